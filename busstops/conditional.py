@@ -0,0 +1,63 @@
+"""Validators for pages that only change when data is imported (or, for stops, when their departures do),
+so that requests for unchanged pages can be answered with '304 Not Modified' before the pages are built
+"""
+import time
+import hashlib
+import datetime
+from django.core.cache import cache
+from django.utils import timezone
+from django.views.decorators import http
+from django.views.decorators.cache import cache_control
+from departures import caching
+from . import versions
+
+
+# Changed (by invalidate) after importing data
+VERSION_KEY = 'data-version'
+
+
+def invalidate():
+    """Make every page's validators change, after importing data"""
+    versions.invalidate(VERSION_KEY)
+
+
+def get_last_modified(request, *args, **kwargs):
+    """Return when data was last imported, as a datetime, or None if there's no cache"""
+    version = versions.get_version(VERSION_KEY)
+    if version is not None:
+        return datetime.datetime.fromtimestamp(version, timezone.utc)
+
+
+def get_service_last_modified(request, *args, **kwargs):
+    """Like get_last_modified, but no earlier than midnight,
+    because service pages' timetables depend on today's date
+    """
+    if request.user.is_staff:  # staff see a form for adding photos
+        return
+    last_modified = get_last_modified(request)
+    if last_modified is not None:
+        midnight = timezone.make_aware(datetime.datetime.combine(timezone.localdate(), datetime.time()))
+        return max(last_modified, midnight)
+
+
+def get_stop_etag(request, pk):
+    """Return an ETag for a stop page, based on when its departures in the cache go stale,
+    or None if they're not in the cache or are already stale
+    """
+    version = versions.get_version(VERSION_KEY)
+    if version is None:
+        return
+    if '-' not in pk:
+        pk = pk.upper()
+    cached = cache.get(caching.get_key(pk))
+    if cached and cached[1] > time.time():
+        return '"{}"'.format(hashlib.md5('{}:{}:{}'.format(pk, cached[1], version).encode()).hexdigest())
+
+
+def condition(etag_func=None, last_modified_func=None):
+    """Like Django's condition decorator, but making browsers check whether a page has changed every time
+    (rather than guessing how long it will stay the same, from when it was last modified)
+    """
+    def decorator(func):
+        return cache_control(no_cache=True)(http.condition(etag_func, last_modified_func)(func))
+    return decorator
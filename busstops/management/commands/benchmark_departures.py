@@ -0,0 +1,112 @@
+"""Time how long it takes to parse each live departures source's responses,
+and the timestamps in them (compared to dateutil's general parser),
+replaying the responses recorded in data/vcr, to compare the cost of parsing across releases.
+
+Needs PyYAML, which comes with the test requirements (it's a dependency of vcrpy)
+"""
+import os
+import gzip
+import timeit
+import datetime
+import requests
+import dateutil.parser
+from requests.structures import CaseInsensitiveDict
+try:
+    import yaml
+except ImportError:  # not in the production requirements
+    yaml = None
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from departures import live, timestamps
+from ...models import StopPoint
+
+
+YORKSHIRE_STOP = StopPoint(atco_code='3290YYA00215', naptan_code='32900215')
+CARDIFF_STOP = StopPoint(atco_code='5710WDB48471')
+BELFAST_STOP = StopPoint(atco_code='700000001415')
+CASSETTES = (
+    ('acisconnect_yorkshire', lambda now: live.AcisConnectDepartures('yorkshire', YORKSHIRE_STOP, (), now)),
+    ('cardiff', lambda now: live.AcisConnectDepartures('cardiff', CARDIFF_STOP, (), now)),
+    ('translink_metro', lambda now: live.AcisConnectDepartures('belfast', BELFAST_STOP, (), now)),
+    ('acislive_yorkshire', lambda now: live.AcisLiveDepartures('tsy', YORKSHIRE_STOP, (), now)),
+    ('acislive_kent', lambda now: live.AcisLiveDepartures('kent', StopPoint(naptan_code='2400A020330A'), (), now)),
+    ('2900M114', lambda now: live.TransportApiDepartures(StopPoint(atco_code='2900M114'), (), now.date())),
+)
+
+
+def get_stagecoach_times(data):
+    for call in data['stopMonitors']['stopMonitor'][0]['monitoredCalls']['monitoredCall']:
+        yield call['aimedDepartureTime']
+        if 'expectedDepartureTime' in call:
+            yield call['expectedDepartureTime']
+
+
+def get_dublin_times(data):
+    for item in data['results']:
+        yield item['scheduleddeparturedatetime']
+        yield item['departuredatetime']
+
+
+TIMESTAMP_CASSETTES = (
+    ('tfl_arrivals', lambda data: (item['expectedArrival'] for item in data), timestamps.parse_datetime,
+     lambda string: dateutil.parser.parse(string).astimezone(timestamps.LOCAL_TIMEZONE)),
+    ('stagecoach', get_stagecoach_times, timestamps.parse_datetime,
+     lambda string: dateutil.parser.parse(string).astimezone(timestamps.LOCAL_TIMEZONE)),
+    ('stagecoach_timezone', get_stagecoach_times, timestamps.parse_datetime,
+     lambda string: dateutil.parser.parse(string).astimezone(timestamps.LOCAL_TIMEZONE)),
+    ('dublin', get_dublin_times, timestamps.parse_day_first_datetime,
+     lambda string: dateutil.parser.parse(string, dayfirst=True)),
+)
+
+
+def time_function(function, number):
+    return min(timeit.repeat(function, repeat=3, number=number)) / number
+
+
+def get_response(path):
+    """Given the path to a VCR.py cassette, return a Response object like the last response recorded in it
+    (the first might be a redirect)
+    """
+    with open(path) as open_file:
+        # some cassettes have !!python/unicode tags, which the safe loader doesn't understand
+        recorded = yaml.load(open_file, Loader=yaml.Loader)['interactions'][-1]['response']
+    content = recorded['body']['string']
+    if not isinstance(content, bytes):
+        content = content.encode()
+    response = requests.models.Response()
+    response.headers = CaseInsensitiveDict((key, values[0]) for key, values in recorded['headers'].items())
+    if response.headers.get('Content-Encoding') == 'gzip':
+        content = gzip.decompress(content)
+    response._content = content
+    response.status_code = recorded['status']['code']
+    return response
+
+
+class Command(BaseCommand):
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--number', type=int, default=100, help='Times to parse each response per repeat')
+
+    def handle(self, *args, **options):
+        if yaml is None:
+            raise CommandError('benchmark_departures needs PyYAML -- pip install -r requirements-test.txt')
+        now = datetime.datetime.now()
+        number = options['number']
+        for name, get_departures in CASSETTES:
+            response = get_response(os.path.join(settings.BASE_DIR, 'data', 'vcr', name + '.yaml'))
+            departures = get_departures(now)
+            rows = departures.departures_from_response(response)
+            seconds = time_function(lambda: departures.departures_from_response(response), number)
+            self.stdout.write('{:<24} {:<24} {:>3} rows {:>8.3f} ms'.format(
+                name, departures.get_source_name(), len(rows or ()), seconds * 1000
+            ))
+
+        for name, get_times, parse, parse_slowly in TIMESTAMP_CASSETTES:
+            response = get_response(os.path.join(settings.BASE_DIR, 'data', 'vcr', name + '.yaml'))
+            strings = list(get_times(response.json()))
+            assert [parse(string) for string in strings] == [parse_slowly(string) for string in strings]
+            seconds = time_function(lambda: [parse(string) for string in strings], number)
+            slow_seconds = time_function(lambda: [parse_slowly(string) for string in strings], number)
+            self.stdout.write('{:<24} {:>3} timestamps {:>8.3f} ms (dateutil {:.3f} ms)'.format(
+                name, len(strings), seconds * 1000, slow_seconds * 1000
+            ))
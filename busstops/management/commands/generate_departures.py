@@ -1,12 +1,15 @@
+import io
 import os
-from datetime import timedelta, datetime, date
+from collections import defaultdict
+from datetime import timedelta, datetime, date, time
 from pytz.exceptions import NonExistentTimeError, AmbiguousTimeError
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import connection, transaction
 from django.conf import settings
 from django.utils import timezone
-from timetables import txc, northern_ireland
-from ...models import Region, Service, Journey, StopUsageUsage, StopPoint
+from departures import boards, profiles
+from timetables import northern_ireland
+from ...models import Region, Service, Journey, StopUsage, StopUsageUsage
 
 
 ONE_DAY = timedelta(days=1)
@@ -22,38 +25,184 @@ def combine_date_time(date, time):
         return timezone.make_aware(combo, is_dst=True)
 
 
-def handle_timetable(service, timetable, day):
+def copy_rows(cursor, table, columns, rows):
+    """Given a cursor, a table name, a list of column names and an iterable of tuples,
+    insert the rows using PostgreSQL's COPY, which is much quicker than INSERTing them
+    """
+    data = io.StringIO()
+    for row in rows:
+        data.write('\t'.join(str(value) for value in row))
+        data.write('\n')
+    data.seek(0)
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(
+        table, ', '.join(connection.ops.quote_name(column) for column in columns)
+    ), data)
+
+
+def get_partitions(cursor, table):
+    """Given a cursor and the name of a partitioned table,
+    return a dict of dates to the names of the table's day partitions
+    """
+    cursor.execute('SELECT relname FROM pg_inherits JOIN pg_class ON pg_class.oid = inhrelid '
+                   'WHERE inhparent = %s::regclass', [table])
+    return {
+        datetime.strptime(name[-8:], '%Y%m%d').date(): name for name, in cursor.fetchall()
+    }
+
+
+def get_partition_name(table, day):
+    return '{}_{:%Y%m%d}'.format(table, day)
+
+
+def get_partition_bounds(day):
+    """Given a date, return the start and end of the range of StopUsageUsage datetimes in its partition
+    (two days long, because a journey that leaves late in the evening can carry on past midnight)
+    """
+    return combine_date_time(day, time(0)), combine_date_time(day + ONE_DAY * 2, time(0))
+
+
+def create_partitions(cursor, day):
+    """Given a cursor and a date, create that date's partitions of the Journey and StopUsageUsage tables.
+
+    They are children that inherit the parent tables, with CHECK constraints on the datetime,
+    so that a query with a datetime range only scans the relevant days (see constraint_exclusion).
+    Foreign keys aren't inherited, so their integrity is left up to Django
+    """
+    quote_name = connection.ops.quote_name
+    start, end = get_partition_bounds(day)
+    for table, table_end, indexes in (
+        (Journey._meta.db_table, combine_date_time(day + ONE_DAY, time(0)), (('service_id',),)),
+        (StopUsageUsage._meta.db_table, end, (('stop_id', 'datetime'), ('journey_id', 'datetime')))
+    ):
+        name = get_partition_name(table, day)
+        cursor.execute('CREATE TABLE IF NOT EXISTS {} (PRIMARY KEY (id), CHECK (datetime >= %s AND datetime < %s)) '
+                       'INHERITS ({})'.format(quote_name(name), quote_name(table)), [start, table_end])
+        for index in indexes:
+            cursor.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                quote_name('{}_{}'.format(name, '_'.join(index))), quote_name(name), ', '.join(index)
+            ))
+
+
+def drop_partitions(before):
+    """Given a date, drop the Journey and StopUsageUsage partitions for the days before it,
+    which is much quicker than deleting all their rows.
+
+    Partitions hold every region's journeys, so this is done once, not for each region
+    """
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for table in (StopUsageUsage._meta.db_table, Journey._meta.db_table):
+            for day, name in get_partitions(cursor, table).items():
+                if day < before:
+                    cursor.execute('DROP TABLE {}'.format(connection.ops.quote_name(name)))
+
+
+class JourneyWriter(object):
+    """Collects generated journeys and their StopUsageUsages in memory,
+    and writes them to the database in large batches
+    """
+    batch_size = 50000
+
+    def __init__(self):
+        self.journeys = []
+        self.stopusageusages = []
+
+    def add(self, service_id, departure, destination_id, stopusageusages):
+        """Given a service code, a departure datetime, a destination ATCO code
+        and a list of (ATCO code, datetime, order) tuples
+        """
+        journey = len(self.journeys)
+        self.journeys.append((service_id, departure, destination_id))
+        self.stopusageusages += [(journey, stop_id, when, order) for stop_id, when, order in stopusageusages]
+        if len(self.stopusageusages) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.journeys:
+            return
+        if connection.vendor == 'postgresql':
+            self.copy()
+        else:
+            ids = [
+                Journey.objects.create(service_id=service_id, datetime=departure, destination_id=destination_id).pk
+                for service_id, departure, destination_id in self.journeys
+            ]
+            StopUsageUsage.objects.bulk_create((
+                StopUsageUsage(journey_id=ids[journey], stop_id=stop_id, datetime=when, order=order)
+                for journey, stop_id, when, order in self.stopusageusages
+            ), batch_size=1000)
+        self.journeys = []
+        self.stopusageusages = []
+
+    def copy(self):
+        """Write each journey and its StopUsageUsages into the partitions for the journey's day
+        (or, for the odd journey with a StopUsageUsage too far from its day, into the parent tables --
+        the parent StopUsageUsage table's foreign key only refers to the parent Journey table)
+        """
+        journey_table = Journey._meta.db_table
+        stopusageusage_table = StopUsageUsage._meta.db_table
+        days = [timezone.localtime(departure).date() for _, departure, _ in self.journeys]
+        bounds = {day: get_partition_bounds(day) for day in set(days)}
+        for journey, _, when, _ in self.stopusageusages:
+            day = days[journey]
+            if day and not bounds[day][0] <= when < bounds[day][1]:
+                days[journey] = None
+        with connection.cursor() as cursor:
+            # reserve the journeys' ids up front, so the StopUsageUsages can refer to them
+            cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                           [journey_table, 'id', len(self.journeys)])
+            ids = [row[0] for row in cursor.fetchall()]
+
+            journeys = defaultdict(list)
+            for i, journey in enumerate(self.journeys):
+                journeys[days[i]].append((ids[i],) + journey)
+            stopusageusages = defaultdict(list)
+            for journey, stop_id, when, order in self.stopusageusages:
+                stopusageusages[days[journey]].append((ids[journey], stop_id, when, order))
+
+            partitions = get_partitions(cursor, journey_table)
+            for day in journeys:
+                if day and day not in partitions:
+                    create_partitions(cursor, day)
+                copy_rows(cursor, get_partition_name(journey_table, day) if day else journey_table,
+                          ('id', 'service_id', 'datetime', 'destination_id'), journeys[day])
+            for day in stopusageusages:
+                copy_rows(cursor, get_partition_name(stopusageusage_table, day) if day else stopusageusage_table,
+                          ('journey_id', 'stop_id', 'datetime', 'order'), stopusageusages[day])
+
+
+def get_stops(region):
+    """Given a region, return the set of ATCO codes of stops that its services use,
+    which (unlike the stops in the timetables) are certain to exist
+    """
+    return set(StopUsage.objects.filter(service__region=region).values_list('stop', flat=True).distinct())
+
+
+def handle_timetable(writer, service, timetable, day, stops):
     if not timetable.operating_period.contains(day):
         return
     for grouping in timetable.groupings:
-        stops = {row.part.stop.atco_code for row in grouping.rows}
-        existent_stops = StopPoint.objects.filter(atco_code__in=stops).values_list('atco_code', flat=True)
         for vj in grouping.journeys:
             if not vj.should_show(day, timetable):
                 continue
             date = day
             previous_time = None
             stopusageusages = []
-            journey = Journey(service=service, datetime=combine_date_time(date, vj.departure_time))
-            for i, (su, time) in enumerate(vj.get_times()):
-                if previous_time and previous_time > time:
+            destination_id = None
+            for i, (su, stop_time) in enumerate(vj.get_times()):
+                if previous_time and previous_time > stop_time:
                     date += ONE_DAY
-                if su.stop.atco_code in existent_stops:
+                if su.stop.atco_code in stops:
                     if not su.activity or su.activity.startswith('pickUp'):
-                        stopusageusages.append(
-                            StopUsageUsage(datetime=combine_date_time(date, time),
-                                           order=i, stop_id=su.stop.atco_code)
-                        )
-                    journey.destination_id = su.stop.atco_code
-                previous_time = time
-            if journey.destination_id:
-                journey.save()
-                for suu in stopusageusages:
-                    suu.journey = journey
-                StopUsageUsage.objects.bulk_create(stopusageusages)
-
-
-def handle_ni_grouping(service, grouping, day):
+                        stopusageusages.append((su.stop.atco_code, combine_date_time(date, stop_time), i))
+                    destination_id = su.stop.atco_code
+                previous_time = stop_time
+            if destination_id:
+                writer.add(service.pk, combine_date_time(day, vj.departure_time), destination_id, stopusageusages)
+
+
+def handle_ni_grouping(writer, service, grouping, day):
     for journey in grouping['Journeys']:
         if not northern_ireland.should_show(journey, day) or not journey['StopUsages']:
             continue
@@ -69,33 +218,69 @@ def handle_ni_grouping(service, grouping, day):
                 if su['Activity'] != 'S':
                     if previous_time and departure < previous_time:
                         date += ONE_DAY
-                    stopusageusages.append(
-                        StopUsageUsage(datetime=combine_date_time(date, departure),
-                                       order=i, stop_id=su['Location'])
-                    )
+                    stopusageusages.append((su['Location'], combine_date_time(date, departure), i))
                 previous_time = departure
-        journey = Journey(service=service, datetime=stopusageusages[0].datetime, destination_id=destination)
-        journey.save()
-        for suu in stopusageusages:
-            suu.journey = journey
-        StopUsageUsage.objects.bulk_create(stopusageusages)
+        writer.add(service.pk, stopusageusages[0][1], destination, stopusageusages)
 
 
-def do_ni_service(service, groupings, day):
+def do_ni_service(writer, service, groupings, day):
     for grouping in groupings:
         if grouping['Journeys']:
-            handle_ni_grouping(service, grouping, day)
+            handle_ni_grouping(writer, service, grouping, day)
+
+
+def get_end_date(region, today):
+    if region.id == 'NI':
+        return today + ONE_DAY * 7
+    return today + ONE_DAY * 2  # not actually next week
+
+
+def handle_service(writer, service, today, end_date, stops):
+    if service.region_id == 'NI':
+        path = os.path.join(settings.DATA_DIR, 'NI', service.pk + '.json')
+        if not os.path.exists(path):
+            return
+        groupings = northern_ireland.get_data(path)
+        day = today
+        while day <= end_date:
+            do_ni_service(writer, service, groupings, day)
+            day += ONE_DAY
+    else:
+        # stored at import time, or parsed again if they're not up to date
+        for timetable in service.get_timetables_from_zipfile(None):
+            day = today
+            while day <= end_date:
+                handle_timetable(writer, service, timetable, day, stops)
+                day += ONE_DAY
+
+
+def delete_journeys(journeys):
+    """Given a Journey QuerySet, delete the journeys and their StopUsageUsages,
+    deleting the StopUsageUsages first in one statement, rather than in batches of journey ids
+    """
+    StopUsageUsage.objects.filter(journey__in=journeys).delete()
+    journeys.delete()
+
+
+def generate(region, services, today, end_date):
+    writer = JourneyWriter()
+    stops = get_stops(region)
+    for service in services:
+        handle_service(writer, service, today, end_date, stops)
+    writer.flush()
+    transaction.on_commit(boards.invalidate)
+    transaction.on_commit(profiles.invalidate)
 
 
 @transaction.atomic
 def handle_region(region):
+    """Given a region, delete the journeys from before today (that aren't in partitions),
+    and only generate the journeys for the days that haven't been generated yet
+    """
     today = date.today()
-    if region.id == 'NI':
-        NEXT_WEEK = today + ONE_DAY * 7
-    else:  # not actually next week
-        NEXT_WEEK = today + ONE_DAY * 2
+    NEXT_WEEK = get_end_date(region, today)
     # delete journeys before today
-    Journey.objects.filter(service__region=region, datetime__date__lt=today).delete()
+    delete_journeys(Journey.objects.filter(service__region=region, datetime__lt=combine_date_time(today, time(0))))
     # get the date of the last generated journey
     last_journey = Journey.objects.filter(service__region=region).order_by('datetime').last()
     if last_journey:
@@ -103,23 +288,18 @@ def handle_region(region):
         if today > NEXT_WEEK:
             return
 
-    for service in Service.objects.filter(region=region, current=True):
-        if region.id == 'NI':
-            path = os.path.join(settings.DATA_DIR, 'NI', service.pk + '.json')
-            if not os.path.exists(path):
-                continue
-            groupings = northern_ireland.get_data(path)
-            day = today
-            while day <= NEXT_WEEK:
-                do_ni_service(service, groupings, day)
-                day += ONE_DAY
-        else:
-            for i, xml_file in enumerate(service.get_files_from_zipfile()):
-                timetable = txc.Timetable(xml_file, None)
-                day = today
-                while day <= NEXT_WEEK:
-                    handle_timetable(service, timetable, day)
-                    day += ONE_DAY
+    generate(region, Service.objects.filter(region=region, current=True), today, NEXT_WEEK)
+
+
+@transaction.atomic
+def handle_services(region, service_codes):
+    """Given a region and the codes of some of its services,
+    regenerate the journeys of just those services
+    """
+    today = date.today()
+    delete_journeys(Journey.objects.filter(service__in=service_codes))
+    generate(region, Service.objects.filter(region=region, service_code__in=service_codes, current=True),
+             today, get_end_date(region, today))
 
 
 class Command(BaseCommand):
@@ -128,5 +308,7 @@ class Command(BaseCommand):
         parser.add_argument('regions', nargs='+', type=str)
 
     def handle(self, regions, *args, **options):
+        with transaction.atomic():
+            drop_partitions(date.today())
         for region in Region.objects.filter(id__in=regions):
             handle_region(region)
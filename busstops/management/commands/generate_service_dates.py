@@ -15,6 +15,13 @@ class Command(BaseCommand):
         ServiceDate.objects.filter(date__lt=date.today()).delete()
         for service in Service.objects.filter(current=True, show_timetable=True, journey=None):
             today = date.today()
+
+            running_dates = service.get_running_dates(today, 100)
+            if running_dates is not None:
+                for day in running_dates[:7]:
+                    ServiceDate.objects.update_or_create(service=service, date=day)
+                continue
+
             days = 0
             tried_days = 0
 
@@ -4,6 +4,7 @@ import csv
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from django.conf import settings
+from departures import profiles
 from ...models import Service
 
 
@@ -45,3 +46,4 @@ class Command(BaseCommand):
                 if 'IF145' in path:
                     with archive.open(path, 'r') as open_file:
                         handle_file(open_file)
+        transaction.on_commit(profiles.invalidate)
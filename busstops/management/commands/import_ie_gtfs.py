@@ -7,7 +7,9 @@ from django.db import transaction
 from django.db.models import Count
 from django.conf import settings
 from multigtfs.models import Feed
+from departures import profiles
 from timetables.gtfs import get_timetables
+from ... import conditional
 from ...models import Operator, Service, StopPoint, StopUsage, Region
 
 
@@ -151,3 +153,5 @@ class Command(BaseCommand):
             if modified or options['force']:
                 print(collection)
                 self.handle_zipfile(path, collection)
+        profiles.invalidate()
+        conditional.invalidate()
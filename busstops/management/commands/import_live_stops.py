@@ -10,6 +10,7 @@ import json
 import requests
 from bs4 import BeautifulSoup
 from django.core.management.base import BaseCommand
+from departures import profiles
 from ...models import StopPoint, LiveSource
 
 
@@ -98,3 +99,5 @@ class Command(BaseCommand):
             print(stop_ids)
             stoppoints = StopPoint.objects.filter(pk__in=stop_ids)
             live_source.stoppoint_set.add(*stoppoints)
+
+        profiles.invalidate()
@@ -11,6 +11,7 @@ except ImportError:
 from bs4 import BeautifulSoup
 from titlecase import titlecase
 from django.utils.text import slugify
+from departures import profiles
 from ..import_from_csv import ImportFromCSVCommand
 from ...models import StopPoint, Operator, Service, StopUsage
 
@@ -21,6 +22,10 @@ session = requests.Session()
 class Command(ImportFromCSVCommand):
     encoding = 'utf-8-sig'
 
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        profiles.invalidate()
+
     def handle_row(self, row):
         atco_code = 'maneo-' + row['CODE']
         defaults = {
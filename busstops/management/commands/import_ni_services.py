@@ -6,7 +6,9 @@ from django.contrib.gis.geos import Point
 from django.db import transaction
 from chardet.universaldetector import UniversalDetector
 from titlecase import titlecase
+from busstops import conditional
 from busstops.models import Operator, Service, StopPoint, StopUsage
+from departures import profiles
 
 
 class Command(BaseCommand):
@@ -191,3 +193,6 @@ class Command(BaseCommand):
         cls.create_stop_usages()
 
         Service.objects.filter(region_id='NI', stops__isnull=True).delete()
+
+        transaction.on_commit(profiles.invalidate)
+        transaction.on_commit(conditional.invalidate)
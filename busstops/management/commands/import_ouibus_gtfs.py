@@ -6,7 +6,9 @@ from django.db import transaction
 from django.conf import settings
 from titlecase import titlecase
 from multigtfs.models import Feed, ServiceDate, Service as GTFSService
+from departures import profiles
 from timetables.gtfs import get_grouping_name_part, get_timetable
+from ... import conditional
 from ...models import Operator, Service, StopPoint, StopUsage, Region
 from .import_ie_gtfs import download_if_modified, MODES
 
@@ -140,3 +142,5 @@ class Command(BaseCommand):
             path = os.path.join(settings.DATA_DIR, collection) + '.zip'
             if download_if_modified(path, settings.FRANCE_COLLECTIONS[collection]) or force:
                 self.handle_zipfile(path, collection)
+        profiles.invalidate()
+        conditional.invalidate()
@@ -7,6 +7,8 @@ known errors.
 Usage:
 
     ./manage.py import_services EA.zip [EM.zip etc]
+
+With --workers 4 (say), the XML files are parsed in 4 processes, while this process saves the results
 """
 
 import os
@@ -15,12 +17,16 @@ import csv
 import warnings
 import xml.etree.cElementTree as ET
 from datetime import date
+from multiprocessing import Pool
+from django.conf import settings
 from django.contrib.gis.geos import LineString, MultiLineString
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import connections, transaction
+from timetables import store, archives
 from timetables.txc import Timetable, sanitize_description_part
+from ... import conditional, polylines, tiles
 from ...models import Operator, StopPoint, Service, StopUsage, Region, Journey, ServiceCode
-from .generate_departures import handle_region
+from .generate_departures import handle_region, handle_services, delete_journeys
 
 
 # map names to operator IDs where there is no correspondence between the NOC DB and TNDS:
@@ -118,6 +124,10 @@ class Command(BaseCommand):
     @staticmethod
     def add_arguments(parser):
         parser.add_argument('filenames', nargs='+', type=str)
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes to parse files in (default 1, meaning no extra processes)')
+        parser.add_argument('--full', action='store_true',
+                            help='Import every file, not just the ones that have changed since the last import')
 
     @staticmethod
     def infer_from_filename(filename):
@@ -134,6 +144,16 @@ class Command(BaseCommand):
                 return (net, '-'.join(parts[:-1]), parts[-1][:-4])
         return ('', None, None)
 
+    @staticmethod
+    def get_homogeneous_service_code(service_code):
+        """
+        Given a North West service code like 'NW_04_GMS_237_1', returns the code like 'NW_04_GMS_237'
+        that the service might share with others. Given any other sort of service code, returns None
+        """
+        parts = service_code.split('_')
+        if len(parts) == 5 and parts[0] == 'NW':
+            return '_'.join(parts[:-1])
+
     @staticmethod
     def sanitize_description(name):
         """
@@ -236,19 +256,20 @@ class Command(BaseCommand):
         except ValueError as error:
             warnings.warn('%s %s' % (error, points))
 
-    def do_service(self, open_file, filename):
+    def parse_service(self, open_file, filename):
         """
-        Given a root element, region ID, filename, and optional dictionary of service descriptions
-        (for the NCSD), does stuff
+        Given an open TransXChange file and its filename, returns a (Timetable, record) tuple, where the record
+        is a dict of plain values that save_service can save (or (None, None) if the service should be skipped).
+        Only reads from the database, so can be run in a worker process.
         """
 
         timetable = Timetable(open_file, None)
 
         if not hasattr(timetable, 'element'):
-            return
+            return None, None
 
         if timetable.operating_period.end and timetable.operating_period.end < date.today():
-            return
+            return None, None
 
         operators = timetable.operators
         if timetable.operator and len(operators) > 1:
@@ -282,9 +303,9 @@ class Command(BaseCommand):
             for grouping in timetable.groupings:
                 if grouping.rows:
                     stop_usages += [
-                        StopUsage(
-                            service_id=service_code, stop_id=row.part.stop.atco_code,
-                            direction=grouping.direction, order=i, timing_status=row.part.timingstatus
+                        dict(
+                            stop_id=row.part.stop.atco_code, direction=grouping.direction, order=i,
+                            timing_status=row.part.timingstatus
                         )
                         for i, row in enumerate(grouping.rows) if row.part.stop.atco_code in stops
                     ]
@@ -303,13 +324,15 @@ class Command(BaseCommand):
         except (AttributeError, IndexError) as error:
             warnings.warn('%s, %s' % (error, filename))
             show_timetable = False
-            stop_usages = [StopUsage(service_id=service_code, stop_id=stop, order=0) for stop in stops]
+            stop_usages = [dict(stop_id=stop, order=0) for stop in stops]
             multi_line_string = None
 
         # service:
         defaults['show_timetable'] = show_timetable
         defaults['geometry'] = multi_line_string
+        defaults['simplified_geometry'] = polylines.simplify(multi_line_string) if multi_line_string else None
 
+        description = None
         if self.service_descriptions:
             filename_parts = filename.split('_')
             operator = filename_parts[-2]
@@ -330,44 +353,94 @@ class Command(BaseCommand):
             if description != 'Origin - Destination':
                 defaults['description'] = description
 
-            parts = service_code.split('_')
-            if len(parts) == 5 and parts[0] == 'NW':
-                homogeneous_service_code = '_'.join(parts[:-1])
+        return timetable, {
+            'filename': filename,
+            'service_code': service_code,
+            'description': description,
+            'defaults': defaults,
+            'operators': operators,
+            'stop_usages': stop_usages,
+            'private_code': timetable.private_code,
+            'end': timetable.operating_period.end
+        }
+
+    def save_service(self, record):
+        """
+        Given a record from parse_service, creates or updates the Service.
+        Stop usages are saved in batches, by flush_stop_usages
+        """
+
+        service_code = record['service_code']
+        defaults = record['defaults']
 
-                same_services = Service.objects.filter(description=description, current=True)
+        if not self.service_descriptions:
+            homogeneous_service_code = self.get_homogeneous_service_code(service_code)
+            if homogeneous_service_code:
+                same_services = Service.objects.filter(description=record['description'], current=True)
                 same_service = same_services.filter(service_code__startswith=homogeneous_service_code + '_')
                 same_service = same_service.exclude(service_code=service_code).first()
                 if same_service:
+                    filenames = self.service_filenames.pop(same_service.service_code, [])
                     service_code = homogeneous_service_code
                     same_service.service_code = service_code
                     same_service.save()
+                    self.service_filenames.setdefault(service_code, []).extend(filenames)
                 elif same_services.filter(service_code=homogeneous_service_code).exists():
                     service_code = homogeneous_service_code
 
-                if service_code == homogeneous_service_code:
-                    for stop_usage in stop_usages:
-                        stop_usage.service_id = service_code
-
         service, created = Service.objects.update_or_create(service_code=service_code, defaults=defaults)
 
         if created:
-            service.operator.add(*operators)
+            service.operator.add(*record['operators'])
         else:
-            service.operator.set(operators)
+            service.operator.set(record['operators'])
             if service_code not in self.service_codes:
                 service.stops.clear()
-        StopUsage.objects.bulk_create(stop_usages)
+        self.stop_usages += [
+            StopUsage(service_id=service_code, **stop_usage) for stop_usage in record['stop_usages']
+        ]
 
-        if timetable.private_code:
+        if record['private_code']:
             private_code_args = {
                 'service': service,
                 'scheme': 'Traveline Cymru',
-                'code': timetable.private_code
+                'code': record['private_code']
             }
             if not ServiceCode.objects.filter(**private_code_args).exists():
                 ServiceCode.objects.create(**private_code_args)
 
         self.service_codes.add(service_code)
+        self.service_filenames.setdefault(service_code, []).append(record['filename'])
+        self.file_ends[record['filename']] = record['end']
+
+    def flush_stop_usages(self):
+        StopUsage.objects.bulk_create(self.stop_usages, batch_size=1000)
+        self.stop_usages = []
+
+    def do_service(self, open_file, filename):
+        """
+        Given an open file and its filename, does stuff, and returns the Timetable
+        (or None if the service was skipped)
+        """
+
+        timetable, record = self.parse_service(open_file, filename)
+        if record is not None:
+            self.save_service(record)
+            self.flush_stop_usages()
+        return timetable
+
+    def parse_file(self, archive, filename):
+        """
+        Given an open zipfile and the name of an XML file in it, returns a record from parse_service
+        (or None), having stored the parsed timetable
+        """
+
+        with archive.open(filename) as open_file:
+            timetable, record = self.parse_service(open_file, filename)
+        if timetable is not None:
+            path = store.get_path(settings.TNDS_DIR, self.region_id, filename)
+            store.write(path, timetable, archive.getinfo(filename).CRC)
+        return record
 
     def set_region(self, archive_name):
         self.region_id, _ = os.path.splitext(os.path.basename(archive_name))
@@ -375,12 +448,12 @@ class Command(BaseCommand):
         if self.region_id == 'NCSD':
             self.region_id = 'GB'
 
-    @transaction.atomic
     def handle_region(self, archive_name):
         self.set_region(archive_name)
         self.service_codes = set()
-
-        Service.objects.filter(region=self.region_id).update(current=False)
+        self.service_filenames = {}
+        self.file_ends = {}
+        self.stop_usages = []
 
         with zipfile.ZipFile(archive_name) as archive:
 
@@ -395,19 +468,147 @@ class Command(BaseCommand):
             else:
                 self.service_descriptions = None
 
-            for i, filename in enumerate(archive.namelist()):
-                if filename.endswith('.xml'):
-                    with archive.open(filename) as open_file:
-                        self.do_service(open_file, filename)
+            zipinfos = [zipinfo for zipinfo in archive.infolist() if zipinfo.filename.endswith('.xml')]
+
+            if self.workers > 1:
+                # worker processes must not share this process's database connection
+                connections.close_all()
+                pool = Pool(self.workers, initializer=init_worker,
+                            initargs=(archive_name, self.service_descriptions))
+            else:
+                pool = None
+
+            manifest_path = archives.get_manifest_path(settings.TNDS_DIR, self.region_id)
+            manifest = None if self.full else archives.read_manifest(manifest_path)
+
+            try:
+                if manifest is None:
+                    service_codes = None
+                    records = self.parse_files(archive, [zipinfo.filename for zipinfo in zipinfos], pool)
+                else:
+                    service_codes, records = self.parse_changed_files(archive, zipinfos, manifest, pool)
+                with transaction.atomic():
+                    self.save_region(records, service_codes)
+            finally:
+                if pool is not None:
+                    pool.terminate()
+
+            archives.write_index(archives.get_index_path(settings.TNDS_DIR, self.region_id), archive,
+                                 self.service_filenames)
+            filename_service_codes = {
+                filename: service_code
+                for service_code, filenames in self.service_filenames.items() for filename in filenames
+            }
+            archives.write_manifest(manifest_path, {
+                zipinfo.filename: (zipinfo.CRC, zipinfo.file_size, filename_service_codes.get(zipinfo.filename),
+                                   self.file_ends.get(zipinfo.filename))
+                for zipinfo in zipinfos
+            })
+
+    def parse_files(self, archive, filenames, pool):
+        """Given an open zipfile, some names of files in it, and maybe a Pool of worker processes,
+        returns an iterable of records from parse_file, in the same order as the filenames
+        """
+        if pool is None:
+            return (self.parse_file(archive, filename) for filename in filenames)
+        return pool.imap(parse_file, filenames)
+
+    def parse_changed_files(self, archive, zipinfos, manifest, pool):
+        """Given an open zipfile, the ZipInfos of the XML files in it, the manifest from the last import
+        and maybe a Pool of worker processes,
+        parses only the files that have changed since the last import (or whose operating periods have ended since),
+        and the other files of the services they are (or were) part of.
+        Returns a (service_codes, records) tuple, where service_codes is a set of the codes of affected services
+        """
+        today = date.today()
+        unchanged = {}
+        changed = []
+        for zipinfo in zipinfos:
+            entry = manifest.get(zipinfo.filename)
+            if (
+                entry is not None and entry[:2] == (zipinfo.CRC, zipinfo.file_size)
+                and not (entry[3] and entry[3] < today)
+            ):
+                unchanged[zipinfo.filename] = entry[2]
+            else:
+                changed.append(zipinfo.filename)
+        removed = [filename for filename in manifest if filename not in unchanged and filename not in changed]
+
+        service_codes = {manifest[filename][2] for filename in changed + removed if filename in manifest}
+        records = {}
+        for filename, record in zip(changed, self.parse_files(archive, changed, pool)):
+            records[filename] = record
+            if record is not None:
+                service_codes.add(record['service_code'])
+
+        # files of the same services (including North West services that might share a homogeneous service code)
+        groups = {self.get_homogeneous_service_code(code) or code for code in service_codes if code}
+        others = [
+            filename for filename, code in unchanged.items()
+            if code and (self.get_homogeneous_service_code(code) or code) in groups
+        ]
+        for filename, record in zip(others, self.parse_files(archive, others, pool)):
+            records[filename] = record
+            service_codes.add(unchanged[filename])
+
+        for filename, code in unchanged.items():
+            if code and filename not in records:
+                self.service_filenames.setdefault(code, []).append(filename)
+                self.file_ends[filename] = manifest[filename][3]
+
+        service_codes.discard(None)
+        return service_codes, [records[zipinfo.filename] for zipinfo in zipinfos if zipinfo.filename in records]
+
+    def save_region(self, records, service_codes=None):
+        """Given an iterable of records and (if only some services have changed) a set of affected service codes,
+        saves the records and regenerates departures
+        """
+        services = Service.objects.filter(region=self.region_id)
+        if service_codes is not None:
+            services = services.filter(service_code__in=service_codes)
+        services.update(current=False)
+
+        for record in records:
+            if record is not None:
+                self.save_service(record)
+                if len(self.stop_usages) >= 1000:
+                    self.flush_stop_usages()
+        self.flush_stop_usages()
 
-        Service.objects.filter(region=self.region_id, current=False).update(geometry=None)
+        Service.objects.filter(region=self.region_id, current=False).update(geometry=None, simplified_geometry=None)
 
         StopPoint.objects.filter(admin_area__region=self.region_id).exclude(service__current=True).update(active=False)
         StopPoint.objects.filter(admin_area__region=self.region_id, service__current=True).update(active=True)
 
-        Journey.objects.filter(service__region=self.region_id).delete()
-        handle_region(Region.objects.get(id=self.region_id))
+        region = Region.objects.get(id=self.region_id)
+        if service_codes is None:
+            delete_journeys(Journey.objects.filter(service__region=self.region_id))
+            handle_region(region)
+        else:
+            handle_services(region, service_codes | self.service_codes)
 
     def handle(self, *args, **options):
+        self.workers = options['workers']
+        self.full = options['full']
         for archive_name in options['filenames']:
             self.handle_region(archive_name)
+        # importing services changes which stops are active, so which are on the map
+        tiles.update_clusters()
+        tiles.invalidate()
+        conditional.invalidate()
+
+
+# a Command and an open zipfile, in each worker process
+worker = None
+
+
+def init_worker(archive_name, service_descriptions):
+    global worker
+    worker = Command()
+    worker.set_region(archive_name)
+    worker.service_descriptions = service_descriptions
+    worker.archive = zipfile.ZipFile(archive_name)
+
+
+def parse_file(filename):
+    return worker.parse_file(worker.archive, filename)
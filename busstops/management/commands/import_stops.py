@@ -6,6 +6,7 @@
 from django.contrib.gis.geos import Point
 from titlecase import titlecase
 from ..import_from_csv import ImportFromCSVCommand
+from ... import tiles
 from ...models import Locality, StopPoint
 
 
@@ -159,3 +160,8 @@ class Command(ImportFromCSVCommand):
         )
         # A list of tuples like ('naptan_code', 'NaptanCode')
         self.field_names = [(name, self.to_camel_case(name)) for name in django_field_names]
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        tiles.update_clusters()
+        tiles.invalidate()
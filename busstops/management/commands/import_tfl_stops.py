@@ -7,7 +7,9 @@ import warnings
 import requests
 from titlecase import titlecase
 from django.core.exceptions import MultipleObjectsReturned
+from departures import profiles
 from ..import_from_csv import ImportFromCSVCommand
+from ... import tiles
 from ...models import StopPoint, LiveSource
 
 
@@ -53,3 +55,8 @@ class Command(ImportFromCSVCommand):
         stop.live_sources.add(TFL)
 
         stop.save()
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        profiles.invalidate()
+        tiles.invalidate()
@@ -0,0 +1,34 @@
+"""Keep the departures of the busiest stops in the cache,
+by fetching them again shortly before they would expire
+"""
+import time
+from django.core.management.base import BaseCommand
+from departures import caching
+from ...models import StopPoint
+
+
+class Command(BaseCommand):
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--stops', type=int, default=50, help='The number of busiest stops to keep fresh')
+        parser.add_argument('--interval', type=int, default=10, help='Seconds to sleep between rounds')
+
+    @staticmethod
+    def poll(number, interval, expiries):
+        """Given the number of stops, the interval in seconds and a dict of ATCO codes to when (time.monotonic())
+        this process's cached departures for those stops will expire, refresh the stops that need it
+        """
+        for atco_code in caching.get_hot_stops(number):
+            if expiries.get(atco_code, 0) - time.monotonic() > interval * 2:
+                continue
+            stop = StopPoint.objects.filter(atco_code=atco_code).first()
+            if stop is None:
+                continue
+            max_age = caching.refresh(stop, caching.get_services(stop))
+            expiries[atco_code] = time.monotonic() + max_age
+
+    def handle(self, *args, **options):
+        expiries = {}
+        while True:
+            self.poll(options['stops'], options['interval'], expiries)
+            time.sleep(options['interval'])
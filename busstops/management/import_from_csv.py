@@ -6,6 +6,7 @@ from io import open
 import csv
 from django.core.management.base import BaseCommand
 from django.db import transaction
+from .. import conditional
 
 
 class ImportFromCSVCommand(BaseCommand):
@@ -43,3 +44,4 @@ class ImportFromCSVCommand(BaseCommand):
             rows = csv.DictReader(input)
             for row in self.process_rows(rows):
                 self.handle_row(row)
+        transaction.on_commit(conditional.invalidate)
@@ -7,8 +7,10 @@ import zipfile
 import vcr
 from freezegun import freeze_time
 from django.test import TestCase, override_settings
+from django.core.cache import cache
 from django.core.management import call_command
 from django.conf import settings
+from departures import profiles
 from ...models import StopPoint, Service
 from ..commands import import_ie_gtfs
 
@@ -34,8 +36,11 @@ class ImportGTFSTest(TestCase):
                 for item in os.listdir(dir_path):
                     open_zipfile.write(os.path.join(dir_path, item), item)
 
-        with vcr.use_cassette(os.path.join(FIXTURES_DIR, 'ouibus_gtfs.yaml')):
-            call_command('import_ouibus_gtfs', '--force')
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            cache.set(profiles.VERSION_KEY, 0, None)
+            with vcr.use_cassette(os.path.join(FIXTURES_DIR, 'ouibus_gtfs.yaml')):
+                call_command('import_ouibus_gtfs', '--force')
+            cls.profiles_version = cache.get(profiles.VERSION_KEY)
 
         for collection in settings.FRANCE_COLLECTIONS:
             path = os.path.join(FIXTURES_DIR, collection) + '.zip'
@@ -55,6 +60,10 @@ class ImportGTFSTest(TestCase):
 
         os.remove(path)
 
+    def test_profiles_invalidated(self):
+        # stops' cached services are out of date
+        self.assertNotEqual(self.profiles_version, 0)
+
     def test_stops(self):
         self.assertEqual(14, StopPoint.objects.all().count())
 
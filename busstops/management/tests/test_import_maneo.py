@@ -1,6 +1,9 @@
 import os
+import tempfile
 import vcr
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from departures import profiles
 from ...models import Region, StopPoint, Service
 from ..commands import import_maneo_stops
 
@@ -51,3 +54,15 @@ class ImportManeoTest(TestCase):
         self.assertEqual(4, len(services))
         self.assertEqual('maneo-L3', services[0].service_code)
         self.assertEqual('L3', services[0].line_name)
+
+    def test_profiles_invalidated(self):
+        command = import_maneo_stops.Command()
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as open_file:
+            open_file.write('APPCOM,CODE,IDARRET,IDCOMMUNE,RAD_LON,RAD_LAT,geometry\n')
+            open_file.flush()
+            command.input = open_file.name
+            with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+                cache.set(profiles.VERSION_KEY, 0, None)
+                command.handle()
+                # stops' cached services are out of date
+                self.assertNotEqual(cache.get(profiles.VERSION_KEY), 0)
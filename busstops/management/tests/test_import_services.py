@@ -1,15 +1,22 @@
 # coding=utf-8
 from __future__ import unicode_literals
 import os
+import json
+import pickle
+import shutil
+import tempfile
 import xml.etree.cElementTree as ET
 import zipfile
 import warnings
-from datetime import date, time
+from datetime import date, time, timedelta
 from freezegun import freeze_time
-from django.test import TestCase, override_settings
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.contrib.gis.geos import Point
 from django.core.management import call_command
-from ...models import Operator, Service, Region, StopPoint, Journey, StopUsageUsage, ServiceDate
+from django.db import connection
+from timetables import store, archives
+from ... import polylines, tiles
+from ...models import Operator, Service, Region, AdminArea, StopPoint, StopUsage, Journey, StopUsageUsage, ServiceDate
 from ..commands import import_services, generate_departures
 
 
@@ -98,6 +105,11 @@ class ImportServicesTest(TestCase):
             call_command(cls.command, ncsd_zipfile_path)
 
             # test re-importing a previously imported service again
+            call_command(cls.command, ncsd_zipfile_path, full=True)
+
+            assert len(caught_warnings) == 2
+
+            # nothing has changed, so nothing should be parsed again
             call_command(cls.command, ncsd_zipfile_path)
 
             assert len(caught_warnings) == 2
@@ -235,6 +247,19 @@ class ImportServicesTest(TestCase):
         with open(path) as xml_file:
             cls.command.do_service(xml_file, filename)
 
+    @freeze_time('3 October 2016')
+    def test_parse_service(self):
+        """A parsed service should be a record that can be sent between processes"""
+        self.command.set_region('EA.zip')
+        with open(os.path.join(FIXTURES_DIR, 'ea_21-13B-B-y08-1.xml')) as xml_file:
+            with warnings.catch_warnings(record=True):
+                timetable, record = self.command.parse_service(xml_file, 'ea_21-13B-B-y08-1.xml')
+        record = pickle.loads(pickle.dumps(record))
+        self.assertEqual(record['service_code'], 'ea_21-13B-B-y08')
+        self.assertEqual(record['operators'], ['FECS'])
+        self.assertEqual(record['defaults']['line_brand'], 'Turquoise Line')
+        self.assertIn('2900A1820', [stop_usage['stop_id'] for stop_usage in record['stop_usages']])
+
     def test_do_service_invalid(self):
         """A file with some wrong references should be silently ignored"""
         self.do_service('NW_05_PBT_6_1', 'GB')
@@ -395,6 +420,14 @@ class ImportServicesTest(TestCase):
             'Rugby ASDA', '049004705400', 'Victoria Coach Station Arrivals'
         ])
 
+        # The rendered timetables should be cached, so they're not constructed again
+        res = self.client.get(self.gb_m12.get_absolute_url())
+        self.assertTrue(res.context_data['timetables_html'])
+        self.assertIsNone(res.context_data.get('timetables'))
+        self.assertContains(res, '<option selected value="2017-01-01">Sunday 1 January 2017</option>')
+        self.assertContains(res, 'Middlesbrough Bus Station Express Lounge')
+        self.assertContains(res, '/static/js/timetable.')
+
         with override_settings(TNDS_DIR='this is not a directory'):
             # should not be cached (because dummy cache)
             with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}):
@@ -409,6 +442,65 @@ class ImportServicesTest(TestCase):
             res = self.client.get(self.gb_m12.get_absolute_url() + '?date=2017-01-02')
             self.assertEqual('2017-01-02', str(res.context_data['timetables'][0].date))
 
+    @freeze_time('1 Dec 2016')
+    def test_stored_timetables(self):
+        path = store.get_path(FIXTURES_DIR, 'GB', 'NCSD_TXC/Megabus_Megabus14032016 163144_MEGA_M12.xml')
+        self.assertTrue(os.path.exists(path))
+
+        timetables = self.gb_m12.get_timetables_from_zipfile(None)
+        self.assertEqual(1, len(timetables))
+
+        # a stored timetable should be ignored if the XML file in the archive has changed
+        with zipfile.ZipFile(self.gb_m12.get_archive_path()) as archive:
+            crc = archive.getinfo('NCSD_TXC/Megabus_Megabus14032016 163144_MEGA_M12.xml').CRC
+        self.assertIsNotNone(store.read(path, crc))
+        self.assertIsNone(store.read(path, crc + 1))
+
+    def test_manifest(self):
+        manifest = archives.read_manifest(archives.get_manifest_path(FIXTURES_DIR, 'NW'))
+        self.assertEqual('NW_04_GMS_237', manifest['NW_04_GMS_237_1.xml'][2])
+        self.assertEqual('NW_04_GMS_237', manifest['NW_04_GMS_237_2.xml'][2])
+
+        manifest = archives.read_manifest(archives.get_manifest_path(FIXTURES_DIR, 'GB'))
+        self.assertEqual('M12_MEGA', manifest['NCSD_TXC/Megabus_Megabus14032016 163144_MEGA_M12.xml'][2])
+        self.assertEqual(['NCSD_TXC/Megabus_Megabus14032016 163144_MEGA_M11A.xml',
+                          'NCSD_TXC/Megabus_Megabus14032016 163144_MEGA_M12.xml'], sorted(manifest))
+
+        self.assertEqual({'M12_MEGA'}, self.command.parse_changed_files(None, [], {
+            'NCSD_TXC/Megabus_Megabus14032016 163144_MEGA_M12.xml': (0, 0, 'M12_MEGA', None)
+        }, None)[0])  # a removed file
+
+        # an unchanged file whose operating period has ended since it was imported
+        filename = 'NCSD_TXC/Megabus_Megabus14032016 163144_MEGA_M12.xml'
+        with zipfile.ZipFile(self.gb_m12.get_archive_path()) as archive:
+            zipinfo = archive.getinfo(filename)
+            self.assertEqual({'M12_MEGA'}, self.command.parse_changed_files(archive, [zipinfo], {
+                filename: (zipinfo.CRC, zipinfo.file_size, 'M12_MEGA', date(2000, 1, 1))
+            }, None)[0])
+
+        # the manifest should be ignored if the stored timetables are out of date
+        path = archives.get_manifest_path(FIXTURES_DIR, 'GB')
+        store.VERSION += 1
+        try:
+            self.assertIsNone(archives.read_manifest(path))
+        finally:
+            store.VERSION -= 1
+        self.assertIsNotNone(archives.read_manifest(path))
+
+    def test_index(self):
+        index_path = archives.get_index_path(FIXTURES_DIR, 'NW')
+        index = archives.get_index(index_path, os.path.join(FIXTURES_DIR, 'NW.zip'))
+        self.assertEqual(['NW_04_GMS_237_1.xml', 'NW_04_GMS_237_2.xml'],
+                         sorted(zipinfo.filename for zipinfo in index['NW_04_GMS_237']))
+
+        archive = archives.get_archive(self.gb_m12.get_archive_path())
+        self.assertIs(archive, archives.get_archive(self.gb_m12.get_archive_path()))
+        self.assertEqual(['NCSD_TXC/Megabus_Megabus14032016 163144_MEGA_M12.xml'],
+                         [zipinfo.filename for zipinfo in self.gb_m12.get_zipinfos(archive)])
+
+        # an index should be ignored if the archive has changed since
+        self.assertIsNone(archives.get_index(index_path, self.gb_m12.get_archive_path()))
+
     @freeze_time('25 June 2016')
     def test_do_service_scotland(self):
         service = self.sc_service
@@ -425,6 +517,12 @@ class ImportServicesTest(TestCase):
             (53.7423055225, -2.504212506), (53.7398252112, -2.5083672338),
             (53.7389877672, -2.5108434749), (53.7425523688, -2.4989239373)
         ),))
+        self.assertEqual(service.simplified_geometry['0'], [polylines.encode(service.geometry[0].coords)])
+        res = self.client.get('/services/{}/geometry.json'.format(service.pk), {'zoom': 16})
+        self.assertEqual(res.json(), {'tolerance': 0, 'polylines': service.simplified_geometry['0']})
+        res = self.client.get('/services/{}/geometry.json'.format(service.pk), {'zoom': 6})
+        self.assertEqual(res.json()['tolerance'], 0.01)
+        self.assertEqual(len(res.json()['polylines']), 1)
 
         res = self.client.get(service.get_absolute_url())
         self.assertEqual(res.context_data['breadcrumb'], (self.sc, self.fabd))
@@ -490,6 +588,21 @@ class ImportServicesTest(TestCase):
         self.assertEqual(str(combine_date_time(date(2017, 3, 26), time(1, 10))), '2017-03-26 02:10:00+01:00')
         self.assertEqual(str(combine_date_time(date(2017, 3, 27), time(0, 10))), '2017-03-27 00:10:00+01:00')
 
+    def test_journey_writer(self):
+        stop_id = self.gb_m12.stops.first().pk
+        departure = generate_departures.combine_date_time(date(2017, 1, 5), time(23))
+        writer = generate_departures.JourneyWriter()
+        # the second StopUsageUsage is too far from the journey's day to go in the journey's partition
+        writer.add(self.gb_m12.pk, departure, stop_id, [
+            (stop_id, departure, 0), (stop_id, departure + timedelta(2), 1)
+        ])
+        writer.flush()
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')  # check the foreign keys now, not at the end of the test
+
+        journey = Journey.objects.get(service=self.gb_m12, datetime=departure)
+        self.assertEqual(2, journey.stopusageusage_set.count())
+
     @classmethod
     def tearDownClass(cls):
         super(ImportServicesTest, cls).tearDownClass()
@@ -499,3 +612,82 @@ class ImportServicesTest(TestCase):
         os.remove(os.path.join(FIXTURES_DIR, 'S.zip'))
         os.remove(os.path.join(FIXTURES_DIR, 'NCSD.zip'))
         os.remove(os.path.join(FIXTURES_DIR, 'NW.zip'))
+        shutil.rmtree(os.path.join(FIXTURES_DIR, 'timetables'))
+
+
+class ImportServicesWorkersTest(TransactionTestCase):
+    "Tests for importing services with worker processes, which can't share a TestCase's transaction"
+
+    def setUp(self):
+        self.tnds_dir = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.tnds_dir, 'NW.zip')
+        with zipfile.ZipFile(self.archive_path, 'w') as archive:
+            for filename in ('NW_04_GMN_2_1.xml', 'NW_04_GMN_2_2.xml', 'NW_04_GMS_237_1.xml', 'NW_04_GMS_237_2.xml'):
+                archive.write(os.path.join(FIXTURES_DIR, filename), filename)
+
+        Region.objects.create(pk='NW', name='North West')
+        for atco_code, lat, lng in (
+                ('639004572', -2.5042125060, 53.7423055225),
+                ('639004562', -2.5083672338, 53.7398252112),
+                ('639004554', -2.5108434749, 53.7389877672),
+                ('639004552', -2.4989239373, 53.7425523688),
+        ):
+            StopPoint.objects.create(atco_code=atco_code, locality_centre=False, active=True,
+                                     latlong=Point(lng, lat, srid=4326))
+
+    def tearDown(self):
+        shutil.rmtree(self.tnds_dir)
+
+    def get_imported(self):
+        return (
+            list(Service.objects.order_by('pk').values_list(
+                'pk', 'line_name', 'description', 'outbound_description', 'inbound_description', 'mode', 'date',
+                'current', 'show_timetable'
+            )),
+            list(StopUsage.objects.order_by('service', 'direction', 'order', 'stop').values_list(
+                'service', 'stop', 'direction', 'order', 'timing_status'
+            )),
+            list(Journey.objects.order_by('service', 'datetime', 'destination').values_list(
+                'service', 'datetime', 'destination'
+            )),
+            list(StopUsageUsage.objects.order_by('journey__service', 'journey__datetime', 'order').values_list(
+                'journey__service', 'journey__datetime', 'stop', 'datetime', 'order'
+            )),
+            list(StopPoint.objects.order_by('pk').values_list('pk', 'active'))
+        )
+
+    @freeze_time('2016-01-01')
+    def test_workers(self):
+        with self.settings(TNDS_DIR=self.tnds_dir), warnings.catch_warnings(record=True):
+            call_command(import_services.Command(), self.archive_path, full=True)
+            imported = self.get_imported()
+            self.assertTrue(imported[0])
+            self.assertTrue(imported[2])
+
+            generate_departures.delete_journeys(Journey.objects.all())
+            Service.objects.all().delete()
+            shutil.rmtree(os.path.join(self.tnds_dir, 'timetables'))
+
+            call_command(import_services.Command(), self.archive_path, workers=2, full=True)
+            self.assertEqual(imported, self.get_imported())
+
+    @freeze_time('2016-01-01')
+    def test_tiles(self):
+        # a stop in the region with no services, so it'll be made inactive
+        admin_area = AdminArea.objects.create(id=1, atco_code=639, name='Lancashire', region_id='NW')
+        StopPoint.objects.create(atco_code='639000000', locality_centre=False, active=True, admin_area=admin_area,
+                                 latlong=Point(0.5, 0.5, srid=4326))
+
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            content, etag = tiles.get_tile(14, 8214, 8169)
+            self.assertEqual(1, len(json.loads(content.decode())['features']))
+            tiles.update_clusters()
+            self.assertEqual(1, len(json.loads(tiles.get_tile(13, 4107, 4084)[0].decode())['features']))
+
+            with self.settings(TNDS_DIR=self.tnds_dir), warnings.catch_warnings(record=True):
+                call_command(import_services.Command(), self.archive_path)
+
+            content, new_etag = tiles.get_tile(14, 8214, 8169)
+            self.assertNotEqual(etag, new_etag)
+            self.assertEqual([], json.loads(content.decode())['features'])
+            self.assertEqual([], json.loads(tiles.get_tile(13, 4107, 4084)[0].decode())['features'])
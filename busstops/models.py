@@ -9,7 +9,7 @@ try:
     from urllib.parse import urlencode
 except ImportError:
     from urllib import urlencode
-from datetime import date
+from datetime import date, timedelta
 from autoslug import AutoSlugField
 from django.conf import settings
 from django.contrib.gis.db import models
@@ -18,7 +18,7 @@ from django.core.cache import cache
 from django.core.files.base import ContentFile
 from django.urls import reverse
 from django.utils.encoding import python_2_unicode_compatible
-from timetables import txc, northern_ireland, gtfs
+from timetables import txc, northern_ireland, gtfs, store, archives
 from .utils import sign_url
 
 
@@ -340,6 +340,20 @@ class StopPoint(models.Model):
         return reverse('stoppoint_detail', args=(self.atco_code,))
 
 
+class StopCluster(models.Model):
+    """A cell of a grid of active stops at a map zoom level, for showing on the map when zoomed out.
+    The cells are the 'slippy map' tiles at a few zoom levels more than the zoom level
+    """
+    zoom = models.PositiveSmallIntegerField()
+    x = models.PositiveIntegerField()
+    y = models.PositiveIntegerField()
+    count = models.PositiveIntegerField()
+    latlong = models.PointField()
+
+    class Meta():
+        index_together = ('zoom', 'x', 'y')
+
+
 @python_2_unicode_compatible
 class Operator(ValidateOnSaveMixin, models.Model):
     """An entity that operates public transport services"""
@@ -462,6 +476,8 @@ class Service(models.Model):
     current = models.BooleanField(default=True, db_index=True)
     show_timetable = models.BooleanField(default=False)
     geometry = models.MultiLineStringField(null=True, editable=False)
+    # geometry simplified at a few tolerances, as encoded polylines (see polylines.py)
+    simplified_geometry = JSONField(null=True, editable=False)
 
     wheelchair = models.NullBooleanField()
     low_floor = models.NullBooleanField()
@@ -633,26 +649,89 @@ class Service(models.Model):
             return [name for name in namelist if name.endswith('_%s_%s%s' % (parts[1], parts[0], suffix))]
         return [name for name in namelist if name.endswith('_%s%s' % (self.pk, suffix))]  # Wales
 
-    def get_files_from_zipfile(self):
-        """Given a Service,
-        return an iterable of open files from the relevant zipfile.
-        """
-        service_code = self.service_code
+    def get_archive_path(self):
         if self.region_id == 'GB':
             archive_name = 'NCSD'
-            parts = service_code.split('_')
-            service_code = '_%s_%s' % (parts[-1], parts[-2])
         else:
             archive_name = self.region_id
+        return os.path.join(settings.TNDS_DIR, archive_name + '.zip')
+
+    def get_zipinfos(self, archive):
+        """Given the open zipfile that the service's files are in,
+        return a list of ZipInfos for those files, from the index made at import time if it's up to date.
+        """
+        index = archives.get_index(archives.get_index_path(settings.TNDS_DIR, self.region_id), archive.filename)
+        if index is not None:
+            return index.get(self.service_code, [])
+        return [archive.getinfo(filename) for filename in self.get_filenames(archive)]
 
-        archive_path = os.path.join(settings.TNDS_DIR, archive_name + '.zip')
+    def get_files_from_zipfile(self):
+        """Given a Service,
+        return an iterable of open files from the relevant zipfile.
+        """
+        try:
+            archive = archives.get_archive(self.get_archive_path())
+            return [archive.open(zipinfo) for zipinfo in self.get_zipinfos(archive)]
+        except (zipfile.BadZipfile, IOError, KeyError):
+            return []
 
+    def get_timetables_from_zipfile(self, day):
+        """Given a Service and a date,
+        return a list of Timetables, from the stored versions if they're up to date,
+        otherwise by parsing the XML files in the relevant zipfile.
+        """
+        timetables = []
         try:
-            with zipfile.ZipFile(archive_path) as archive:
-                filenames = self.get_filenames(archive)
-                return [archive.open(filename) for filename in filenames]
+            archive = archives.get_archive(self.get_archive_path())
+            for zipinfo in self.get_zipinfos(archive):
+                path = store.get_path(settings.TNDS_DIR, self.region_id, zipinfo.filename)
+                timetable = store.read(path, zipinfo.CRC)
+                if timetable is None:
+                    with archive.open(zipinfo) as xml_file:
+                        timetable = store.strip(txc.Timetable(xml_file, day, self.description))
+                elif not timetable.description:
+                    timetable.set_description(self.description)
+                timetables.append(timetable)
         except (zipfile.BadZipfile, IOError, KeyError):
             return []
+        return timetables
+
+    def is_gtfs(self):
+        return self.region_id in {'UL', 'LE', 'MU', 'CO', 'FR'} or self.service_code.startswith('citymapper')
+
+    def get_cached_timetables(self, day):
+        cache_key = '{}:{}'.format(self.service_code, self.date)
+        timetables = cache.get(cache_key)
+
+        if timetables is None:
+            timetables = self.get_timetables_from_zipfile(day)
+            cache.set(cache_key, timetables)
+
+        return timetables
+
+    def get_running_dates(self, start, days):
+        """Given a start date and a number of days,
+        return a list of the dates in that period on which the service has any journeys
+        (or None if it doesn't have TransXChange timetables).
+
+        Like get_timetables, stops showing the timetable if it would have more than 100 columns
+        on any of the first 7 of those dates (the ones generate_service_dates looks at)
+        """
+        if self.region_id == 'NI' or self.is_gtfs():
+            return
+
+        calendar = txc.Calendar(start, start + timedelta(days=days - 1))
+        timetables = self.get_cached_timetables(start)
+        bits = 0
+        for timetable in timetables:
+            bits |= timetable.get_bits(calendar)
+        dates = list(calendar.get_dates(bits))
+        if self.show_timetable and any(
+            timetable.get_most_journeys(calendar, dates[:7]) > 100 for timetable in timetables
+        ):
+            self.show_timetable = False
+            self.save()
+        return dates
 
     def get_timetables(self, day=None):
         """Given a Service, return a list of Timetables."""
@@ -665,23 +744,10 @@ class Service(models.Model):
                 return northern_ireland.get_timetable(path, day)
             return []
 
-        if self.region_id in {'UL', 'LE', 'MU', 'CO', 'FR'} or self.service_code.startswith('citymapper'):
+        if self.is_gtfs():
             return gtfs.get_timetables(self.service_code, day)
 
-        cache_key = '{}:{}'.format(self.service_code, self.date)
-        timetables = cache.get(cache_key)
-
-        if timetables is None:
-            timetables = []
-            for xml_file in self.get_files_from_zipfile():
-                with xml_file:
-                    timetable = (txc.Timetable(xml_file, day, self.description))
-                del timetable.journeypatterns
-                del timetable.stops
-                del timetable.operators
-                del timetable.element
-                timetables.append(timetable)
-            cache.set(cache_key, timetables)
+        timetables = self.get_cached_timetables(day)
 
         timetables = [timetable for timetable in timetables if timetable.operating_period.contains(day)]
         for timetable in timetables:
@@ -0,0 +1,57 @@
+"""Services' route geometries simplified at a few tolerances, as encoded polylines
+(https://developers.google.com/maps/documentation/utilities/polylinealgorithm),
+so that maps can load a small version suitable for the zoom level
+"""
+
+
+# In degrees -- roughly 1 km, 100 m, 10 m, and not simplified at all
+TOLERANCES = (0.01, 0.001, 0.0001, 0)
+
+
+def encode_number(number):
+    number = ~(number << 1) if number < 0 else number << 1
+    chunks = []
+    while number >= 0x20:
+        chunks.append(chr((0x20 | (number & 0x1f)) + 63))
+        number >>= 5
+    chunks.append(chr(number + 63))
+    return ''.join(chunks)
+
+
+def encode(coords):
+    """Given a sequence of (longitude, latitude) tuples, return an encoded polyline string"""
+    parts = []
+    previous_latitude = previous_longitude = 0
+    for longitude, latitude in coords:
+        latitude = int(round(latitude * 1e5))
+        longitude = int(round(longitude * 1e5))
+        parts.append(encode_number(latitude - previous_latitude))
+        parts.append(encode_number(longitude - previous_longitude))
+        previous_latitude = latitude
+        previous_longitude = longitude
+    return ''.join(parts)
+
+
+def get_line_strings(geometry):
+    if geometry.geom_type == 'LineString':
+        return (geometry,)
+    return geometry
+
+
+def simplify(multi_line_string):
+    """Given a MultiLineString, return a dict of tolerances (as strings) to lists of encoded polylines"""
+    merged = multi_line_string.merged
+    simplified = {}
+    for tolerance in TOLERANCES:
+        geometry = merged.simplify(tolerance) if tolerance else merged
+        simplified[str(tolerance)] = [encode(line_string.coords) for line_string in get_line_strings(geometry)
+                                      if not line_string.empty]
+    return simplified
+
+
+def get_tolerance(zoom):
+    """Given a map zoom level, return the greatest tolerance less than the size of a pixel at that zoom level"""
+    pixel = 360 / 256 / 2 ** zoom
+    for tolerance in TOLERANCES:
+        if tolerance < pixel:
+            return tolerance
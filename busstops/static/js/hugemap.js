@@ -26,7 +26,11 @@
             disableClusteringAtZoom: 15,
             maxClusterRadius: 50
         }),
-        lastReq,
+        clusters = L.layerGroup(),
+        tiles = {}, // 'z/x/y' strings to arrays of GeoJSON features
+        stopsZoom = 14, // zoomed out further than this, show clusters of stops instead of stops
+        clustersZoom = 6, // zoomed out further than this, show nothing (there are no tiles)
+        loads = 0,
         movedByAccident;
 
     L.tileLayer(tileURL, {
@@ -48,6 +52,7 @@
     });
 
     map.addLayer(markers);
+    map.addLayer(clusters);
 
     function processStopsData(data) {
         var sidebar = document.getElementById('sidebar');
@@ -85,21 +90,109 @@
         });
         sidebar.appendChild(ul);
         markers.clearLayers();
+        clusters.clearLayers();
         layer.addTo(markers);
         statusBar.getContainer().innerHTML = '';
     }
 
-    function loadStops(map, statusBar) {
-        var bounds = map.getBounds();
+    function showClusters(data) {
+        markers.clearLayers();
+        clusters.clearLayers();
+        L.geoJson(data, {
+            pointToLayer: function (data, latlng) {
+                var count = data.properties.count,
+                    size = count < 10 ? 30 : (count < 100 ? 35 : 40);
+                return L.marker(latlng, {
+                    icon: L.divIcon({
+                        html: '<div><span>' + count + '</span></div>',
+                        className: 'marker-cluster',
+                        iconSize: [size, size]
+                    })
+                }).on('click', function () {
+                    map.setView(latlng, map.getZoom() + 2);
+                });
+            }
+        }).addTo(clusters);
+        statusBar.getContainer().innerHTML = 'Please zoom in to see stops';
+    }
+
+    function getTileX(lng, zoom) {
+        return Math.floor((lng + 180) / 360 * Math.pow(2, zoom));
+    }
+
+    function getTileY(lat, zoom) {
+        var radians = lat * Math.PI / 180;
+        return Math.floor((1 - Math.log(Math.tan(radians) + 1 / Math.cos(radians)) / Math.PI) / 2 * Math.pow(2, zoom));
+    }
+
+    function getTileKeys(bounds, zoom) {
+        var keys = [],
+            x,
+            y;
+        for (x = getTileX(bounds.getWest(), zoom); x <= getTileX(bounds.getEast(), zoom); x += 1) {
+            for (y = getTileY(bounds.getNorth(), zoom); y <= getTileY(bounds.getSouth(), zoom); y += 1) {
+                keys.push(zoom + '/' + x + '/' + y);
+            }
+        }
+        return keys;
+    }
+
+    function getFeatures(map, keys) {
+        var centre = map.getCenter(),
+            urls = {},
+            features = [];
+        keys.forEach(function (key) {
+            (tiles[key] || []).forEach(function (feature) {
+                // a stop on the edge of a tile is in both tiles
+                if (!feature.properties.url || !urls[feature.properties.url]) {
+                    urls[feature.properties.url] = true;
+                    feature.distance = centre.distanceTo(L.latLng(feature.geometry.coordinates[1], feature.geometry.coordinates[0]));
+                    features.push(feature);
+                }
+            });
+        });
+        features.sort(function (a, b) {
+            return a.distance - b.distance;
+        });
+        return {
+            type: 'FeatureCollection',
+            features: features
+        };
+    }
+
+    function loadTiles(map, zoom, show) {
+        var keys = getTileKeys(map.getBounds(), zoom),
+            load,
+            pending = 0;
+
+        loads += 1;
+        load = loads;
+
+        function loaded() {
+            pending -= 1;
+            if (!pending && load === loads) {
+                show(getFeatures(map, keys));
+            }
+        }
+
         statusBar.getContainer().innerHTML = 'Loading\u2026';
-        if (lastReq) {
-            lastReq.abort();
+        keys.forEach(function (key) {
+            if (!tiles[key]) {
+                pending += 1;
+                reqwest({
+                    url: '/stops/' + key + '.json',
+                    success: function (data) {
+                        tiles[key] = data.features;
+                        loaded();
+                    },
+                    error: loaded
+                });
+            }
+        });
+        if (!pending) {
+            show(getFeatures(map, keys));
         }
-        lastReq = reqwest(
-            '/stops.json?ymax=' + bounds.getNorth() + '&xmax=' + bounds.getEast() + '&ymin=' + bounds.getSouth() + '&xmin=' + bounds.getWest(),
-            processStopsData
-        );
-        map.highWater = bounds;
+        map.highWater = map.getBounds();
     }
 
     function rememberLocation(latLngString) {
@@ -120,14 +213,20 @@
         }
 
         var latLng = event.target.getCenter(),
-            latLngString = Math.round(latLng.lat * 10000) / 10000 + ',' + Math.round(latLng.lng * 10000) / 10000;
+            latLngString = Math.round(latLng.lat * 10000) / 10000 + ',' + Math.round(latLng.lng * 10000) / 10000,
+            zoom = Math.round(event.target.getZoom());
 
         rememberLocation(latLngString);
 
-        if (event.target.getZoom() > 13) {
-            loadStops(this, statusBar);
+        if (event.target.getZoom() >= stopsZoom) {
+            loadTiles(this, stopsZoom, processStopsData);
+        } else if (zoom >= clustersZoom) {
+            loadTiles(this, zoom, showClusters);
         } else {
-            statusBar.getContainer().innerHTML = 'Please zoom in to see stops';
+            loads += 1; // so that any tiles still loading aren't shown
+            markers.clearLayers();
+            clusters.clearLayers();
+            statusBar.getContainer().innerHTML = '';
         }
     }
 
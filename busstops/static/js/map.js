@@ -14,6 +14,65 @@
         return;
     }
 
+    var geometry, // the route's polylines
+        geometryZoom; // the zoom level they were loaded for
+
+    // decode an encoded polyline (https://developers.google.com/maps/documentation/utilities/polylinealgorithm)
+    function decodePolyline(string) {
+        var latLngs = [],
+            index = 0,
+            lat = 0,
+            lng = 0,
+            coordinate = [],
+            result,
+            shift,
+            byte;
+        while (index < string.length) {
+            result = 0;
+            shift = 0;
+            do {
+                byte = string.charCodeAt(index) - 63;
+                index += 1;
+                result |= (byte & 0x1f) << shift;
+                shift += 5;
+            } while (byte >= 0x20);
+            coordinate.push(result & 1 ? ~(result >> 1) : result >> 1);
+            if (coordinate.length === 2) {
+                lat += coordinate[0];
+                lng += coordinate[1];
+                latLngs.push([lat / 1e5, lng / 1e5]);
+                coordinate = [];
+            }
+        }
+        return latLngs;
+    }
+
+    // load the route, simplified to suit the zoom level, unless a more detailed version has already been loaded
+    function loadGeometry() {
+        var zoom = map.getZoom(),
+            request;
+        if (geometryZoom >= zoom) {
+            return;
+        }
+        geometryZoom = zoom;
+        request = new XMLHttpRequest();
+        request.open('GET', window.geometryURL + '?zoom=' + zoom);
+        request.onload = function () {
+            if (request.status === 200) {
+                var polylines = JSON.parse(request.responseText).polylines;
+                if (polylines.length) {
+                    if (geometry) {
+                        map.removeLayer(geometry);
+                    }
+                    geometry = L.polyline(polylines.map(decodePolyline), {
+                        weight: 2
+                    }).addTo(map);
+                }
+            }
+        };
+        request.send();
+    }
+
     function setUpMap() {
         var h1 = document.getElementsByTagName('h1')[0],
             items = document.getElementsByTagName('li'),
@@ -86,18 +145,13 @@
                 L.marker(mainLocations[i], {icon: pin}).addTo(map);
                 map.setView(mainLocations[i], 17);
             } else {
-                var polyline;
-                if (window.geometry) {
-                    polyline = L.geoJson(window.geometry, {
-                        style: {
-                            weight: 2
-                        }
-                    });
-                    polyline.addTo(map);
-                }
-                map.fitBounds((polyline || L.polyline(mainLocations)).getBounds(), {
+                map.fitBounds(L.polyline(mainLocations).getBounds(), {
                     padding: [10, 20]
                 });
+                if (window.geometryURL) {
+                    loadGeometry();
+                    map.on('zoomend', loadGeometry);
+                }
             }
 
             for (i = labels.length - 1; i >= 0; i -= 1) {
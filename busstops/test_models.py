@@ -1,3 +1,4 @@
+from datetime import date, timedelta
 from django.test import TestCase, override_settings
 from django.contrib.gis.geos import Point
 from .models import (
@@ -72,6 +73,18 @@ class OperatorTests(TestCase):
         self.assertEqual(str(self.chariots), 'Ainsley\'s Chariots')
 
 
+class BusyTimetable(object):
+    """A timetable that runs every day, with more than 100 journeys a day after its first week"""
+    def __init__(self, start):
+        self.busy_from = start + timedelta(days=7)
+
+    def get_bits(self, calendar):
+        return calendar.all
+
+    def get_most_journeys(self, calendar, dates):
+        return 101 if any(day >= self.busy_from for day in dates) else 100
+
+
 class ServiceTests(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -87,6 +100,21 @@ class ServiceTests(TestCase):
         self.london_service.line_name = ''
         self.assertEqual(str(self.london_service), 'tfl_8-N41-_-y05')
 
+    def test_get_running_dates(self):
+        start = date(2017, 1, 1)
+        self.london_service.show_timetable = True
+        self.london_service.get_cached_timetables = lambda day: [BusyTimetable(start)]
+
+        # only busy after the first week, so still shown
+        running_dates = self.london_service.get_running_dates(start, 100)
+        self.assertEqual(len(running_dates), 100)
+        self.assertTrue(self.london_service.show_timetable)
+
+        # busy in the first week
+        self.london_service.get_cached_timetables = lambda day: [BusyTimetable(start - timedelta(days=1))]
+        self.london_service.get_running_dates(start, 100)
+        self.assertFalse(Service.objects.get(pk=self.london_service.pk).show_timetable)
+
     def test_get_a_mode(self):
         self.assertEqual(self.london_service.get_a_mode(), 'A ')
 
@@ -1,11 +1,15 @@
 # coding=utf-8
 import os
 import json
+import time
 import vcr
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.core import mail
 from django.contrib.gis.geos import Point
 from django.shortcuts import render
+from django.core.cache import cache
+from departures import caching
+from . import conditional, tiles
 from .models import Region, AdminArea, District, Locality, StopPoint, StopUsage, Operator, Service, Note
 
 
@@ -234,6 +238,29 @@ class ViewsTests(TestCase):
         self.assertEqual('FeatureCollection', response.json()['type'])
         self.assertIn('features', response.json())
 
+    def test_stops_tile(self):
+        self.assertEqual(self.client.get('/stops/5/20/15.json').status_code, 404)
+        self.assertEqual(self.client.get('/stops/19/339104/260613.json').status_code, 404)
+        self.assertEqual(self.client.get('/stops/14/16384/8144.json').status_code, 404)
+
+        response = self.client.get('/stops/14/10597/8144.json')
+        self.assertEqual(response.json()['features'][0]['properties']['url'], '/stops/2900M114')
+        self.assertEqual(response['Cache-Control'], 'max-age=3600')
+
+        response = self.client.get('/stops/14/10597/8144.json', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Cache-Control'], 'max-age=3600')
+        response = self.client.get('/stops/14/10597/8144.json', HTTP_IF_NONE_MATCH=response['ETag'][:-3] + '"')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.client.get('/stops/14/10597/8143.json').json()['features'], [])
+
+        # zoomed out, so clusters
+        tiles.update_clusters()
+        features = self.client.get('/stops/13/5298/4072.json').json()['features']
+        self.assertEqual(features[0]['properties'], {'count': 1})
+        self.assertAlmostEqual(features[0]['geometry']['coordinates'][0], 52.8566019427)
+
     def test_stop(self):
         with vcr.use_cassette(os.path.join(DIR, '..', 'data', 'vcr', '2900M114.yaml')):
             response = self.client.get('/stops/2900M114')
@@ -289,6 +316,41 @@ class ViewsTests(TestCase):
         self.assertContains(response, 'Mind your head')  # Note
         self.assertEqual(self.note.get_absolute_url(), '/operators/ainsleys-chariots')
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_conditional(self):
+        cache.set(conditional.VERSION_KEY, 946684800, None)  # 1 January 2000
+        for url in ('/operators/AINS', self.melton_constable.get_absolute_url(), '/sitemap.xml'):
+            response = self.client.get(url)
+            self.assertEqual(response['Last-Modified'], 'Sat, 01 Jan 2000 00:00:00 GMT')
+            self.assertEqual(response['Cache-Control'], 'no-cache')
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, 304)
+
+        # Service pages change at midnight
+        response = self.client.get(self.service.get_absolute_url())
+        self.assertNotEqual(response['Last-Modified'], 'Sat, 01 Jan 2000 00:00:00 GMT')
+        response = self.client.get(self.service.get_absolute_url(), HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        # After importing data
+        cache.set(conditional.VERSION_KEY, 978307200, None)  # 1 January 2001
+        response = self.client.get('/operators/AINS', HTTP_IF_MODIFIED_SINCE='Sat, 01 Jan 2000 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+
+        # Stop pages change when their departures do
+        cache.set(caching.get_key('2900M114'), ({'departures': []}, time.time() + 60))
+        response = self.client.get('/stops/2900M114')
+        self.assertEqual(self.client.get('/stops/2900m114', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        cache.set(caching.get_key('2900M114'), ({'departures': []}, time.time() + 120))
+        self.assertEqual(self.client.get('/stops/2900M114', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_service_geometry(self):
+        url = '/services/{}/geometry.json'.format(self.service.pk)
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {'zoom': 12}).json(), {'tolerance': 0.0001, 'polylines': []})
+        # simplified in memory, not saved by a GET request
+        self.assertIsNone(Service.objects.get(pk=self.service.pk).simplified_geometry)
+
     def test_service_flixbus(self):
         self.service.operator.set([self.flixbus])
         self.service.line_name = 'FlixBus'
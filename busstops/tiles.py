@@ -0,0 +1,131 @@
+"""Stops for the map, as GeoJSON, in fixed 'slippy map' tiles (so they can be cached and shared between users),
+kept in the cache until stops are next imported.
+
+When the map is zoomed out, tiles contain clusters of stops (with counts) instead of individual stops
+"""
+import json
+import math
+import hashlib
+from django.core.cache import cache
+from django.contrib.gis.geos import Polygon
+from django.db import connection, transaction
+from . import versions
+from .models import StopPoint, StopCluster
+
+
+# Changed (by invalidate) after importing stops
+VERSION_KEY = 'stop-tiles-version'
+TIMEOUT = 86400 * 7
+
+# The map only shows stops when zoomed in this far
+MIN_ZOOM = 14
+# and can't be zoomed in further than this
+MAX_ZOOM = 18
+# When zoomed out less far than that (but this far), it shows clusters of stops
+MIN_CLUSTER_ZOOM = 6
+# A tile is divided into a grid of 2 ** CLUSTER_DETAIL by 2 ** CLUSTER_DETAIL cells
+CLUSTER_DETAIL = 3
+
+
+def get_bounds(zoom, x, y):
+    """Given a tile's zoom level and x and y numbers,
+    return a (xmin, ymin, xmax, ymax) tuple of longitudes and latitudes
+    """
+    tiles = 2 ** zoom
+
+    def get_longitude(x):
+        return x / tiles * 360 - 180
+
+    def get_latitude(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / tiles))))
+
+    return (get_longitude(x), get_latitude(y + 1), get_longitude(x + 1), get_latitude(y))
+
+
+def render_tile(zoom, x, y):
+    """Return a GeoJSON FeatureCollection of the active stops in a tile, as bytes"""
+    stops = StopPoint.objects.filter(
+        latlong__intersects=Polygon.from_bbox(get_bounds(zoom, x, y)), active=True
+    ).select_related('locality').defer('osm', 'locality__latlong').order_by('atco_code')
+    return json.dumps({
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'geometry': {
+                'type': 'Point',
+                'coordinates': tuple(stop.latlong)
+            },
+            'properties': {
+                'name': stop.get_qualified_name(),
+                'url': stop.get_absolute_url(),
+            }
+        } for stop in stops]
+    }, separators=(',', ':')).encode()
+
+
+def render_clusters_tile(zoom, x, y):
+    """Return a GeoJSON FeatureCollection of the clusters of stops in a tile, as bytes"""
+    cells = 2 ** CLUSTER_DETAIL
+    clusters = StopCluster.objects.filter(
+        zoom=zoom, x__gte=x * cells, x__lt=(x + 1) * cells, y__gte=y * cells, y__lt=(y + 1) * cells
+    ).order_by('x', 'y')
+    return json.dumps({
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'geometry': {
+                'type': 'Point',
+                'coordinates': tuple(cluster.latlong)
+            },
+            'properties': {
+                'count': cluster.count
+            }
+        } for cluster in clusters]
+    }, separators=(',', ':')).encode()
+
+
+@transaction.atomic
+def update_clusters():
+    """Replace the clusters of stops at every zoom level with ones made from the active stops"""
+    StopCluster.objects.all().delete()
+    with connection.cursor() as cursor:
+        for zoom in range(MIN_CLUSTER_ZOOM, MIN_ZOOM):
+            cells = 2 ** (zoom + CLUSTER_DETAIL)
+            cursor.execute("""
+                INSERT INTO busstops_stopcluster (zoom, x, y, count, latlong)
+                SELECT %s, x, y, COUNT(*), ST_Centroid(ST_Collect(latlong)) FROM (
+                    SELECT latlong,
+                        FLOOR((ST_X(latlong) + 180) / 360 * %s) AS x,
+                        FLOOR((1 - LN(TAN(RADIANS(ST_Y(latlong))) + 1 / COS(RADIANS(ST_Y(latlong)))) / PI()) / 2 * %s)
+                        AS y
+                    FROM busstops_stoppoint
+                    WHERE active AND ST_Y(latlong) BETWEEN -85 AND 85
+                ) AS cells
+                GROUP BY x, y
+            """, (zoom, cells, cells))
+
+
+def get_key(zoom, x, y):
+    return 'stop-tile:{}/{}/{}'.format(zoom, x, y)
+
+
+def get_tile(zoom, x, y):
+    """Return a tuple containing a tile's content (bytes) and ETag, from the cache if possible"""
+    version = versions.get_version(VERSION_KEY)
+    if version is not None:
+        tile = cache.get(get_key(zoom, x, y), version=version)
+        if tile is not None:
+            return tile
+    if zoom < MIN_ZOOM:
+        content = render_clusters_tile(zoom, x, y)
+    else:
+        content = render_tile(zoom, x, y)
+    tile = (content, '"{}"'.format(hashlib.md5(content).hexdigest()))
+    if version is not None:
+        cache.set(get_key(zoom, x, y), tile, TIMEOUT, version=version)
+    return tile
+
+
+def invalidate():
+    """Make every tile be rendered again next time it's requested"""
+    versions.invalidate(VERSION_KEY)
@@ -4,7 +4,7 @@ from django.contrib import staticfiles
 from django.contrib.sitemaps.views import sitemap
 from haystack.views import SearchView
 from .forms import CustomSearchForm
-from . import views
+from . import conditional, views
 
 urlpatterns = [
     url(r'^$', views.index),
@@ -14,20 +14,23 @@ urlpatterns = [
     url(r'^cookies', views.cookies),
     url(r'^data', views.data),
     url(r'^map', views.hugemap),
+    url(r'^status', views.status),
     url(r'^stops\.json', views.stops),
     url(r'^regions/(?P<pk>\w+)', views.RegionDetailView.as_view(), name='region_detail'),
     url(r'^(admin-)?areas/(?P<pk>\d+)', views.AdminAreaDetailView.as_view(), name='adminarea_detail'),
     url(r'^districts/(?P<pk>\d+)', views.DistrictDetailView.as_view(), name='district_detail'),
     url(r'^localities/(?P<pk>[A-Z0-9]+)', views.LocalityDetailView.as_view()),
     url(r'^localities/(?P<slug>[\w-]+)', views.LocalityDetailView.as_view(), name='locality_detail'),
+    url(r'^stops/(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+)\.json$', views.stops_tile),
     url(r'^stops/(?P<pk>\w+)\.json', views.stop_json),
     url(r'^stops/(?P<pk>[\w-]+)', views.StopPointDetailView.as_view(), name='stoppoint_detail'),
     url(r'^operators/(?P<pk>[A-Z]+)$', views.OperatorDetailView.as_view()),
     url(r'^operators/(?P<slug>[\w-]+)', views.OperatorDetailView.as_view(), name='operator_detail'),
     url(r'^services/(?P<pk>[^/]+)\.xml', views.service_xml),
+    url(r'^services/(?P<pk>[^/]+)/geometry\.json$', views.service_geometry, name='service_geometry'),
     url(r'^services/(?P<slug>[\w-]+)', views.ServiceDetailView.as_view(), name='service_detail'),
     url(r'^images/(?P<id>\d+)', views.image),
-    url(r'^sitemap\.xml$', sitemap, {
+    url(r'^sitemap\.xml$', conditional.condition(last_modified_func=conditional.get_last_modified)(sitemap), {
         'sitemaps': {
              'services': views.ServiceSitemap
         }
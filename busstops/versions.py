@@ -0,0 +1,23 @@
+"""Versions of things kept in the cache (or in processes' memory), shared between processes.
+
+A version is a timestamp in the cache, changed (by invalidate) whenever the things it's the version of change,
+so that everything kept under an older version is ignored
+"""
+import time
+from django.core.cache import cache
+
+
+def get_version(key):
+    """Given the cache key of a version, return the version, or None if it can't be known
+    (if there's no cache, for example, in which case nothing should be kept)
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time(), None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate(key):
+    """Given the cache key of a version, change the version"""
+    cache.set(key, time.time(), None)
@@ -3,21 +3,27 @@
 import os
 import json
 import PIL
-from datetime import datetime
+from datetime import datetime, timedelta
 from django.shortcuts import render, get_object_or_404, redirect
+from django.core.cache import cache
+from django.template.loader import render_to_string
 from django.db.models import Q
 from django.http import (HttpResponse, JsonResponse, Http404,
                          HttpResponseBadRequest)
 from django.utils import timezone
+from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.contrib.admin.views.decorators import staff_member_required
 from django.views.generic.detail import DetailView
 from django.conf import settings
 from django.contrib.gis.geos import Polygon
 from django.contrib.gis.db.models.functions import Distance
 from django.contrib.sitemaps import Sitemap
-from django.core.cache import cache
 from django.core.mail import EmailMessage
-from departures import live
+from departures import breakers, caching, metrics
+from . import conditional, polylines, tiles
 from .utils import format_gbp, viglink
 from .models import (Region, StopPoint, AdminArea, Locality, District,
                      Operator, Service, Note, Image)
@@ -64,7 +70,9 @@ def not_found(request, exception):
     if (request.resolver_match
             and request.resolver_match.url_name == 'service_detail'):
         slug = request.resolver_match.kwargs.get('slug')
-        service = Service.objects.filter(Q(service_code=slug) | Q(slug=slug)).defer('geometry').first()
+        service = Service.objects.filter(Q(service_code=slug) | Q(slug=slug)).defer(
+            'geometry', 'simplified_geometry'
+        ).first()
         localities = Locality.objects.filter(stoppoint__service=service).defer('latlong').distinct()
         context = {
             'service': service,
@@ -144,6 +152,18 @@ def hugemap(request):
     return render(request, 'map.html')
 
 
+@staff_member_required
+def status(request):
+    """The health of the live departures sources"""
+    metrics.flush()
+    return render(request, 'status.html', {
+        'breakers': breakers.get_states(),
+        'reset_timeout': breakers.RESET_TIMEOUT,
+        'window': breakers.WINDOW,
+        'metrics': metrics.get_summary(),
+    })
+
+
 def stops(request):
     """JSON endpoint accessed by the JavaScript map,
     listing the active StopPoints within a rectangle,
@@ -178,6 +198,28 @@ def stops(request):
     })
 
 
+def get_stops_tile(request, zoom, x, y):
+    """Return a (content, ETag) tuple for a tile of stops, getting it only once per request,
+    or raise Http404 if the tile is outside the map's zoom levels or the world
+    """
+    if not hasattr(request, 'stops_tile'):
+        zoom, x, y = int(zoom), int(x), int(y)
+        if not tiles.MIN_CLUSTER_ZOOM <= zoom <= tiles.MAX_ZOOM or x >= 2 ** zoom or y >= 2 ** zoom:
+            raise Http404()
+        request.stops_tile = tiles.get_tile(zoom, x, y)
+    return request.stops_tile
+
+
+@cache_control(max_age=3600)
+@condition(etag_func=lambda request, **kwargs: get_stops_tile(request, **kwargs)[1])
+def stops_tile(request, zoom, x, y):
+    """JSON endpoint accessed by the JavaScript map,
+    listing the active StopPoints (or, at low zoom levels, clusters of them) within a map tile,
+    in standard GeoJSON format
+    """
+    return HttpResponse(get_stops_tile(request, zoom, x, y)[0], content_type='application/json')
+
+
 class UppercasePrimaryKeyMixin(object):
     """Normalises the primary key argument to uppercase"""
     def get_object(self, queryset=None):
@@ -208,6 +250,7 @@ class RegionDetailView(UppercasePrimaryKeyMixin, DetailView):
         return context
 
 
+@method_decorator(conditional.condition(last_modified_func=conditional.get_last_modified), name='get')
 class AdminAreaDetailView(DetailView):
     """A single administrative area,
     and the districts, localities (or stops) in it
@@ -230,9 +273,9 @@ class AdminAreaDetailView(DetailView):
         ).defer('latlong').distinct()
 
         if not (context['localities'] or context['districts']):
-            context['services'] = sorted(Service.objects.filter(stops__admin_area=self.object,
-                                                                current=True).distinct().defer('geometry'),
-                                         key=Service.get_order)
+            context['services'] = sorted(Service.objects.filter(
+                stops__admin_area=self.object, current=True
+            ).distinct().defer('geometry', 'simplified_geometry'), key=Service.get_order)
             context['modes'] = {service.mode for service in context['services'] if service.mode}
         context['breadcrumb'] = [self.object.region]
         return context
@@ -245,6 +288,7 @@ class AdminAreaDetailView(DetailView):
         return super(AdminAreaDetailView, self).render_to_response(context)
 
 
+@method_decorator(conditional.condition(last_modified_func=conditional.get_last_modified), name='get')
 class DistrictDetailView(DetailView):
     """A single district, and the localities in it"""
 
@@ -265,6 +309,7 @@ class DistrictDetailView(DetailView):
         return super(DistrictDetailView, self).render_to_response(context)
 
 
+@method_decorator(conditional.condition(last_modified_func=conditional.get_last_modified), name='get')
 class LocalityDetailView(UppercasePrimaryKeyMixin, DetailView):
     """A single locality, its children (if any), and the stops in it"""
 
@@ -289,7 +334,7 @@ class LocalityDetailView(UppercasePrimaryKeyMixin, DetailView):
             context['services'] = sorted(Service.objects.filter(
                 stops__locality=self.object,
                 current=True
-            ).defer('geometry').distinct(), key=Service.get_order)
+            ).defer('geometry', 'simplified_geometry').distinct(), key=Service.get_order)
             context['modes'] = {service.mode for service in context['services'] if service.mode}
 
         context['breadcrumb'] = (crumb for crumb in [
@@ -302,6 +347,7 @@ class LocalityDetailView(UppercasePrimaryKeyMixin, DetailView):
         return context
 
 
+@method_decorator(conditional.condition(etag_func=conditional.get_stop_etag), name='get')
 class StopPointDetailView(UppercasePrimaryKeyMixin, DetailView):
     """A stop, other stops in the same area, and the services servicing it"""
 
@@ -314,25 +360,12 @@ class StopPointDetailView(UppercasePrimaryKeyMixin, DetailView):
     def get_context_data(self, **kwargs):
         context = super(StopPointDetailView, self).get_context_data(**kwargs)
 
-        context['services'] = sorted(
-            self.object.service_set.filter(current=True).defer('geometry').distinct(),
-            key=Service.get_order
-        )
+        context['services'] = caching.get_services(self.object)
 
         if not (self.object.active or context['services']):
             raise Http404()
 
-        departures = cache.get(self.object.atco_code)
-        if not departures:
-            bot = self.request.META.get('HTTP_X_BOT')
-            departures, max_age = live.get_departures(
-                self.object, context['services'], bot
-            )
-            if hasattr(departures['departures'], 'get_departures'):
-                departures['departures'] = departures['departures'].get_departures()
-            if not bot:
-                cache.set(self.object.atco_code, departures, max_age)
-
+        departures = caching.get_departures(self.object, context['services'], self.request.META.get('HTTP_X_BOT'))
         context.update(departures)
         if context['departures']:
             context['live'] = any(item.get('live') for item in context['departures'])
@@ -398,6 +431,7 @@ def stop_json(_, pk):
     }, safe=False)
 
 
+@method_decorator(conditional.condition(last_modified_func=conditional.get_last_modified), name='get')
 class OperatorDetailView(UppercasePrimaryKeyMixin, DetailView):
     "An operator and the services it operates"
 
@@ -407,8 +441,9 @@ class OperatorDetailView(UppercasePrimaryKeyMixin, DetailView):
     def get_context_data(self, **kwargs):
         context = super(OperatorDetailView, self).get_context_data(**kwargs)
         context['notes'] = self.object.note_set.all()
-        context['services'] = sorted(self.object.service_set.filter(current=True).defer('geometry'),
-                                     key=Service.get_order)
+        context['services'] = sorted(self.object.service_set.filter(current=True).defer(
+            'geometry', 'simplified_geometry'
+        ), key=Service.get_order)
         if not context['services']:
             raise Http404()
         context['modes'] = {service.mode for service in context['services'] if service.mode}
@@ -416,11 +451,15 @@ class OperatorDetailView(UppercasePrimaryKeyMixin, DetailView):
         return context
 
 
+@method_decorator(conditional.condition(last_modified_func=conditional.get_service_last_modified),
+                  name='get')
 class ServiceDetailView(DetailView):
     "A service and the stops it stops at"
 
     model = Service
-    queryset = model.objects.select_related('region').prefetch_related('operator')
+    queryset = model.objects.select_related('region').prefetch_related('operator').defer(
+        'geometry', 'simplified_geometry'
+    )
 
     def get_object(self, **kwargs):
         try:
@@ -450,6 +489,7 @@ class ServiceDetailView(DetailView):
 
         context['form'] = ImageForm()
 
+        timetables_key = None
         if self.object.show_timetable:
             date = self.request.GET.get('date')
             today = timezone.now().date()
@@ -468,9 +508,16 @@ class ServiceDetailView(DetailView):
                 next_usage = self.object.journey_set.filter(datetime__date__gte=today).first()
                 if next_usage:
                     date = next_usage.datetime.date()
-            context['timetables'] = self.object.get_timetables(date)
-
-        if not context.get('timetables') or not context['timetables'][0].groupings:
+            if self.object.region_id != 'NI' and not self.object.is_gtfs():
+                # the rendered timetables, until the service is next imported (or until tomorrow)
+                timetables_key = 'timetables-html:{}:{}:{}'.format(self.object.service_code, date, self.object.date)
+                context['timetables_html'] = cache.get(timetables_key)
+            if not context.get('timetables_html'):
+                context['timetables'] = self.object.get_timetables(date)
+
+        if context.get('timetables_html'):
+            pass  # the stops and timetables are already rendered
+        elif not context.get('timetables') or not context['timetables'][0].groupings:
             context['stopusages'] = self.object.stopusage_set.all().select_related(
                 'stop__locality'
             ).defer('stop__osm', 'stop__locality__latlong')
@@ -486,6 +533,13 @@ class ServiceDetailView(DetailView):
                     grouping.rows = [row for row in grouping.rows if any(row.times)]
                     for row in grouping.rows:
                         row.part.stop.stop = stops_dict.get(row.part.stop.atco_code)
+            if timetables_key and all(table.groupings for table in context['timetables']):
+                context['timetables_html'] = render_to_string('busstops/timetables.html', {
+                    'timetables': context['timetables']
+                })
+                tomorrow = datetime.combine(timezone.localtime().date(), datetime.min.time()) + timedelta(days=1)
+                cache.set(timetables_key, context['timetables_html'],
+                          (timezone.make_aware(tomorrow) - timezone.now()).total_seconds())
 
         if bool(context['operators']):
             operator = context['operators']
@@ -523,7 +577,9 @@ class ServiceDetailView(DetailView):
             })
 
         if self.object.description and self.object.line_name != 'FlixBus' and self.object.line_name != 'Ouibus':
-            related = Service.objects.filter(current=True).exclude(pk=self.object.pk).defer('geometry')
+            related = Service.objects.filter(current=True).exclude(pk=self.object.pk).defer(
+                'geometry', 'simplified_geometry'
+            )
             related = related.filter(Q(description=self.object.description) |
                                      Q(line_name=self.object.line_name, operator__in=context['operators']))
             context['related'] = sorted(related, key=Service.get_order)
@@ -535,11 +591,11 @@ class ServiceDetailView(DetailView):
             alternative = Service.objects.filter(
                 description=self.object.description,
                 current=True
-            ).defer('geometry').first() or Service.objects.filter(
+            ).defer('geometry', 'simplified_geometry').first() or Service.objects.filter(
                 line_name=self.object.line_name,
                 stopusage__stop_id__in=self.object.stopusage_set.values_list('stop_id', flat=True),
                 current=True
-            ).defer('geometry').first()
+            ).defer('geometry', 'simplified_geometry').first()
 
             if alternative is not None:
                 return redirect(alternative, permanent=True)
@@ -568,6 +624,29 @@ def service_xml(_, pk):
     return HttpResponse(bodies, content_type='text/plain')
 
 
+def service_geometry(request, pk):
+    """JSON endpoint accessed by the JavaScript map on service pages,
+    returning a service's route as encoded polylines simplified to suit the map's zoom level
+    """
+    try:
+        zoom = int(request.GET['zoom'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest()
+    service = get_object_or_404(Service.objects.only('simplified_geometry'), pk=pk)
+    simplified_geometry = service.simplified_geometry
+    if simplified_geometry is None:
+        # imported before simplified geometries were (until it's imported again, simplify it here, without saving)
+        geometry = Service.objects.filter(pk=pk).values_list('geometry', flat=True)[0]
+        simplified_geometry = polylines.simplify(geometry) if geometry else {}
+    tolerance = polylines.get_tolerance(zoom)
+    response = JsonResponse({
+        'tolerance': tolerance,
+        'polylines': simplified_geometry.get(str(tolerance), [])
+    })
+    response['Cache-Control'] = 'max-age=3600'
+    return response
+
+
 class ServiceSitemap(Sitemap):
     protocol = 'https'
 
@@ -135,7 +135,7 @@ for region in "${REGIONS[@]}"; do
         s3cmd put "$region.zip" "s3://bustimes-backup/$region-$date.zip"
         updated_services=1
         ../../../manage.py import_services "$region.zip"
-        cp "$region.zip" ..
+        cp -p "$region.zip" ..
     fi
 done
 cd ../..
@@ -0,0 +1,79 @@
+"""Departure boards for stops, kept in memory for the life of the process,
+so that finding the next departures from a stop usually needn't query the database
+"""
+import datetime
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from busstops import versions
+
+
+# Changed (by invalidate) whenever generate_departures has generated some departures
+VERSION_KEY = 'departure-boards-version'
+
+# The most boards to keep in memory at once
+MAX_BOARDS = 5000
+
+BOARDS = OrderedDict()
+STATE = {'version': None}
+LOCK = threading.Lock()
+
+
+class Board(object):
+    """All the generated departures from one stop, as a sorted list of epoch seconds,
+    and a parallel list of indices into a list of (service, destination) pairs
+    """
+    def __init__(self, rows):
+        """Given a list of departure dicts (with 'time', 'service' and 'destination' keys) sorted by time"""
+        self.times = []
+        self.journeys = []
+        self.pairs = []
+        self.timezone = None
+        pair_indices = {}
+        for row in rows:
+            pair = (row['service'], row['destination'])
+            key = (getattr(pair[0], 'pk', pair[0]), getattr(pair[1], 'pk', pair[1]))
+            if key not in pair_indices:
+                pair_indices[key] = len(self.pairs)
+                self.pairs.append(pair)
+            self.times.append(row['time'].timestamp())
+            self.journeys.append(pair_indices[key])
+            self.timezone = row['time'].tzinfo
+
+    def get_departures(self, now, limit=10):
+        """Given an aware datetime, return a list of at most limit departure dicts from then onwards"""
+        start = bisect_left(self.times, now.timestamp())
+        return [{
+            'time': datetime.datetime.fromtimestamp(self.times[i], self.timezone),
+            'service': self.pairs[self.journeys[i]][0],
+            'destination': self.pairs[self.journeys[i]][1]
+        } for i in range(start, min(start + limit, len(self.times)))]
+
+
+def get_board(key, load):
+    """Given a key (like an ATCO code) and a function that returns a sorted list of that stop's departures,
+    return a Board, or None if boards can't be used
+    """
+    version = versions.get_version(VERSION_KEY)
+    if version is None:
+        return
+    with LOCK:
+        if STATE['version'] != version:
+            BOARDS.clear()
+            STATE['version'] = version
+        board = BOARDS.get(key)
+        if board is not None:
+            BOARDS.move_to_end(key)
+            return board
+    board = Board(load())
+    with LOCK:
+        if STATE['version'] == version:
+            BOARDS[key] = board
+            while len(BOARDS) > MAX_BOARDS:
+                BOARDS.popitem(last=False)
+    return board
+
+
+def invalidate():
+    """Make every process reload its boards next time they're used"""
+    versions.invalidate(VERSION_KEY)
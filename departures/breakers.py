@@ -0,0 +1,120 @@
+"""Circuit breakers for live departures sources,
+so that while a source is down, pages don't keep waiting for it to time out.
+
+A breaker's state is kept in the cache, so it's shared by all processes.
+Requests and errors are counted in fixed windows, with atomic increments,
+so that processes counting at the same time don't overwrite each other's counts
+"""
+import time
+import datetime
+from django.core.cache import cache
+from . import counters
+
+
+# A breaker opens when at least this many requests to a source fail within one window
+FAILURE_THRESHOLD = 5
+# and at least this proportion of the window's requests failed
+FAILURE_RATE = 0.5
+# Seconds in a window
+WINDOW = 60
+# Seconds a breaker stays open before it lets a trial request through (half-opens)
+RESET_TIMEOUT = 60
+
+NAMES_KEY = 'breakers'
+NAMES = set()
+
+
+class Breaker(object):
+    def __init__(self, name):
+        self.name = name
+        self.key = 'breaker:' + name
+        self.opened_key = self.key + ':opened'
+        self.trial_key = self.key + ':trial'
+        self.error_key = self.key + ':error'
+        self.trial = False  # whether this is the trial request of a half-open breaker
+
+    def get_counter_key(self, counter, window):
+        return '{}:{}:{}'.format(self.key, counter, window)
+
+    def increment(self, counter, window):
+        """Given the name of a counter and a window number, add 1 to the count and return the new count"""
+        return counters.incr(self.get_counter_key(counter, window), timeout=WINDOW * 2)
+
+    def get_state(self):
+        """Return a dict of the current window's counts, when the breaker opened and the last error"""
+        window = int(time.time() // WINDOW)
+        requests_key = self.get_counter_key('requests', window)
+        errors_key = self.get_counter_key('errors', window)
+        values = cache.get_many([requests_key, errors_key, self.opened_key, self.error_key])
+        failed, error = values.get(self.error_key, (None, None))
+        return {
+            'requests': values.get(requests_key, 0),
+            'errors': values.get(errors_key, 0),
+            'error': error,
+            'failed': failed,
+            'opened': values.get(self.opened_key)
+        }
+
+    def allow(self):
+        """Return whether a request may be made to the source"""
+        opened = cache.get(self.opened_key)
+        if opened is None:
+            return True
+        if time.time() - opened < RESET_TIMEOUT:
+            return False
+        # half-open -- only let one trial request through at a time
+        if cache.add(self.trial_key, True, RESET_TIMEOUT):
+            self.trial = True
+        return self.trial
+
+    def record(self, error=None):
+        """Given (if the request failed) an exception or error message,
+        count a request, and return whether the failure opened the breaker
+        """
+        window = int(time.time() // WINDOW)
+        requests = self.increment('requests', window)
+        opened = False
+        if error is None:
+            if self.trial:
+                cache.delete_many([self.opened_key, self.trial_key])
+        else:
+            errors = self.increment('errors', window)
+            cache.set(self.error_key, (time.time(), str(error)), None)
+            if self.trial:
+                # still failing, so stay open for longer
+                cache.set(self.opened_key, time.time(), None)
+                cache.delete(self.trial_key)
+            elif errors >= FAILURE_THRESHOLD and errors >= requests * FAILURE_RATE:
+                opened = cache.add(self.opened_key, time.time(), None)
+        self.trial = False
+        self.register()
+        return opened
+
+    def register(self):
+        """Add the breaker's name to the shared set of names (once per process), for the status page"""
+        if self.name not in NAMES:
+            counters.add_name(NAMES_KEY, self.name)
+            NAMES.add(self.name)
+
+
+def get_status(state):
+    if state['opened'] is None:
+        return 'closed'
+    if time.time() - state['opened'] < RESET_TIMEOUT:
+        return 'open'
+    return 'half-open'
+
+
+def get_states():
+    """Return a list of (name, state) tuples for every breaker that has been used,
+    with the times in the states as datetimes
+    """
+    states = []
+    for name in sorted(counters.get_names(NAMES_KEY)):
+        state = Breaker(name).get_state()
+        state['status'] = get_status(state)
+        for key in ('failed', 'opened'):
+            if state[key] is not None:
+                state[key] = datetime.datetime.fromtimestamp(state[key], datetime.timezone.utc)
+        states.append((name, state))
+    return states
@@ -0,0 +1,225 @@
+"""Caching of stops' departures, shared between processes,
+so that when lots of people look at a busy stop at once, its departures are only fetched once,
+and so that people needn't wait for departures to be fetched when slightly stale ones will do
+"""
+import time
+import uuid
+import threading
+from collections import Counter
+from django.core.cache import cache
+from django.db import connection
+from busstops.models import Service, StopPoint
+from . import counters, live, metrics, profiles
+
+
+# How long (in seconds) after departures go stale they may still be shown while they're fetched again
+STALE_TTL = 120
+# How long (in seconds) one process may spend fetching a stop's departures while others wait for it
+LOCK_TIMEOUT = 5
+# How often (in seconds) a waiting process looks for the departures
+WAIT_INTERVAL = 0.05
+
+# The most other stops in a stop area to fetch Transport for London departures for at the same time as a stop
+TFL_MAX_OTHERS = 19
+
+# Requests for stops' departures are counted in 5 minute buckets, to find the busiest stops
+HITS_BUCKET = 300
+# The most stops whose counts each process adds to a bucket at once
+HITS_MAX_STOPS = 1000
+HITS = Counter()
+HITS_LOCK = threading.Lock()  # HITS is shared by the threads in a process
+STATE = {'flushed': 0}
+
+
+def get_key(atco_code):
+    return 'departures:' + atco_code
+
+
+def get_lock_key(atco_code):
+    return atco_code + ':lock'
+
+
+def acquire_lock(atco_code):
+    """Return a token if the stop's lock was acquired (so this process should fetch its departures),
+    or None if another process holds it
+    """
+    token = uuid.uuid4().hex
+    if cache.add(get_lock_key(atco_code), token, LOCK_TIMEOUT):
+        return token
+
+
+def release_lock(atco_code, token):
+    """Release the stop's lock, unless it has timed out and been acquired by another process since"""
+    lock_key = get_lock_key(atco_code)
+    if cache.get(lock_key) == token:
+        cache.delete(lock_key)
+
+
+def get_hits_key(now):
+    return 'departures-hits:{}'.format(int(now // HITS_BUCKET))
+
+
+def get_stop_hits_key(hits_key, atco_code):
+    return '{}:hits:{}'.format(hits_key, atco_code)
+
+
+def record_hit(atco_code):
+    """Count a request for a stop's departures.
+    Counts are kept in memory, and added to the shared counts in the cache once a minute,
+    with cache.incr (one key per stop), so that processes adding their counts at the same time don't lose any
+    """
+    now = time.time()
+    with HITS_LOCK:
+        HITS[atco_code] += 1
+        if now - STATE['flushed'] < 60:
+            return
+        flushing = HITS.copy()
+        HITS.clear()
+        STATE['flushed'] = now
+    key = get_hits_key(now)
+    for atco_code, count in flushing.most_common(HITS_MAX_STOPS):
+        counters.add_name(key, atco_code, HITS_BUCKET * 2)
+        counters.incr(get_stop_hits_key(key, atco_code), count, HITS_BUCKET * 2)
+
+
+def get_hot_stops(number):
+    """Return a list of the ATCO codes of the stops whose departures have been requested most recently"""
+    now = time.time()
+    hits = Counter()
+    for key in (get_hits_key(now - HITS_BUCKET), get_hits_key(now)):
+        atco_codes = counters.get_names(key)
+        counts = counters.get_counts([get_stop_hits_key(key, atco_code) for atco_code in atco_codes])
+        hits.update({atco_code: counts[get_stop_hits_key(key, atco_code)] for atco_code in atco_codes})
+    return [atco_code for atco_code, _ in hits.most_common(number)]
+
+
+def get_services(stop):
+    return profiles.get_profile(stop).services
+
+
+def get_tfl_others(stop):
+    """Return a list of the other London stops in a stop's stop area whose departures aren't fresh in the cache,
+    with only the fields needed to fetch their departures and correct their names and headings
+    """
+    if not stop.stop_area_id:
+        return []
+    others = StopPoint.objects.filter(
+        stop_area=stop.stop_area_id, live_sources='TfL', active=True
+    ).exclude(atco_code=stop.atco_code).only('atco_code', 'common_name', 'heading').order_by('atco_code')
+    others = list(others[:TFL_MAX_OTHERS])
+    cached = cache.get_many([get_key(other.atco_code) for other in others])
+    now = time.time()
+    return [
+        other for other in others
+        if get_key(other.atco_code) not in cached or cached[get_key(other.atco_code)][1] <= now
+    ]
+
+
+def get_others_services(others):
+    """Given some StopPoints, return a list of their current services,
+    from their profiles in the cache if possible, and otherwise in one query
+    """
+    cached = profiles.get_cached_profiles(others)
+    services = [service for profile in cached.values() for service in profile.services]
+    missing = [other for other in others if other.atco_code not in cached]
+    if missing:
+        services += Service.objects.filter(
+            stops__in=missing, current=True
+        ).defer('geometry', 'simplified_geometry').distinct()
+    return services
+
+
+def fetch(stop, services, bot=False):
+    """Return a tuple containing a context dictionary (with a list of departures) and a max_age integer.
+
+    Transport for London departures for the other stops in the stop area are fetched in the same request,
+    and put in the cache
+    """
+    profile = profiles.get_profile(stop)
+    departures, max_age = live.get_departures(stop, services, bot, profile.live_sources, profile.operators)
+    others = ()
+    if not bot and isinstance(departures['departures'], live.TflDepartures):
+        others = get_tfl_others(stop)
+        if others:
+            departures['departures'].add_stops(others, get_others_services(others))
+    if hasattr(departures['departures'], 'get_departures'):
+        source = departures['departures']
+        departures['departures'] = source.get_departures()
+        stale = time.time() + max_age
+        for other in others:
+            if other.atco_code in source.other_departures:
+                cache.set(get_key(other.atco_code), ({
+                    'departures': source.other_departures[other.atco_code],
+                    'today': departures['today'],
+                    'source': live.get_tfl_source(other)
+                }, stale), max_age + STALE_TTL)
+    return departures, max_age
+
+
+def store(stop, services, token):
+    """Fetch a stop's departures and put them in the cache (along with when they go stale),
+    release the stop's lock (given the token it was acquired with),
+    and return a tuple containing a context dictionary and a max_age integer
+    """
+    try:
+        departures, max_age = fetch(stop, services)
+        cache.set(get_key(stop.atco_code), (departures, time.time() + max_age), max_age + STALE_TTL)
+    finally:
+        release_lock(stop.atco_code, token)
+    return departures, max_age
+
+
+def store_in_background(stop, services, token):
+    def target():
+        try:
+            store(stop, services, token)
+        finally:
+            connection.close()
+    threading.Thread(target=target, daemon=True).start()
+
+
+def refresh(stop, services):
+    """Fetch a stop's departures and put them in the cache, and return the max_age"""
+    token = uuid.uuid4().hex
+    cache.set(get_lock_key(stop.atco_code), token, LOCK_TIMEOUT)
+    return store(stop, services, token)[1]
+
+
+def get_departures(stop, services, bot=False):
+    """Given a StopPoint and a list of Services, return a context dictionary (with a list of departures),
+    from the cache if possible.
+
+    If the cached departures are stale, return them anyway, and fetch them again in the background.
+    If another process is already fetching the stop's departures, wait for it rather than fetching them again
+    """
+    record_hit(stop.atco_code)
+    key = get_key(stop.atco_code)
+    cached = cache.get(key)
+    lock_key = get_lock_key(stop.atco_code)
+    if cached:
+        departures, stale = cached
+        if time.time() >= stale:
+            metrics.record_cache('stale')
+            if not bot:
+                token = acquire_lock(stop.atco_code)
+                if token:
+                    store_in_background(stop, services, token)
+        else:
+            metrics.record_cache('hit')
+        return departures
+    metrics.record_cache('miss')
+    if bot:  # don't cache departures fetched for bots
+        return fetch(stop, services, bot)[0]
+
+    token = acquire_lock(stop.atco_code)
+    if not token:
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(WAIT_INTERVAL)
+            cached = cache.get(key)
+            if cached:
+                return cached[0]
+            if not cache.get(lock_key):
+                break
+        token = acquire_lock(stop.atco_code)
+    return store(stop, services, token)[0]
@@ -0,0 +1,41 @@
+"""Counts and sets of names shared between processes, in the cache.
+
+They're only changed with atomic cache operations (incr and add), never by getting a value and setting a new one,
+so that processes changing them at the same time don't undo each other's changes
+"""
+from django.core.cache import cache
+
+
+def incr(key, delta=1, timeout=None):
+    """Add delta to the count in the cache (starting from 0, with the timeout, if it's not there),
+    and return the new count
+    """
+    try:
+        return cache.incr(key, delta)
+    except ValueError:  # not in the cache yet
+        if cache.add(key, delta, timeout):
+            return delta
+        return cache.incr(key, delta)
+
+
+def get_counts(keys):
+    """Given some keys, return a dict of their counts (0 for those not in the cache)"""
+    counts = cache.get_many(keys)
+    return {key: counts.get(key, 0) for key in keys}
+
+
+def add_name(key, name, timeout=None):
+    """Add a name to the set of names, with its keys in the cache expiring after the timeout.
+
+    Each name has a key of its own, so only the first process to add a name (with cache.add) gives it a number,
+    and names are numbered with cache.incr, so each has a key that no other name's number overwrites
+    """
+    if cache.add('{}:name:{}'.format(key, name), True, timeout):
+        number = incr(key + ':count', timeout=timeout)
+        cache.set('{}:{}'.format(key, number), name, timeout)
+
+
+def get_names(key):
+    """Return the set of names"""
+    count = cache.get(key + ':count') or 0
+    return set(cache.get_many(['{}:{}'.format(key, number) for number in range(1, count + 1)]).values())
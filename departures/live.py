@@ -1,21 +1,95 @@
 """Various ways of getting live departures from some web service"""
 import re
+import time
+import queue
 import datetime
+import threading
 import requests
-import pytz
 import dateutil.parser
 import logging
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, wait
+from lxml import etree, html
 from django.conf import settings
+from django.db import connection
 from django.utils.text import slugify
 from django.utils.timezone import make_naive
-from busstops.models import Operator, Service
+from busstops.models import Operator, Service, StopPoint
+from . import boards, breakers, metrics, timestamps
 
 
 logger = logging.getLogger(__name__)
 DESTINATION_REGEX = re.compile(r'.+\((.+)\)')
-LOCAL_TIMEZONE = pytz.timezone('Europe/London')
+LOCAL_TIMEZONE = timestamps.LOCAL_TIMEZONE
 SESSION = requests.Session()
+CELLS_XPATH = etree.XPath('//td')
+RTI_TABLE_XPATH = etree.XPath('//*[@id="GridViewRTI"]')
+ROWS_XPATH = etree.XPath('.//tr')
+ROW_CELLS_XPATH = etree.XPath('.//td')
+# Corrections to stops' names and headings, waiting to be saved by a background thread
+CORRECTIONS = queue.Queue()
+CORRECTIONS_WRITER = {'thread': None}
+CORRECTIONS_LOCK = threading.Lock()
+# Threads for fetching live departures from several sources at once
+EXECUTOR = ThreadPoolExecutor(max_workers=16)
+# The most seconds to spend waiting for live departures to build one stop's departures
+DEADLINE = 1.5
+
+
+def log_success(breaker, latency):
+    """Record a successful request to a live departures source"""
+    metrics.record_request(breaker.name, latency)
+    breaker.record()
+
+
+def log_failure(breaker, latency, error):
+    """Record a failed request to a live departures source,
+    and only log an error when that makes the source's breaker open, to avoid a deluge of identical errors
+    """
+    metrics.record_request(breaker.name, latency, error, isinstance(error, requests.exceptions.Timeout))
+    if breaker.record(error):
+        logger.error('%s is failing: %s', breaker.name, error)
+    else:
+        logger.warning('%s: %s', breaker.name, error)
+
+
+def write_corrections():
+    """Save queued corrections to stops until there are none for a second,
+    closing the database connection whenever the queue is empty
+    """
+    while True:
+        try:
+            atco_code, common_name, heading = CORRECTIONS.get(timeout=1)
+        except queue.Empty:
+            with CORRECTIONS_LOCK:
+                if CORRECTIONS.empty():
+                    CORRECTIONS_WRITER['thread'] = None
+                    return
+            continue
+        try:
+            StopPoint.objects.filter(atco_code=atco_code).update(common_name=common_name, heading=heading)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+        if CORRECTIONS.empty():
+            connection.close()
+
+
+def queue_correction(stop):
+    """Given a StopPoint with a corrected name or heading, queue it to be saved in the background,
+    so that the request needn't wait for the database
+    """
+    with CORRECTIONS_LOCK:
+        CORRECTIONS.put((stop.atco_code, stop.common_name, stop.heading))
+        if CORRECTIONS_WRITER['thread'] is None:
+            CORRECTIONS_WRITER['thread'] = threading.Thread(target=write_corrections, daemon=True)
+            CORRECTIONS_WRITER['thread'].start()
+
+
+def parse_html(text):
+    """Given a string of HTML, return an lxml document, or None if there's nothing to parse"""
+    try:
+        return html.document_fromstring(text)
+    except etree.ParserError:
+        return
 
 
 class Departures(object):
@@ -51,36 +125,74 @@ class Departures(object):
         """
         raise NotImplementedError
 
+    def get_source_name(self):
+        """Return the name of the source, for its circuit breaker"""
+        return self.__class__.__name__.replace('Departures', '')
+
     def get_departures(self):
         """Returns a list of departures"""
+        breaker = breakers.Breaker(self.get_source_name())
+        if not breaker.allow():
+            return
+        start = time.monotonic()
         try:
             response = self.get_response()
         except requests.exceptions.RequestException as e:
-            logger.error(e, exc_info=True)
+            log_failure(breaker, time.monotonic() - start, e)
             return
+        if response.status_code >= 500:
+            log_failure(breaker, time.monotonic() - start, response.status_code)
+        else:
+            log_success(breaker, time.monotonic() - start)
         if response.ok:
-            return self.departures_from_response(response)
+            start = time.monotonic()
+            departures = self.departures_from_response(response)
+            metrics.record_parse(breaker.name, time.monotonic() - start)
+            return departures
 
 
 class TflDepartures(Departures):
     """Departures from the Transport for London API"""
+    others = ()
+
+    def add_stops(self, stops, services):
+        """Given some other StopPoints and their Services,
+        get the other stops' departures (into self.other_departures) in the same request
+        """
+        self.others = stops
+        self.other_departures = {}
+        for service in services:
+            self.services.setdefault(service.line_name.split('|', 1)[0].lower(), service)
+
     def get_request_url(self):
-        return 'https://api.tfl.gov.uk/StopPoint/%s/arrivals' % self.stop.pk
+        return 'https://api.tfl.gov.uk/StopPoint/%s/arrivals' % ','.join(
+            [self.stop.pk] + [stop.pk for stop in self.others]
+        )
 
     def departures_from_response(self, res):
         rows = res.json()
+        if not self.others:
+            return self.get_stop_departures(self.stop, rows)
+        stops_rows = {}
+        for item in rows:
+            stops_rows.setdefault(item.get('naptanId'), []).append(item)
+        for stop in self.others:
+            self.other_departures[stop.pk] = self.get_stop_departures(stop, stops_rows.get(stop.pk))
+        return self.get_stop_departures(self.stop, stops_rows.get(self.stop.pk))
+
+    def get_stop_departures(self, stop, rows):
         if rows:
             name = rows[0]['stationName']
             heading = int(rows[0]['bearing'])
-            if name != self.stop.common_name or heading != self.stop.heading:
-                self.stop.common_name = name
-                self.stop.heading = heading
-                self.stop.save()
+            if name != stop.common_name or heading != stop.heading:
+                stop.common_name = name
+                stop.heading = heading
+                queue_correction(stop)
         return sorted([{
-            'live': dateutil.parser.parse(item.get('expectedArrival')).astimezone(LOCAL_TIMEZONE),
+            'live': timestamps.parse_datetime(item.get('expectedArrival')),
             'service': self.get_service(item.get('lineName')),
             'destination': item.get('destinationName'),
-        } for item in res.json()], key=lambda d: d['live'])
+        } for item in rows or ()], key=lambda d: d['live'])
 
 
 class AcisDepartures(Departures):
@@ -96,6 +208,9 @@ class AcisDepartures(Departures):
         self.prefix = prefix
         super(AcisDepartures, self).__init__(stop, services, now)
 
+    def get_source_name(self):
+        return self.prefix
+
 
 class AcisLiveDepartures(AcisDepartures):
     """Departures from an old-fashioned website ending in .acislive.com"""
@@ -117,8 +232,10 @@ class AcisLiveDepartures(AcisDepartures):
         }
 
     def departures_from_response(self, res):
-        soup = BeautifulSoup(res.text, 'lxml')
-        cells = [cell.text.strip() for cell in soup.find_all('td')]
+        document = parse_html(res.text)
+        if document is None:
+            return []
+        cells = [cell.text_content().strip() for cell in CELLS_XPATH(document)]
         rows = (cells[i * 4 - 4:i * 4] for i in range(1, int(len(cells) / 4) + 1))
         return [self.get_row(row) for row in rows]
 
@@ -134,29 +251,29 @@ class AcisConnectDepartures(AcisDepartures):
         }
 
     def get_yorkshire_row(self, row):
-        time, live = self.get_time(row[2].text)
+        time, live = self.get_time(row[2])
         return {
             'time': time,
             'live': live,
-            'service': self.get_service(row[0].text),
-            'destination': row[1].text
+            'service': self.get_service(row[0]),
+            'destination': row[1]
         }
 
     def get_row(self, row):
-        time, live = self.get_time(row[4].text)
+        time, live = self.get_time(row[4])
         return {
             'time': time,
             'live': live,
-            'service': self.get_service(row[0].text),
-            'destination': row[2].text
+            'service': self.get_service(row[0]),
+            'destination': row[2]
         }
 
     def departures_from_response(self, res):
-        soup = BeautifulSoup(res.text, 'lxml')
-        table = soup.find(id='GridViewRTI')
-        if table is None:
+        document = parse_html(res.text)
+        tables = RTI_TABLE_XPATH(document) if document is not None else ()
+        if not tables:
             return
-        rows = (row.findAll('td') for row in table.findAll('tr')[1:])
+        rows = ([cell.text_content() for cell in ROW_CELLS_XPATH(row)] for row in ROWS_XPATH(tables[0])[1:])
         if self.prefix == 'yorkshire':
             return [self.get_yorkshire_row(row) for row in rows]
         return [self.get_row(row) for row in rows]
@@ -242,12 +359,27 @@ class TimetableDepartures(Departures):
             'service': suu.journey.service
         }
 
-    def get_departures(self):
-        queryset = self.stop.stopusageusage_set.filter(datetime__gte=self.now, journey__service__current=True)
+    def get_queryset(self):
+        queryset = self.stop.stopusageusage_set.filter(journey__service__current=True)
         queryset = queryset.select_related('journey__destination__locality', 'journey__service')
-        queryset = queryset.defer('journey__destination__latlong', 'journey__destination__locality__latlong',
-                                  'journey__service__geometry')[:10]
-        return [self.get_row(suu) for suu in queryset]
+        return queryset.defer('journey__destination__latlong', 'journey__destination__locality__latlong',
+                              'journey__service__geometry')
+
+    def get_all_departures(self):
+        """Return a list of all the generated departures from now on, to load into a Board"""
+        return [self.get_row(suu) for suu in self.get_queryset().filter(datetime__gte=self.now).iterator()]
+
+    def get_departures(self):
+        board = boards.get_board(self.stop.atco_code, self.get_all_departures)
+        if board is not None:
+            return board.get_departures(self.now)
+        queryset = self.get_queryset()
+        # look in the next day first, so only the latest day partitions need to be scanned
+        horizon = self.now + datetime.timedelta(days=1)
+        departures = list(queryset.filter(datetime__gte=self.now, datetime__lt=horizon)[:10])
+        if len(departures) < 10:
+            departures += queryset.filter(datetime__gte=horizon)[:10 - len(departures)]
+        return [self.get_row(suu) for suu in departures]
 
 
 class LambdaDepartures(Departures):
@@ -258,8 +390,8 @@ class LambdaDepartures(Departures):
         json = res.json()
         if 'departures' in json:
             return [{
-                'time': dateutil.parser.parse(item['aimed_time']),
-                'live': item['expected_time'] and dateutil.parser.parse(item['expected_time']),
+                'time': timestamps.parse_datetime(item['aimed_time']),
+                'live': item['expected_time'] and timestamps.parse_datetime(item['expected_time']),
                 'service': self.get_service(item['service']),
                 'destination': item['destination_name']
             } for item in json['departures'] if item['aimed_time']]
@@ -283,7 +415,28 @@ def get_max_age(departures, now):
     return 3600
 
 
-def add_stagecoach_departures(stop, services_dict, departures):
+def fetch_all(functions, deadline):
+    """Given a list of functions (that mustn't touch the database) and a time.monotonic() deadline,
+    call them all at once in different threads, and return a list of what they returned
+    (or None for any that raised an exception or hadn't finished by the deadline)
+    """
+    futures = [EXECUTOR.submit(function) for function in functions]
+    done, not_done = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+    results = []
+    for future in futures:
+        if future in done:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                results.append(None)
+        else:
+            future.cancel()
+            results.append(None)
+    return results
+
+
+def get_stagecoach_stop_monitors(stop):
     headers = {
         'Origin': 'https://www.stagecoachbus.com',
         'Referer': 'https://www.stagecoachbus.com',
@@ -304,55 +457,133 @@ def add_stagecoach_departures(stop, services_dict, departures):
             }
         }
     }
+    breaker = breakers.Breaker('stagecoach')
+    if not breaker.allow():
+        return
+    start = time.monotonic()
     try:
         response = SESSION.post('https://api.stagecoachbus.com/adc/stop-monitor', headers=headers, json=json, timeout=1)
     except requests.exceptions.RequestException as e:
-        logger.error(e, exc_info=True)
-        return departures
-    if not response.ok:
-        return departures
-    stop_monitors = response.json()['stopMonitors']
-    if 'stopMonitor' in stop_monitors:
+        log_failure(breaker, time.monotonic() - start, e)
+        return
+    if response.status_code >= 500:
+        log_failure(breaker, time.monotonic() - start, response.status_code)
+    else:
+        log_success(breaker, time.monotonic() - start)
+    if response.ok:
+        start = time.monotonic()
+        stop_monitors = response.json()['stopMonitors']
+        metrics.record_parse(breaker.name, time.monotonic() - start)
+        return stop_monitors
+
+
+def add_stagecoach_departures(stop, services_dict, departures, stop_monitors=None):
+    """Given a StopPoint, a dict of line names to Services, a list of departures
+    and (optionally, if they've already been fetched) some Stagecoach stop monitors,
+    return the departures with Stagecoach's live departure times added
+    """
+    if stop_monitors is None:
+        stop_monitors = get_stagecoach_stop_monitors(stop)
+    if stop_monitors and 'stopMonitor' in stop_monitors:
         added = False
+        times = {}  # times to the positions of the first departures at those times
+        lines = {}  # line names to the positions of departures without live times
+        starts = {}  # line names to how many of those positions have since got live times
+
+        def add(i, departure):
+            times.setdefault(departure['time'], i)
+            if not departure.get('live'):
+                lines.setdefault(getattr(departure['service'], 'line_name', None), []).append(i)
+
+        for i, departure in enumerate(departures):
+            add(i, departure)
         for monitor in stop_monitors['stopMonitor'][0]['monitoredCalls']['monitoredCall']:
             if 'expectedDepartureTime' in monitor:
-                aimed, expected = [dateutil.parser.parse(time).astimezone(LOCAL_TIMEZONE)
+                aimed, expected = [timestamps.parse_datetime(time)
                                    for time in (monitor['aimedDepartureTime'], monitor['expectedDepartureTime'])]
                 line = monitor['lineRef']
                 if aimed >= departures[0]['time']:
-                    replaced = False
-                    for departure in departures:
-                        if aimed == departure['time']:
-                            departure['live'] = expected
-                            replaced = True
-                            break
-                    if replaced:
+                    if aimed in times:
+                        departures[times[aimed]]['live'] = expected
                         continue
-                    for departure in departures:
-                        if not departure.get('live') and line == departure['service'].line_name:
-                            departure['live'] = expected
-                            replaced = True
-                            break
-                    if replaced:
+                    positions = lines.get(line, ())
+                    start = starts.get(line, 0)
+                    while start < len(positions) and departures[positions[start]].get('live'):
+                        start += 1
+                    starts[line] = start
+                    if start < len(positions):
+                        departures[positions[start]]['live'] = expected
                         continue
-                departures.append({
+                departure = {
                     'time': aimed,
                     'live': expected,
                     'service': services_dict.get(line.lower(), line),
                     'destination': monitor['destinationDisplay']
-                })
+                }
+                add(len(departures), departure)
+                departures.append(departure)
                 added = True
         if added:
             departures.sort(key=lambda d: d['time'])
     return departures
 
 
-def services_match(a, b):
-    if type(a) == Service:
-        a = a.line_name
-    if type(b) == Service:
-        b = b.line_name
-    return a == b
+def get_line_name(service):
+    if type(service) == Service:
+        return service.line_name
+    return service
+
+
+class Line(object):
+    """The departures of one line (in a list of departures),
+    indexed so that live departures can be matched to them without looking through the whole list
+    """
+    def __init__(self):
+        self.times = {}  # times to the positions of the first departures at those times
+        self.scheduled = []  # positions of departures without live times (yet)
+        self.start = 0  # self.scheduled[:self.start] have since got live times
+        self.sorted = True  # whether self.scheduled are in time order
+        self.last_time = None
+
+    def add(self, i, row):
+        if row['time'] and row['time'] not in self.times:
+            self.times[row['time']] = i
+        if 'live' not in row:
+            if self.sorted and self.scheduled:
+                try:
+                    self.sorted = self.last_time <= row['time']
+                except TypeError:
+                    self.sorted = False
+            self.last_time = row['time']
+            self.scheduled.append(i)
+
+    def match(self, departures, live_row):
+        """Given the list of departures and a live departure, return the position of the first departure that
+        has the same time as the live departure, or else of the first that doesn't have a live time yet
+        and is no later, or None
+        """
+        exact = self.times.get(live_row['time'])
+        if exact is not None:
+            return exact
+        while self.start < len(self.scheduled) and 'live' in departures[self.scheduled[self.start]]:
+            self.start += 1
+        # if the departures are in time order, only the first one without a live time need be considered
+        end = self.start + 1 if self.sorted else len(self.scheduled)
+        for i in self.scheduled[self.start:end]:
+            row = departures[i]
+            if 'live' not in row and (
+                live_row['time'] is None
+                or type(live_row['time']) is str
+                or get_naive(row['time']) <= get_naive(live_row['time'])
+            ):
+                return i
+
+
+def get_naive(time):
+    """Given a datetime, return it in local time without a timezone, like the times from most live sources"""
+    if time.tzinfo:
+        return make_naive(time)
+    return time
 
 
 def can_sort(departure):
@@ -361,43 +592,45 @@ def can_sort(departure):
 
 def get_departure_order(departure):
     if departure['time']:
-        if departure['time'].tzinfo:
-            return make_naive(departure['time'])
-        return departure['time']
+        return get_naive(departure['time'])
     return make_naive(departure['live'])
 
 
 def blend(departures, live_rows):
+    """Given a list of departures and a list of live departures from another source,
+    add the live times to the matching departures, and add the live departures that don't match any to the list
+    """
+    lines = {}
+    for i, row in enumerate(departures):
+        lines.setdefault(get_line_name(row['service']), Line()).add(i, row)
     added = False
     for live_row in live_rows:
-        replaced = False
-        for row in departures:
-            if (
-                services_match(row['service'], live_row['service'])
-                and (
-                    row['time'] and row['time'] == live_row['time']
-                    or 'live' not in row and (
-                        live_row['time'] is None
-                        or type(live_row['time']) is str
-                        or make_naive(row['time']) <= live_row['time']
-                    )
-                )
-            ):
-                row['live'] = live_row['live']
-                replaced = True
-                break
-        if not replaced:
+        line_name = get_line_name(live_row['service'])
+        i = lines[line_name].match(departures, live_row) if line_name in lines else None
+        if i is None:
             added = True
+            lines.setdefault(line_name, Line()).add(len(departures), live_row)
             departures.append(live_row)
+        else:
+            departures[i]['live'] = live_row['live']
     if added and all(can_sort(departure) for departure in departures):
         departures.sort(key=get_departure_order)
 
 
-def get_departures(stop, services, bot=False):
-    """Given a StopPoint object and an iterable of Service objects,
+def get_tfl_source(stop):
+    return {
+        'url': 'https://tfl.gov.uk/bus/stop/%s/%s' % (stop.atco_code, slugify(stop.common_name)),
+        'name': 'Transport for London'
+    }
+
+
+def get_departures(stop, services, bot=False, live_sources=None, operators=None):
+    """Given a StopPoint object and an iterable of Service objects
+    (and optionally the names of the stop's live sources and a list of its services' Operators, if already known),
     returns a tuple containing a context dictionary and a max_age integer
     """
-    live_sources = stop.live_sources.values_list('name', flat=True)
+    if live_sources is None:
+        live_sources = stop.live_sources.values_list('name', flat=True)
 
     # Transport for London
     if 'TfL' in live_sources:
@@ -405,13 +638,9 @@ def get_departures(stop, services, bot=False):
         return ({
             'departures': departures,
             'today': datetime.date.today(),
-            'source': {
-                # use departures.stop instead of local stop,
-                # in case it was updated in departures_from_response
-                'url': 'https://tfl.gov.uk/bus/stop/%s/%s' % (departures.stop.atco_code,
-                                                              slugify(departures.stop.common_name)),
-                'name': 'Transport for London'
-            }
+            # use departures.stop instead of local stop,
+            # in case it was updated in departures_from_response
+            'source': get_tfl_source(departures.stop)
         }, 60)
 
     now = datetime.datetime.now(LOCAL_TIMEZONE)
@@ -436,11 +665,13 @@ def get_departures(stop, services, bot=False):
             }
         }, 60)
 
-    operators = Operator.objects.filter(service__stops=stop,
-                                        service__current=True).distinct()
+    if operators is None:
+        operators = Operator.objects.filter(service__stops=stop,
+                                            service__current=True).distinct()
 
     # Dublin
     if stop.atco_code[0] == '8' and 'DB' in stop.atco_code:
+        start = time.monotonic()
         try:
             response = SESSION.get(
                 'https://data.dublinked.ie/cgi-bin/rtpi/realtimebusinformation',
@@ -448,16 +679,23 @@ def get_departures(stop, services, bot=False):
                 timeout=1
             )
         except requests.exceptions.RequestException as e:
+            metrics.record_request('dublin', time.monotonic() - start, e,
+                                   isinstance(e, requests.exceptions.Timeout))
             logger.error(e, exc_info=True)
-            pass
-        if response.ok:
+            response = None
+        else:
+            metrics.record_request('dublin', time.monotonic() - start,
+                                   response.status_code if response.status_code >= 500 else None)
+        if response is not None and response.ok:
+            start = time.monotonic()
             services_dict = {service.line_name.lower(): service for service in services}
             departures = [{
-                'time': dateutil.parser.parse(item['scheduleddeparturedatetime'], dayfirst=True),
-                'live': dateutil.parser.parse(item['departuredatetime'], dayfirst=True),
+                'time': timestamps.parse_day_first_datetime(item['scheduleddeparturedatetime']),
+                'live': timestamps.parse_day_first_datetime(item['departuredatetime']),
                 'destination': item['destination'],
                 'service': services_dict.get(item['route'].lower(), item['route'])
             } for item in response.json()['results']]
+            metrics.record_parse('dublin', time.monotonic() - start)
             return ({
                 'departures': departures
             }, 60)
@@ -466,11 +704,15 @@ def get_departures(stop, services, bot=False):
     services_dict = departures.services
     departures = departures.get_departures()
 
+    source = None  # vixConnect
     if not departures or (departures[0]['time'] - now) < datetime.timedelta(hours=1):
+        deadline = time.monotonic() + DEADLINE
+        functions = []
         # Stagecoach
-        if any(operator.name.startswith('Stagecoach') for operator in operators):
+        stagecoach = any(operator.name.startswith('Stagecoach') for operator in operators)
+        if stagecoach:
             if departures:
-                departures = add_stagecoach_departures(stop, services_dict, departures)
+                functions.append(lambda: get_stagecoach_stop_monitors(stop))
         else:
             for live_source_name, prefix in (
                     ('ayr', 'ayrshire'),
@@ -483,30 +725,33 @@ def get_departures(stop, services, bot=False):
                     ('metr', 'metrobus')
             ):
                 if live_source_name in live_sources:
-                    live_rows = AcisConnectDepartures(prefix, stop, services, now).get_departures()
-                    if live_rows:
-                        blend(departures, live_rows)
-
-                    return ({
-                        'departures': departures,
-                        'today': now.date(),
-                        'source': {
-                            'url': 'http://%s.acisconnect.com/Text/WebDisplay.aspx?stopRef=%s' % (prefix, stop.pk),
-                            'name': 'vixConnect'
-                        }
-                    }, 60)
-        # Belfast
-        if operators and any(operator.id == 'MET' for operator in operators):
-            live_rows = AcisConnectDepartures('belfast', stop, services, now).get_departures()
-            if live_rows:
-                blend(departures, live_rows)
-        # Norfolk
-        elif not bot and departures and stop.atco_code[:3] == '290':
-            live_rows = LambdaDepartures(stop, services, now).get_departures()
+                    functions.append(AcisConnectDepartures(prefix, stop, services, now).get_departures)
+                    source = {
+                        'url': 'http://%s.acisconnect.com/Text/WebDisplay.aspx?stopRef=%s' % (prefix, stop.pk),
+                        'name': 'vixConnect'
+                    }
+                    break
+        if source is None:
+            # Belfast
+            if operators and any(operator.id == 'MET' for operator in operators):
+                functions.append(AcisConnectDepartures('belfast', stop, services, now).get_departures)
+            # Norfolk
+            elif not bot and departures and stop.atco_code[:3] == '290':
+                functions.append(LambdaDepartures(stop, services, now).get_departures)
+
+        results = fetch_all(functions, deadline)
+        if stagecoach and departures:
+            stop_monitors = results.pop(0)
+            if stop_monitors:
+                departures = add_stagecoach_departures(stop, services_dict, departures, stop_monitors)
+        for live_rows in results:
             if live_rows:
                 blend(departures, live_rows)
 
-    return ({
+    context = {
         'departures': departures,
         'today': now.date(),
-    },  60)
+    }
+    if source is not None:
+        context['source'] = source
+    return context, 60
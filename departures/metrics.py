@@ -0,0 +1,184 @@
+"""Counts of requests to live departures sources, and how long they take, and of departures cache hits.
+
+Counts are kept in memory, and added to the shared counts in the cache (and logged) once a minute,
+so recording them is cheap. The shared counts are only changed with cache.incr, one key per count,
+so that processes adding their counts at the same time don't lose each other's
+"""
+import time
+import logging
+import datetime
+import threading
+from collections import Counter
+from django.core.cache import cache
+from . import counters
+
+
+logger = logging.getLogger(__name__)
+
+KEY = 'departures-metrics'
+SOURCES_KEY = KEY + ':sources'
+SINCE_KEY = KEY + ':since'
+FLUSH_INTERVAL = 60
+
+# The upper bounds (in seconds) of the latency histograms' buckets -- the last bucket is for anything slower
+BUCKETS = (0.1, 0.25, 0.5, 1, 2)
+LABELS = ['< {} s'.format(bound) for bound in BUCKETS] + ['≥ {} s'.format(BUCKETS[-1])]
+
+# The counts kept in the cache for each source -- times in microseconds, because cache.incr only adds integers
+COUNTERS = ('requests', 'errors', 'timeouts', 'latency', 'parses', 'parse_time') + tuple(
+    'histogram:{}'.format(i) for i in range(len(BUCKETS) + 1)
+)
+TIMES = {'latency', 'parse_time'}
+CACHE_RESULTS = ('hit', 'stale', 'miss')
+
+SOURCES = {}
+CACHE = Counter()
+STATE = {'flushed': time.time()}
+LOCK = threading.Lock()
+
+
+def get_empty_source():
+    return {
+        'requests': 0,
+        'errors': 0,
+        'timeouts': 0,
+        'latency': 0,  # total seconds
+        'histogram': [0] * (len(BUCKETS) + 1),
+        'parses': 0,
+        'parse_time': 0,  # total seconds
+    }
+
+
+def get_bucket(seconds):
+    for i, bound in enumerate(BUCKETS):
+        if seconds < bound:
+            return i
+    return len(BUCKETS)
+
+
+def record_request(name, latency, error=None, timeout=False):
+    """Given the name of a live departures source, how many seconds a request to it took,
+    and (if it failed) an exception or error message, and whether it timed out
+    """
+    with LOCK:
+        source = SOURCES.setdefault(name, get_empty_source())
+        source['requests'] += 1
+        source['latency'] += latency
+        source['histogram'][get_bucket(latency)] += 1
+        if error is not None:
+            source['errors'] += 1
+        if timeout:
+            source['timeouts'] += 1
+    maybe_flush()
+
+
+def record_parse(name, seconds):
+    """Given the name of a live departures source and how many seconds parsing a response from it took"""
+    with LOCK:
+        source = SOURCES.setdefault(name, get_empty_source())
+        source['parses'] += 1
+        source['parse_time'] += seconds
+
+
+def record_cache(result):
+    """Given 'hit', 'stale' or 'miss', count a request for a stop's departures"""
+    with LOCK:
+        CACHE[result] += 1
+    maybe_flush()
+
+
+def get_source_key(name, counter):
+    return '{}:{}:{}'.format(KEY, name, counter)
+
+
+def get_cache_key(result):
+    return '{}:cache:{}'.format(KEY, result)
+
+
+def get_counts(source):
+    """Given a dict of a source's counts in memory, return a dict of them as integers, by name of counter"""
+    counts = {}
+    for key, value in source.items():
+        if key == 'histogram':
+            for i, count in enumerate(value):
+                counts['histogram:{}'.format(i)] = count
+        elif key in TIMES:
+            counts[key] = int(round(value * 1000000))
+        else:
+            counts[key] = value
+    return counts
+
+
+def maybe_flush():
+    now = time.time()
+    if now - STATE['flushed'] >= FLUSH_INTERVAL:
+        flush(now)
+
+
+def flush(now=None):
+    """Add the counts in memory to the shared counts in the cache, and log them"""
+    with LOCK:
+        sources = dict(SOURCES)
+        cache_counts = Counter(CACHE)
+        SOURCES.clear()
+        CACHE.clear()
+        now = STATE['flushed'] = now or time.time()
+    if sources or cache_counts:
+        cache.add(SINCE_KEY, now, None)
+    for name, source in sources.items():
+        counters.add_name(SOURCES_KEY, name)
+        for counter, count in get_counts(source).items():
+            if count:
+                counters.incr(get_source_key(name, counter), count)
+        logger.info('%s: %d requests, %d errors, %d timeouts, %.3f s latency, %.3f ms parse time',
+                    name, source['requests'], source['errors'], source['timeouts'],
+                    source['latency'] / source['requests'] if source['requests'] else 0,
+                    source['parse_time'] * 1000 / source['parses'] if source['parses'] else 0)
+    for result, count in cache_counts.items():
+        counters.incr(get_cache_key(result), count)
+
+
+def get_metrics():
+    """Return a dict of the shared counts since the cache was last cleared"""
+    names = counters.get_names(SOURCES_KEY)
+    counts = counters.get_counts(
+        [get_source_key(name, counter) for name in names for counter in COUNTERS]
+        + [get_cache_key(result) for result in CACHE_RESULTS]
+    )
+    sources = {}
+    for name in names:
+        source = sources[name] = get_empty_source()
+        for counter in COUNTERS:
+            count = counts[get_source_key(name, counter)]
+            if counter.startswith('histogram:'):
+                source['histogram'][int(counter.split(':')[1])] = count
+            elif counter in TIMES:
+                source[counter] = count / 1000000
+            else:
+                source[counter] = count
+    return {
+        'sources': sources,
+        'cache': Counter({result: counts[get_cache_key(result)] for result in CACHE_RESULTS}),
+        'since': cache.get(SINCE_KEY) or time.time()
+    }
+
+
+def get_summary():
+    """Return a dict of the shared counts, with a list of (name, dict) tuples for the sources
+    (with mean latencies and parse times), the departures cache hit ratio (or None), and when counting began
+    """
+    metrics = get_metrics()
+    sources = []
+    for name in sorted(metrics['sources']):
+        source = dict(metrics['sources'][name])
+        source['mean_latency'] = source['latency'] / source['requests'] if source['requests'] else None
+        source['mean_parse_time'] = source['parse_time'] / source['parses'] if source['parses'] else None
+        source['histogram'] = list(zip(LABELS, source['histogram']))
+        sources.append((name, source))
+    total = sum(metrics['cache'].values())
+    return {
+        'sources': sources,
+        'cache': metrics['cache'],
+        'hit_ratio': (metrics['cache']['hit'] + metrics['cache']['stale']) / total if total else None,
+        'since': datetime.datetime.fromtimestamp(metrics['since'], datetime.timezone.utc)
+    }
@@ -0,0 +1,66 @@
+"""Stops' routing profiles -- the things needed to decide how to get a stop's departures
+(its live departures sources, current services and their operators) -- kept in the cache,
+so that getting a stop's departures usually needn't query the database for them
+"""
+from django.core.cache import cache
+from busstops import versions
+from busstops.models import Service
+
+
+# Changed (by invalidate) after importing services or live departures sources
+VERSION_KEY = 'stop-profiles-version'
+TIMEOUT = 86400
+
+
+class Profile(object):
+    def __init__(self, stop):
+        """Given a StopPoint, load its live departures sources' names, and its current services and their operators
+        """
+        self.live_sources = list(stop.live_sources.values_list('name', flat=True))
+        services = stop.service_set.filter(current=True).defer('geometry', 'simplified_geometry').distinct()
+        services = services.prefetch_related('operator')
+        self.services = sorted(services, key=Service.get_order)
+        operators = {}
+        for service in self.services:
+            for operator in service.operator.all():
+                operators.setdefault(operator.pk, operator)
+        self.operators = list(operators.values())
+
+
+def get_key(atco_code):
+    return 'stop-profile:' + atco_code
+
+
+def get_profile(stop):
+    """Given a StopPoint, return its Profile, from the cache if possible.
+
+    The profile is also kept on the StopPoint object, so it's only got once per request
+    """
+    if hasattr(stop, 'profile'):
+        return stop.profile
+    version = versions.get_version(VERSION_KEY)
+    profile = None
+    if version is not None:
+        profile = cache.get(get_key(stop.atco_code), version=version)
+    if profile is None:
+        profile = Profile(stop)
+        if version is not None:
+            cache.set(get_key(stop.atco_code), profile, TIMEOUT, version=version)
+    stop.profile = profile
+    return profile
+
+
+def get_cached_profiles(stops):
+    """Given some StopPoints, return a dict of the Profiles of those whose profiles are in the cache,
+    by ATCO code, without loading the others
+    """
+    version = versions.get_version(VERSION_KEY)
+    if version is None:
+        return {}
+    profiles = cache.get_many([get_key(stop.atco_code) for stop in stops], version=version)
+    return {stop.atco_code: profiles[get_key(stop.atco_code)] for stop in stops if get_key(stop.atco_code) in profiles}
+
+
+def invalidate():
+    """Make every stop's profile be loaded again next time it's used"""
+    versions.invalidate(VERSION_KEY)
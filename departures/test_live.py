@@ -2,12 +2,15 @@
 """Tests for live departures
 """
 import vcr
-from datetime import date, time, datetime
-from django.test import TestCase
+import random
+import threading
+from datetime import date, time, datetime, timedelta
+from django.test import TestCase, override_settings
 from django.shortcuts import render
 from freezegun import freeze_time
 from busstops.models import LiveSource, StopPoint, Service, Region, Operator, StopUsage, Journey, StopUsageUsage
-from . import live
+from django.contrib.auth.models import User
+from . import live, boards, breakers, caching, metrics, profiles, timestamps
 
 
 class DummyResponse(object):
@@ -18,6 +21,39 @@ class DummyResponse(object):
         return self.data
 
 
+def get_line_name(service):
+    if type(service) is Service:
+        return service.line_name
+    return service
+
+
+def old_blend(departures, live_rows):
+    """How live.blend used to work, looking through the whole list of departures for each live departure"""
+    added = False
+    for live_row in live_rows:
+        replaced = False
+        for row in departures:
+            if (
+                get_line_name(row['service']) == get_line_name(live_row['service'])
+                and (
+                    row['time'] and row['time'] == live_row['time']
+                    or 'live' not in row and (
+                        live_row['time'] is None
+                        or type(live_row['time']) is str
+                        or live.make_naive(row['time']) <= live_row['time']
+                    )
+                )
+            ):
+                row['live'] = live_row['live']
+                replaced = True
+                break
+        if not replaced:
+            added = True
+            departures.append(live_row)
+    if added and all(live.can_sort(departure) for departure in departures):
+        departures.sort(key=live.get_departure_order)
+
+
 class LiveDeparturesTest(TestCase):
     """Tests for live departures
     """
@@ -278,6 +314,229 @@ class LiveDeparturesTest(TestCase):
         self.assertEqual(str(res.context_data['departures'][2]['time']), '2017-03-28 19:20:00+01:00')
         self.assertEqual(str(res.context_data['departures'][2]['live']), '2017-03-28 19:24:08+01:00')
 
+    def test_board(self):
+        now = live.LOCAL_TIMEZONE.localize(datetime(2017, 3, 14, 20, 30))
+        departures = live.TimetableDepartures(self.stagecoach_stop, (), now)
+        expected = departures.get_departures()
+        self.assertEqual(len(expected), 2)
+        self.assertIsNone(boards.get_board(self.stagecoach_stop.atco_code, departures.get_all_departures))
+
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual(departures.get_departures(), expected)
+            self.assertIn(self.stagecoach_stop.atco_code, boards.BOARDS)
+            with self.assertNumQueries(0):
+                self.assertEqual(departures.get_departures(), expected)
+                departures.now = live.LOCAL_TIMEZONE.localize(datetime(2017, 3, 28, 18, 53))
+                self.assertEqual(str(departures.get_departures()[0]['time']), '2017-03-28 18:53:00+01:00')
+
+            boards.invalidate()
+            with self.assertNumQueries(1):
+                self.assertEqual(len(departures.get_departures()), 1)
+
+    def test_tfl_stop_area(self):
+        stop = StopPoint(atco_code='490000077E', common_name='Bethnal Green Station', heading=225)
+        other = StopPoint(atco_code='490000077F', common_name='Bethnal Green Stn', heading=45)
+        departures = live.TflDepartures(stop, ())
+        departures.add_stops([other], [Service(line_name='D3')])
+        self.assertEqual(departures.get_request_url(),
+                         'https://api.tfl.gov.uk/StopPoint/490000077E,490000077F/arrivals')
+        rows = departures.departures_from_response(DummyResponse([{
+            'naptanId': '490000077F',
+            'stationName': 'Bethnal Green Station',
+            'bearing': '45',
+            'expectedArrival': '2016-07-26T17:23:00Z',
+            'lineName': 'D3',
+            'destinationName': 'Crossharbour'
+        }, {
+            'naptanId': '490000077F',
+            'stationName': 'Bethnal Green Station',
+            'bearing': '45',
+            'expectedArrival': '2016-07-26T17:21:00Z',
+            'lineName': '8',
+            'destinationName': 'Bow Church'
+        }]))
+        self.assertEqual(rows, [])
+        other_rows = departures.other_departures['490000077F']
+        self.assertEqual([row['destination'] for row in other_rows], ['Bow Church', 'Crossharbour'])
+        self.assertEqual(other_rows[1]['service'].line_name, 'D3')
+        self.assertEqual(other_rows[0]['service'], '8')
+        # the correction to the other stop's name is saved in the background
+        self.assertEqual(other.common_name, 'Bethnal Green Station')
+        self.assertEqual(stop.common_name, 'Bethnal Green Station')
+
+    def test_caching(self):
+        atco_code = self.stagecoach_stop.atco_code
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            caching.HITS.clear()
+            caching.STATE['flushed'] = 0
+            caching.record_hit(self.cardiff_stop.atco_code)
+            caching.STATE['flushed'] = 0
+            caching.record_hit(atco_code)
+            self.assertEqual(set(caching.get_hot_stops(2)), {atco_code, self.cardiff_stop.atco_code})
+            caching.STATE['flushed'] = 0
+            caching.record_hit(self.cardiff_stop.atco_code)  # added to the count in the cache
+            self.assertEqual(caching.get_hot_stops(1), [self.cardiff_stop.atco_code])
+
+            # another process is fetching the departures, so wait for it
+            lock_key = caching.get_lock_key(atco_code)
+            caching.cache.add(lock_key, True, 5)
+            threading.Timer(0.1, caching.cache.set, (caching.get_key(atco_code), ({'departures': []}, 0), 60)).start()
+            with self.assertNumQueries(0):
+                self.assertEqual(caching.get_departures(self.stagecoach_stop, ()), {'departures': []})
+
+                # stale, but still being fetched again, so serve the stale departures straight away
+                self.assertEqual(caching.get_departures(self.stagecoach_stop, ()), {'departures': []})
+                self.assertTrue(caching.cache.get(lock_key))
+
+            # a stop with no live departures sources
+            stop = StopPoint.objects.create(atco_code='1800SB05291', locality_centre=False, active=True)
+            self.assertEqual(caching.refresh(stop, ()), 60)
+            departures, stale = caching.cache.get(caching.get_key(stop.atco_code))
+            self.assertEqual(departures['departures'], [])
+            self.assertGreater(stale, caching.time.time())
+            self.assertIsNone(caching.cache.get(caching.get_lock_key(stop.atco_code)))
+
+            # a lock that timed out and was acquired by another process isn't released by the first process
+            token = caching.acquire_lock(stop.atco_code)
+            self.assertIsNone(caching.acquire_lock(stop.atco_code))
+            caching.cache.set(caching.get_lock_key(stop.atco_code), 'other', 5)
+            caching.release_lock(stop.atco_code, token)
+            self.assertEqual(caching.cache.get(caching.get_lock_key(stop.atco_code)), 'other')
+            caching.release_lock(stop.atco_code, 'other')
+            self.assertIsNone(caching.cache.get(caching.get_lock_key(stop.atco_code)))
+
+    def test_profile(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            profiles.invalidate()
+            with self.assertNumQueries(3):
+                profile = profiles.get_profile(StopPoint(atco_code=self.stagecoach_stop.atco_code))
+            self.assertEqual(profile.live_sources, [])
+            self.assertEqual(profile.services, [self.stagecoach_service])
+            self.assertEqual([operator.name for operator in profile.operators], ['Stagecoach Oxenholme'])
+
+            stop = StopPoint(atco_code=self.stagecoach_stop.atco_code)
+            with self.assertNumQueries(0):
+                self.assertEqual(caching.get_services(stop), [self.stagecoach_service])
+                self.assertIs(profiles.get_profile(stop), stop.profile)
+
+            # the services of other stops (in a stop area) come from their cached profiles where possible
+            with self.assertNumQueries(0):
+                self.assertEqual(caching.get_others_services([StopPoint(atco_code=self.stagecoach_stop.atco_code)]),
+                                 [self.stagecoach_service])
+            with self.assertNumQueries(1):
+                self.assertEqual(caching.get_others_services([StopPoint(atco_code=self.stagecoach_stop.atco_code),
+                                                              self.cardiff_stop]), [self.stagecoach_service])
+
+            profiles.invalidate()
+            with self.assertNumQueries(3):
+                profiles.get_profile(StopPoint(atco_code=self.stagecoach_stop.atco_code))
+
+    @freeze_time('2017-01-01 12:00:30')
+    def test_breaker(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            breakers.NAMES.clear()
+            breaker = breakers.Breaker('kent')
+            self.assertTrue(breaker.allow())
+            for _ in range(breakers.FAILURE_THRESHOLD * 2):
+                breaker.record()
+            # not enough of the requests have failed
+            for _ in range(breakers.FAILURE_THRESHOLD * 2 - 1):
+                self.assertFalse(breaker.record('Read timed out'))
+                self.assertTrue(breaker.allow())
+            self.assertTrue(breaker.record('Read timed out'))
+            self.assertFalse(breaker.allow())
+            self.assertFalse(breaker.record('Read timed out'))  # already open
+
+            state = breaker.get_state()
+            self.assertEqual(state['requests'], breakers.FAILURE_THRESHOLD * 4 + 1)
+            self.assertEqual(state['errors'], breakers.FAILURE_THRESHOLD * 2 + 1)
+            self.assertEqual(state['error'], 'Read timed out')
+
+            # a request for a stop with only that source doesn't even try
+            with self.assertNumQueries(0):
+                departures = live.AcisLiveDepartures('kent', self.cardiff_stop, (), None).get_departures()
+            self.assertIsNone(departures)
+
+            # half-open, so let one trial request through
+            breakers.cache.set(breaker.opened_key, state['opened'] - breakers.RESET_TIMEOUT)
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breakers.Breaker('kent').allow())
+            breaker.record()
+            self.assertTrue(breakers.Breaker('kent').allow())
+
+            # registered by another process
+            breakers.NAMES.clear()
+            breakers.Breaker('tsy').register()
+            names = [name for name, _ in breakers.get_states()]
+            self.assertIn('kent', names)
+            self.assertIn('tsy', names)
+
+            self.assertEqual(self.client.get('/status').status_code, 302)
+            self.client.force_login(User.objects.create(username='admin', is_staff=True))
+            response = self.client.get('/status')
+            self.assertContains(response, '<td>kent</td>')
+            self.assertContains(response, 'Read timed out')
+
+    def test_metrics(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            metrics.SOURCES.clear()
+            metrics.CACHE.clear()
+            metrics.cache.clear()
+            metrics.record_request('tsy', 0.3)
+            metrics.record_request('tsy', 1.5, 'Read timed out', True)
+            metrics.record_parse('tsy', 0.002)
+            metrics.record_cache('hit')
+            metrics.record_cache('miss')
+            metrics.flush()
+
+            summary = metrics.get_summary()
+            name, source = summary['sources'][0]
+            self.assertEqual(name, 'tsy')
+            self.assertEqual(source['requests'], 2)
+            self.assertEqual(source['errors'], 1)
+            self.assertEqual(source['timeouts'], 1)
+            self.assertAlmostEqual(source['mean_latency'], 0.9)
+            self.assertEqual(source['histogram'][2], ('< 0.5 s', 1))
+            self.assertEqual(source['histogram'][4], ('< 2 s', 1))
+            self.assertEqual(summary['hit_ratio'], 0.5)
+
+            # counts flushed later are added to the shared counts
+            metrics.record_request('tsy', 0.1)
+            metrics.record_request('kent', 0.1)
+            metrics.flush()
+            summary = metrics.get_summary()
+            self.assertEqual([(name, source['requests']) for name, source in summary['sources']],
+                             [('kent', 1), ('tsy', 3)])
+
+            self.client.force_login(User.objects.create(username='admin', is_staff=True))
+            response = self.client.get('/status')
+            self.assertContains(response, '<td>tsy</td>')
+            self.assertContains(response, '1 hits, 0 stale hits, 1 misses')
+
+    def test_timestamps(self):
+        for string in ('2016-07-26T17:44:27.795969Z', '2017-03-14T20:23:00Z', '2016-03-27T01:00:00Z',
+                       '2016-10-30T00:30:00Z', '2016-10-30T01:30:00Z', '2017-05-26T18:57:00+01:00'):
+            parsed = timestamps.parse_datetime(string)
+            self.assertEqual(parsed, live.dateutil.parser.parse(string))
+            self.assertEqual(parsed.tzinfo.zone, 'Europe/London')
+        self.assertEqual(str(timestamps.parse_datetime('2016-10-30T00:30:00Z')), '2016-10-30 01:30:00+01:00')
+        self.assertEqual(str(timestamps.parse_datetime('2016-10-30T01:30:00Z')), '2016-10-30 01:30:00+00:00')
+        self.assertIsNone(timestamps.parse_datetime('2017-05-26T18:57:00').tzinfo)
+
+        self.assertEqual(timestamps.parse_day_first_datetime('05/06/2017 12:10:00'), datetime(2017, 6, 5, 12, 10))
+        self.assertEqual(timestamps.parse_day_first_datetime('5/6/2017 12:10'), datetime(2017, 6, 5, 12, 10))
+
+    def test_fetch_all(self):
+        event = threading.Event()
+
+        def fail():
+            raise ValueError
+
+        deadline = live.time.monotonic() + 0.5
+        self.assertEqual(live.fetch_all([lambda: 1, event.wait, fail], deadline), [1, None, None])
+        event.set()
+        self.assertEqual(live.fetch_all([], deadline), [])
+
     def test_transportapi(self):
         """Test the get_row and other methods for Transport API departures
         """
@@ -405,6 +664,65 @@ class LiveDeparturesTest(TestCase):
             'live': datetime(2017, 4, 21, 20, 5)
         }])
 
+    def test_blend_lambda(self):
+        """Norfolk (Lambda) departures have times with UTC offsets, like scheduled departures"""
+        service = Service(line_name='X1')
+        departures = [{
+            'time': timestamps.parse_datetime('2017-04-21T20:10:00+01:00'),
+            'service': service,
+            'destination': 'Lowestoft'
+        }, {
+            'time': timestamps.parse_datetime('2017-04-21T20:40:00+01:00'),
+            'service': service,
+            'destination': 'Lowestoft'
+        }]
+        lambda_departures = live.LambdaDepartures(self.london_stop, [service])
+        live.blend(departures, lambda_departures.departures_from_response(DummyResponse({
+            'departures': [{
+                'aimed_time': '2017-04-21T20:40:00+01:00',
+                'expected_time': '2017-04-21T20:45:00+01:00',
+                'service': 'X1',
+                'destination_name': 'Lowestoft'
+            }]
+        })))
+        self.assertEqual(2, len(departures))
+        self.assertNotIn('live', departures[0])
+        self.assertEqual(str(departures[1]['live']), '2017-04-21 20:45:00+01:00')
+
+    def test_blend_random(self):
+        """The indexed blend should match live departures to the same departures as the old blend did"""
+        rng = random.Random(0)
+        start = datetime(2017, 4, 21, 20)
+        for _ in range(500):
+            departures = []
+            for _ in range(rng.randint(0, 12)):
+                row = {
+                    'service': rng.choice(('1', '2', Service(line_name='1'), Service(line_name='X98'))),
+                    'time': timestamps.LOCAL_TIMEZONE.localize(start + timedelta(minutes=rng.randint(0, 12) * 5))
+                }
+                if rng.random() < 0.2:
+                    row['live'] = row['time']
+                departures.append(row)
+            if rng.random() < 0.5:
+                departures.sort(key=live.get_departure_order)
+            aware = rng.random() < 0.5  # like Lambda, or like most sources
+            live_rows = []
+            for _ in range(rng.randint(0, 8)):
+                when = start + timedelta(minutes=rng.randint(0, 12) * 5)
+                live_rows.append({
+                    'service': rng.choice(('1', '2', 'X98')),
+                    'time': timestamps.LOCAL_TIMEZONE.localize(when) if aware else rng.choice((when, None)),
+                    'live': timestamps.LOCAL_TIMEZONE.localize(when + timedelta(minutes=rng.randint(0, 10)))
+                })
+            old = [dict(row) for row in departures]
+            try:
+                old_blend(old, [dict(row) for row in live_rows])
+            except TypeError:  # comparing an aware time with a naive one
+                continue
+            new = [dict(row) for row in departures]
+            live.blend(new, [dict(row) for row in live_rows])
+            self.assertEqual(old, new)
+
     def test_max_age(self):
         """Test the get_max_age() method
         """
@@ -0,0 +1,63 @@
+"""Fast parsing of the timestamps in live departures sources' responses.
+
+Each source's timestamps are in a known format, so they can be parsed without dateutil's general parser
+(which is still used for anything not in the expected format)
+"""
+import re
+import datetime
+from functools import lru_cache
+import dateutil.parser
+import pytz
+
+
+LOCAL_TIMEZONE = pytz.timezone('Europe/London')
+
+# like 2016-07-26T17:44:27.795969Z (Transport for London) or 2017-03-14T20:23:00Z (Stagecoach)
+UTC_REGEX = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?(?:Z|[+-]00:?00)$')
+# like 05/06/2017 12:10:00 (Dublin)
+DAY_FIRST_REGEX = re.compile(r'(\d\d)/(\d\d)/(\d{4}) (\d\d):(\d\d):(\d\d)$')
+
+
+@lru_cache(maxsize=64)
+def get_local_offset(utc_date):
+    """Given a date, return a tuple containing the UTC offset timedelta and pytz tzinfo in force in
+    Europe/London for the whole of that (UTC) day, or None if the clocks change that day
+    """
+    start = LOCAL_TIMEZONE.fromutc(datetime.datetime.combine(utc_date, datetime.time(0)))
+    end = LOCAL_TIMEZONE.fromutc(datetime.datetime.combine(utc_date, datetime.time(23, 59, 59, 999999)))
+    if start.tzinfo is end.tzinfo:
+        return start.utcoffset(), start.tzinfo
+
+
+def to_local(utc_datetime):
+    """Given a naive datetime in UTC, return an aware datetime in Europe/London"""
+    offset = get_local_offset(utc_datetime.date())
+    if offset is None:
+        return LOCAL_TIMEZONE.fromutc(utc_datetime)
+    return (utc_datetime + offset[0]).replace(tzinfo=offset[1])
+
+
+def parse_datetime(string):
+    """Given an ISO 8601 date and time string, return an aware datetime in Europe/London
+    (or, if the string has no UTC offset, a naive datetime)
+    """
+    match = UTC_REGEX.match(string)
+    if match is not None:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        return to_local(datetime.datetime(
+            int(year), int(month), int(day), int(hour), int(minute), int(second),
+            int(fraction.ljust(6, '0')) if fraction else 0
+        ))
+    parsed = dateutil.parser.parse(string)
+    if parsed.tzinfo is None:
+        return parsed
+    return parsed.astimezone(LOCAL_TIMEZONE)
+
+
+def parse_day_first_datetime(string):
+    """Given a string like '05/06/2017 12:10:00', return a naive datetime"""
+    match = DAY_FIRST_REGEX.match(string)
+    if match is not None:
+        day, month, year, hour, minute, second = match.groups()
+        return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+    return dateutil.parser.parse(string, dayfirst=True)
@@ -0,0 +1,105 @@
+"""Find a service's TransXChange files in a TNDS zip archive
+without scanning the archive's whole list of names every time,
+and remember what was in an archive when it was last imported
+"""
+import os
+import pickle
+import zipfile
+from . import store
+
+
+# Increment this whenever the format of the index or manifest changes
+VERSION = 2
+
+# Open ZipFiles and loaded indexes, kept for the life of the process
+ARCHIVES = {}
+INDEXES = {}
+
+
+def get_key(archive_path):
+    """Given the path to an archive, return something that changes whenever the archive does"""
+    stat = os.stat(archive_path)
+    return stat.st_mtime, stat.st_size
+
+
+def get_index_path(tnds_dir, region_id):
+    return os.path.join(tnds_dir, 'timetables', region_id + '.index.pickle')
+
+
+def get_manifest_path(tnds_dir, region_id):
+    return os.path.join(tnds_dir, 'timetables', region_id + '.manifest.pickle')
+
+
+def dump(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as open_file:
+        pickle.dump(value, open_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def load(path):
+    try:
+        with open(path, 'rb') as open_file:
+            return pickle.load(open_file)
+    except (IOError, OSError, EOFError, ValueError, AttributeError, ImportError, pickle.UnpicklingError):
+        return
+
+
+def get_archive(archive_path):
+    """Given the path to an archive, return an open ZipFile,
+    reusing the one opened earlier in this process if the archive hasn't changed since
+    """
+    key = get_key(archive_path)
+    if archive_path in ARCHIVES:
+        archive_key, archive = ARCHIVES[archive_path]
+        if archive_key == key:
+            return archive
+        archive.close()
+        del ARCHIVES[archive_path]
+    archive = zipfile.ZipFile(archive_path)
+    ARCHIVES[archive_path] = (key, archive)
+    return archive
+
+
+def write_index(path, archive, filenames):
+    """Given a path, an open ZipFile and a dict of service codes to lists of filenames,
+    write an index of service codes to the ZipInfos (names, offsets and CRCs) of the files in the archive
+    """
+    index = {
+        service_code: [archive.getinfo(filename) for filename in service_filenames]
+        for service_code, service_filenames in filenames.items()
+    }
+    dump(path, (VERSION, get_key(archive.filename), index))
+
+
+def get_index(path, archive_path):
+    """Given the path to an index and the path to the archive it's for,
+    return a dict of service codes to lists of ZipInfos, or None if there isn't an up-to-date index
+    """
+    key = get_key(archive_path)
+    if path in INDEXES and INDEXES[path][0] == key:
+        return INDEXES[path][1]
+    value = load(path)
+    if value is None:
+        return
+    version, index_key, index = value
+    if version == VERSION and index_key == key:
+        INDEXES[path] = (key, index)
+        return index
+
+
+def write_manifest(path, manifest):
+    """Given a path and a dict of filenames to (CRC, size, service code, operating period end date) tuples,
+    describing the files in an archive that has just been imported, write the manifest to the path
+    """
+    dump(path, (VERSION, store.VERSION, manifest))
+
+
+def read_manifest(path):
+    """Given a path, return the manifest of the last import of that region's archive,
+    or None if there isn't one, or if the stored timetables from that import are out of date
+    """
+    value = load(path)
+    if value is not None and value[:2] == (VERSION, store.VERSION):
+        return value[2]
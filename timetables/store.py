@@ -0,0 +1,48 @@
+"""Store parsed TransXChange timetables on disk,
+so that a cache miss needn't mean parsing the XML all over again
+"""
+import os
+import pickle
+
+
+# Increment this whenever the txc classes change in a way that breaks old pickles
+VERSION = 2
+
+
+def get_path(tnds_dir, region_id, filename):
+    """Given the TNDS directory, a region ID and the name of an XML file in that region's zip archive,
+    return the path to the stored version of that file's timetable
+    """
+    return os.path.join(tnds_dir, 'timetables', region_id, filename + '.pickle')
+
+
+def strip(timetable):
+    """Remove the attributes of a Timetable that are only needed while parsing"""
+    for attribute in ('journeypatterns', 'stops', 'operators', 'element'):
+        if hasattr(timetable, attribute):
+            delattr(timetable, attribute)
+    return timetable
+
+
+def write(path, timetable, crc):
+    """Given a path, a Timetable and the CRC-32 of the XML file it was parsed from,
+    write a stripped copy of the timetable to the path
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as open_file:
+        pickle.dump((VERSION, crc, strip(timetable)), open_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def read(path, crc):
+    """Given a path and the CRC-32 of the current version of the XML file,
+    return the stored Timetable, or None if there isn't an up-to-date one
+    """
+    try:
+        with open(path, 'rb') as open_file:
+            version, stored_crc, timetable = pickle.load(open_file)
+    except (IOError, OSError, EOFError, ValueError, AttributeError, ImportError, pickle.UnpicklingError):
+        return
+    if version == VERSION and stored_crc == crc:
+        return timetable
@@ -4,7 +4,9 @@ import vcr
 from datetime import date, time
 from django.test import TestCase, override_settings
 from django.conf import settings
+from django.core.cache import cache
 from django.core.management import call_command
+from departures import profiles
 from busstops.models import Region, AdminArea, StopPoint, Service
 from . import gtfs
 
@@ -50,8 +52,11 @@ class GTFSTest(TestCase):
                 for item in os.listdir(dir_path):
                     open_zipfile.write(os.path.join(dir_path, item), item)
 
-        with vcr.use_cassette(os.path.join(FIXTURES_DIR, 'google_transit_ie') + '.yaml'):
-            call_command('import_ie_gtfs', '--force', '-v2')
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            cache.set(profiles.VERSION_KEY, 0, None)
+            with vcr.use_cassette(os.path.join(FIXTURES_DIR, 'google_transit_ie') + '.yaml'):
+                call_command('import_ie_gtfs', '--force', '-v2')
+            cls.profiles_version = cache.get(profiles.VERSION_KEY)
 
         for collection in settings.IE_COLLECTIONS:
             dir_path = os.path.join(FIXTURES_DIR, 'google_transit_' + collection)
@@ -64,6 +69,10 @@ class GTFSTest(TestCase):
         self.assertEqual(stop.common_name, 'Terenure Library')
         self.assertEqual(stop.admin_area_id, 822)
 
+    def test_profiles_invalidated(self):
+        # stops' cached services are out of date
+        self.assertNotEqual(self.profiles_version, 0)
+
     def test_small_timetable(self):
         timetable = gtfs.get_timetables('mortons-20-165-y11', date(2017, 6, 7))[0]
         timetable.groupings.sort(key=lambda g: str(g), reverse=True)
@@ -0,0 +1,42 @@
+"""Tests for storing parsed timetables on disk"""
+import os
+import shutil
+import tempfile
+from datetime import date, time
+from django.test import TestCase
+from . import txc, store
+
+
+FIXTURES_DIR = './busstops/management/tests/fixtures/'
+
+
+class StoreTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = store.get_path(self.directory, 'GB', 'NCSD_TXC/Megabus_MEGA_M11A.xml')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store(self):
+        self.assertIsNone(store.read(self.path, 1))
+
+        timetable = txc.timetable_from_filename(FIXTURES_DIR, 'NCSD_TXC/Megabus_Megabus14032016 163144_MEGA_M11A.xml',
+                                                None)
+        store.write(self.path, timetable, 1)
+        self.assertTrue(os.path.exists(self.path))
+        self.assertFalse(hasattr(timetable, 'element'))
+
+        # out of date
+        self.assertIsNone(store.read(self.path, 2))
+
+        timetable = store.read(self.path, 1)
+        timetable.set_date(date(2016, 12, 2))
+        self.assertEqual(timetable.groupings[0].rows_list[0].times,
+                         [time(13, 0), time(15, 0), time(16, 0), time(16, 30), time(18, 0), time(20, 0), time(23, 45)])
+
+    def test_corrupt(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as open_file:
+            open_file.write('this is not a pickle')
+        self.assertIsNone(store.read(self.path, 1))
@@ -2,6 +2,7 @@
 import xml.etree.cElementTree as ET
 from os.path import join
 from datetime import time, timedelta, date
+from functools import cmp_to_key
 from freezegun import freeze_time
 from django.test import TestCase
 from . import txc
@@ -425,6 +426,27 @@ class VehicleJourneyTest(TestCase):
         self.assertFalse(journey.should_show(date(2017, 8, 27), timetable))  # A Sunday
 
 
+class JourneyPatternTest(TestCase):
+    def test_get_offsets(self):
+        timetable = txc.timetable_from_filename(FIXTURES_DIR, 'NE_03_SCC_X6_1.xml', None)
+        journey = timetable.groupings[0].journeys[0]
+        stopusages, offsets, timinglink_ids = journey.journeypattern.get_offsets()
+        self.assertEqual(len(stopusages), len(offsets))
+        self.assertEqual(len(stopusages), len(timinglink_ids))
+        self.assertEqual(offsets[0], 0)
+        self.assertIsNone(timinglink_ids[0])
+        self.assertEqual(list(offsets), sorted(offsets))
+
+        times = list(journey.get_times())
+        self.assertEqual(times[0], (stopusages[0], journey.departure_time))
+        self.assertEqual(times[-1][1], txc.seconds_to_time(txc.time_to_seconds(journey.departure_time) + offsets[-1]))
+
+    def test_seconds_to_time(self):
+        self.assertEqual(txc.seconds_to_time(0), time(0))
+        self.assertEqual(txc.seconds_to_time(30610), time(8, 30, 10))
+        self.assertEqual(txc.time_to_seconds(time(23, 59, 59)), 86399)
+
+
 class OperatingProfileTest(TestCase):
     def test_bank_holidays(self):
         operating_profile = txc.OperatingProfile(ET.fromstring("""
@@ -529,6 +551,101 @@ class OperatingProfileTest(TestCase):
         self.assertFalse(operating_profile.should_show(date(2017, 4, 17)))
 
 
+class CalendarTest(TestCase):
+    def test_calendar(self):
+        calendar = txc.Calendar(date(2017, 4, 10), date(2017, 4, 23))  # Monday to Sunday
+        self.assertEqual(calendar.get_weekdays_bits({0, 6}), 0b10000011000001)
+        self.assertEqual(calendar.get_range_bits(date(2017, 4, 22), None), 0b11000000000000)
+        self.assertEqual(calendar.get_range_bits(date(2016, 1, 1), date(2017, 4, 11)), 0b11)
+        self.assertEqual(calendar.get_range_bits(date(2018, 1, 1), None), 0)
+        self.assertEqual(list(calendar.get_dates(0b101)), [date(2017, 4, 10), date(2017, 4, 12)])
+        self.assertTrue(calendar.is_set(0b100, date(2017, 4, 12)))
+        self.assertFalse(calendar.is_set(0b100, date(2017, 4, 13)))
+
+    def test_same_as_should_show(self):
+        """Compiled operating profiles should agree with OperatingProfile.should_show"""
+        for filename in ('SVRLABO024A.xml', 'swe_34-95-A-y10.xml', 'CGAO305.xml', 'twm_6-14B-_-y11-1.xml',
+                         'ea_20-12-_-y08-1.xml'):
+            timetable = txc.timetable_from_filename(FIXTURES_DIR, filename, None)
+            day = date(2016, 12, 1)
+            while day < date(2018, 1, 31):
+                for grouping in timetable.groupings:
+                    for journey in grouping.journeys:
+                        operating_profile = journey.operating_profile or timetable.operating_profile
+                        self.assertEqual(journey.should_show(day, timetable), operating_profile.should_show(day))
+                day += timedelta(days=1)
+
+    def test_timetable_bits(self):
+        timetable = txc.timetable_from_filename(FIXTURES_DIR, 'swe_34-95-A-y10.xml', None)
+        calendar = txc.Calendar(date(2017, 8, 28), date(2017, 9, 10))
+        self.assertEqual(list(calendar.get_dates(timetable.get_bits(calendar))), [
+            date(2017, 8, 29), date(2017, 8, 30), date(2017, 8, 31), date(2017, 9, 1), date(2017, 9, 2),
+            date(2017, 9, 4), date(2017, 9, 5), date(2017, 9, 6), date(2017, 9, 7), date(2017, 9, 8), date(2017, 9, 9)
+        ])  # not on Sundays, or the late summer bank holiday
+
+        # the most journeys on any day should be the most columns the timetable has on any day
+        dates = list(calendar.get_dates(calendar.all))
+        most = 0
+        for day in dates:
+            timetable.set_date(day)
+            for grouping in timetable.groupings:
+                if grouping.rows_list and grouping.rows_list[0].times:
+                    most = max(most, len(grouping.rows_list[0].times))
+        self.assertGreater(most, 0)
+        self.assertEqual(timetable.get_most_journeys(calendar, dates), most)
+
+
+def compare_journeys(x, y):
+    """The old pairwise comparison, which compared departure times, or times at the first shared stop if the
+    journeys had different origins
+    """
+    x_time = x.departure_time
+    y_time = y.departure_time
+    if x.get_origin() != y.get_origin():
+        times = {part.stop.atco_code: stop_time for part, stop_time in x.get_times()}
+        for part, stop_time in y.get_times():
+            if part.stop.atco_code in times:
+                if stop_time >= y.departure_time and times[part.stop.atco_code] >= x.departure_time:
+                    x_time = times[part.stop.atco_code]
+                    y_time = stop_time
+                break
+    if x_time > y_time:
+        return 1
+    if x_time < y_time:
+        return -1
+    return 0
+
+
+class GroupingTest(TestCase):
+    def test_sort_journeys(self):
+        """Journeys should be in the same order as when they were sorted with the old pairwise comparison"""
+        for filename, day in (
+            ('ea_21-13B-B-y08-1.xml', date(2016, 10, 16)),
+            ('ea_20-12-_-y08-1.xml', date(2016, 12, 2)),
+            ('NCSD_TXC/Megabus_Megabus14032016 163144_MEGA_M11A.xml', date(2017, 1, 28)),
+            ('NE_03_SCC_X6_1.xml', date(2016, 12, 15)),
+            ('SVRABBN017.xml', date(2017, 1, 28)),
+            ('ea_21-X29-_-y08-1.xml', date(2017, 12, 11)),
+            ('ea_21-CH-_-y08-1.xml', date(2017, 12, 10)),
+            ('SVRLABO024A.xml', date(2017, 4, 13)),
+            ('swe_34-95-A-y10.xml', date(2017, 8, 30)),
+            ('twm_6-14B-_-y11-1.xml', date(2017, 1, 23)),
+            ('SVRYEAGT00.xml', date(2017, 1, 27)),
+        ):
+            timetable = txc.timetable_from_filename(FIXTURES_DIR, filename, day)
+            for grouping in timetable.groupings:
+                journeys = [journey for journey in grouping.journeys if journey.should_show(day, timetable)]
+                self.assertEqual(journeys, sorted(journeys, key=cmp_to_key(compare_journeys)), filename)
+
+    def test_sort_journeys_circular(self):
+        """On a circular route, a journey from another origin should go by the first time the journeys share a stop,
+        not (as the old comparison sometimes did) by the time of a later visit to the same stop
+        """
+        timetable = txc.timetable_from_filename(FIXTURES_DIR, 'em_11-1-J-y08-1.xml', date(2017, 12, 10))
+        journeys = [journey.code for journey in timetable.groupings[1].journeys]
+        self.assertLess(journeys.index('VJ_11-1-J-y08-1-140-UG'), journeys.index('VJ_11-1-J-y08-1-114-UG'))
+
+
 class StopTest(TestCase):
     def test_is_at(self):
         stop = txc.Stop(ET.fromstring("""
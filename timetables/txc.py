@@ -7,7 +7,10 @@ import xml.etree.cElementTree as ET
 import calendar
 import datetime
 import difflib
-from functools import cmp_to_key
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from functools import lru_cache
 from django.utils.text import slugify
 from titlecase import titlecase
 
@@ -21,6 +24,8 @@ DURATION_REGEX = re.compile(
     r'P((?P<days>-?\d+?)D)?T((?P<hours>-?\d+?)H)?((?P<minutes>-?\d+?)M)?((?P<seconds>-?\d+?)S)?'
 )
 WEEKDAYS = {day: i for i, day in enumerate(calendar.day_name)}
+# How many days a Calendar (of days on which journeys run) should cover
+CALENDAR_DAYS = 400
 BANK_HOLIDAYS = {
     datetime.date(2016, 12, 26): ('BoxingDay',),
     datetime.date(2017, 4, 14): ('GoodFriday',),
@@ -65,6 +70,20 @@ def add_time(time, delta):
     return (datetime.datetime.combine(DUMMY_DATE, time) + delta).time()
 
 
+@lru_cache(maxsize=None)
+def seconds_to_time(seconds):
+    """Given a number of seconds (less than a day) after midnight, return a time.
+
+    Memoised, because the same few thousand times crop up over and over again.
+    """
+    minutes, seconds = divmod(seconds, 60)
+    return datetime.time(minutes // 60, minutes % 60, seconds)
+
+
+def time_to_seconds(time):
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
 def sanitize_description_part(part):
     """Given an oddly formatted part like 'Bus Station bay 5,Blyth',
     return a shorter, more normal version like 'Blyth'.
@@ -222,6 +241,71 @@ class Grouping(object):
         self.journeys = []
         self.rows = Rows()
 
+    def sort_journeys(self):
+        """Sort the journeys into the order they should appear as columns.
+
+        Journeys from the most common origin are ordered by departure time. Each other journey is slotted in
+        among them according to its time at the first stop it shares with them.
+        """
+        journeys = self.journeys
+        if not journeys:
+            return
+        if all(journey.sequencenumber is not None for journey in journeys):
+            journeys.sort(key=lambda journey: journey.sequencenumber)
+            return
+
+        origins = [journey.get_origin() for journey in journeys]
+        counts = Counter(origins)
+        origin = max(origins, key=counts.get)
+        if counts[origin] == len(journeys):
+            journeys.sort(key=lambda journey: journey.departure_time)
+            return
+        main = sorted((i for i, journey_origin in enumerate(origins) if journey_origin == origin),
+                      key=lambda i: journeys[i].departure_time)
+
+        keys = [None] * len(journeys)
+        departures = {}
+        stop_offsets = {}
+        main_stops = set()
+        for rank, i in enumerate(main):
+            keys[i] = (journeys[i].departure_time, rank * 2)
+            departures[i] = time_to_seconds(journeys[i].departure_time)
+            stop_offsets[i] = journeys[i].get_stop_offsets()
+            main_stops.update(stop_offsets[i])
+
+        # atco_code: ([(seconds, i), ...], [rank, ...]) for the journeys from the most common origin, in time order,
+        # where each rank is the lowest of the journeys at that stop at that time or later
+        stops = {}
+        for i, journey in enumerate(journeys):
+            if keys[i] is not None:
+                continue
+            keys[i] = (journey.departure_time, -1, journey.departure_time)
+            for stopusage, time in journey.get_times():
+                atco_code = stopusage.stop.atco_code
+                if atco_code not in main_stops or time < journey.departure_time:
+                    continue
+                if atco_code not in stops:
+                    entries = sorted(
+                        ((departures[j] + stop_offsets[j][atco_code], j), rank) for rank, j in enumerate(main)
+                        if atco_code in stop_offsets[j] and departures[j] + stop_offsets[j][atco_code] < 86400
+                    )
+                    ranks = [rank for _, rank in entries]
+                    for position in range(len(ranks) - 2, -1, -1):
+                        ranks[position] = min(ranks[position], ranks[position + 1])
+                    stops[atco_code] = ([entry for entry, _ in entries], ranks)
+                entries, ranks = stops[atco_code]
+                if entries:
+                    position = bisect_left(entries, (time_to_seconds(time), i))
+                    if position < len(entries):
+                        rank = ranks[position]
+                        keys[i] = (journeys[main[rank]].departure_time, rank * 2 - 1, time)
+                    else:
+                        rank = len(main) - 1
+                        keys[i] = (journeys[main[rank]].departure_time, rank * 2 + 1, time)
+                    break
+
+        self.journeys = [journeys[i] for i in sorted(range(len(journeys)), key=keys.__getitem__)]
+
     def has_minor_stops(self):
         for row in self.rows:
             if row.part.timingstatus == 'OTH':
@@ -322,6 +406,9 @@ class Grouping(object):
 
 class JourneyPattern(object):
     """A collection of JourneyPatternSections, in order."""
+    offsets = None
+    stop_offsets = None
+
     def __init__(self, element, sections, groupings, routes):
         self.id = element.attrib.get('id')
         # self.journeys = []
@@ -382,6 +469,40 @@ class JourneyPattern(object):
 
             previous = row
 
+    def get_offsets(self):
+        """Return a tuple of lists: the JourneyPatternStopUsages in order, the time at each one
+        (in seconds after the journey's departure time, including any wait times),
+        and the ID of the JourneyPatternTimingLink leading to each one.
+
+        Worked out once per pattern, rather than once per journey.
+        """
+        if self.offsets is None:
+            stopusages = [self.sections[0].timinglinks[0].origin]
+            offsets = array('i', [0])
+            timinglink_ids = [None]
+            offset = 0
+            for section in self.sections:
+                for timinglink in section.timinglinks:
+                    if hasattr(timinglink.origin, 'waittime'):
+                        offset += int(timinglink.origin.waittime.total_seconds())
+                    offset += int(timinglink.runtime.total_seconds())
+                    stopusages.append(timinglink.destination)
+                    offsets.append(offset)
+                    timinglink_ids.append(timinglink.id)
+                    if hasattr(timinglink.destination, 'waittime'):
+                        offset += int(timinglink.destination.waittime.total_seconds())
+            self.offsets = (stopusages, offsets, timinglink_ids)
+        return self.offsets
+
+    def get_stop_offsets(self):
+        """Return a dict of ATCO codes to the offset of the first time the pattern calls at each stop"""
+        if self.stop_offsets is None:
+            stopusages, offsets, _ = self.get_offsets()
+            self.stop_offsets = {}
+            for stopusage, offset in zip(stopusages, offsets):
+                self.stop_offsets.setdefault(stopusage.stop.atco_code, offset)
+        return self.stop_offsets
+
     def get_grouping(self, element, groupings, routes):
         route = element.find('txc:RouteRef', NS)
         if route is not None:
@@ -574,30 +695,30 @@ class VehicleJourney(object):
             }
 
     def get_times(self):
-        stopusage = self.journeypattern.sections[0].timinglinks[0].origin
-        time = self.departure_time
-        deadrun = self.start_deadrun is not None
-        if not deadrun:
-            yield(stopusage, time)
+        """Return an iterable of (JourneyPatternStopUsage, time) tuples"""
+        stopusages, offsets, timinglink_ids = self.journeypattern.get_offsets()
+        departure_time = time_to_seconds(self.departure_time)
+        times = [seconds_to_time((departure_time + offset) % 86400) for offset in offsets]
 
-        for section in self.journeypattern.sections:
-            for timinglink in section.timinglinks:
-                stopusage = timinglink.destination
-                if hasattr(timinglink.origin, 'waittime'):
-                    time = add_time(time, timinglink.origin.waittime)
+        if self.start_deadrun is None and self.end_deadrun is None:
+            return zip(stopusages, times)
 
-                time = add_time(time, timinglink.runtime)
+        return self.get_times_with_deadruns(stopusages, times, timinglink_ids)
 
-                if deadrun:
-                    if self.start_deadrun == timinglink.id:
-                        deadrun = False  # end of dead run
-                else:
-                    yield(stopusage, time)
+    def get_times_with_deadruns(self, stopusages, times, timinglink_ids):
+        deadrun = self.start_deadrun is not None
+        if not deadrun:
+            yield(stopusages[0], times[0])
 
-                if self.end_deadrun == timinglink.id:
-                    deadrun = True  # start of dead run
-                if hasattr(stopusage, 'waittime'):
-                    time = add_time(time, stopusage.waittime)
+        for i in range(1, len(stopusages)):
+            if deadrun:
+                if self.start_deadrun == timinglink_ids[i]:
+                    deadrun = False  # end of dead run
+            else:
+                yield(stopusages[i], times[i])
+
+            if self.end_deadrun == timinglink_ids[i]:
+                deadrun = True  # start of dead run
 
     def add_times(self):
         row_length = len(self.journeypattern.grouping.rows.first().times)
@@ -610,41 +731,38 @@ class VehicleJourney(object):
             while len(row.times) <= row_length:
                 row.times.append('')
 
-    def cmp(self, x, y):
-        x_time = x.departure_time
-        y_time = y.departure_time
-        if (
-            x.journeypattern.sections[0].timinglinks[0].origin.stop.atco_code
-            != y.journeypattern.sections[0].timinglinks[0].origin.stop.atco_code
-        ):
-            times = {part.stop.atco_code: time for part, time in x.get_times()}
-            for part, time in y.get_times():
-                if part.stop.atco_code in times:
-                    if time >= y.departure_time and times[part.stop.atco_code] >= x.departure_time:
-                        x_time = times[part.stop.atco_code]
-                        y_time = time
-                    break
-        if x_time > y_time:
-            return 1
-        if x_time < y_time:
-            return -1
-        return 0
+    def get_origin(self):
+        return self.journeypattern.sections[0].timinglinks[0].origin.stop.atco_code
 
-    def get_order(self):
-        if self.sequencenumber is not None:
-            return self.sequencenumber
-        return cmp_to_key(self.cmp)(self)
+    def get_stop_offsets(self):
+        """Return a dict of ATCO codes to the offset of the first time this journey calls at each stop"""
+        if self.start_deadrun is None and self.end_deadrun is None:
+            return self.journeypattern.get_stop_offsets()
+        departure_time = time_to_seconds(self.departure_time)
+        stop_offsets = {}
+        for stopusage, time in self.get_times():
+            stop_offsets.setdefault(stopusage.stop.atco_code, (time_to_seconds(time) - departure_time) % 86400)
+        return stop_offsets
 
     def should_show(self, date, timetable=None):
         if not date:
             return True
+        if timetable:
+            calendar = timetable.get_calendar(date)
+            return calendar.is_set(self.get_bits(calendar, timetable), date)
         if not self.operating_profile:
-            return timetable and timetable.operating_profile.should_show(date)
-        if timetable and timetable.service_code == 'PKBO301':
-            if hasattr(self, 'departure_time') and self.departure_time > datetime.time(19, 0):
-                return False
+            return False
         return self.operating_profile.should_show(date)
 
+    def get_bits(self, calendar, timetable):
+        """Given a Calendar and a Timetable, return a bitset of the days on which this journey runs"""
+        if not self.operating_profile:
+            return timetable.operating_profile.get_bits(calendar)
+        if timetable.service_code == 'PKBO301':
+            if hasattr(self, 'departure_time') and self.departure_time > datetime.time(19, 0):
+                return 0
+        return self.operating_profile.get_bits(calendar)
+
 
 class ServicedOrganisation(object):
     def __init__(self, element):
@@ -714,7 +832,68 @@ class DayOfWeek(object):
         return calendar.day_name[self.day]
 
 
+class Calendar(object):
+    """A run of consecutive days, against which operating profiles can be compiled into bitsets
+    (ints where bit n is set if something happens on the nth day), so that checking whether
+    something happens on a day, or finding all the days on which any of several things happen,
+    is just some bitwise arithmetic
+    """
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.length = (end - start).days + 1
+        self.all = (1 << self.length) - 1
+
+    def contains(self, date):
+        return self.start <= date <= self.end
+
+    def get_index(self, date):
+        return (date - self.start).days
+
+    def is_set(self, bits, date):
+        return bool(bits >> self.get_index(date) & 1)
+
+    def get_dates(self, bits):
+        for i in range(self.length):
+            if bits >> i & 1:
+                yield self.start + datetime.timedelta(days=i)
+
+    def get_date_bits(self, dates):
+        bits = 0
+        for date in dates:
+            if self.contains(date):
+                bits |= 1 << self.get_index(date)
+        return bits
+
+    def get_range_bits(self, start, end):
+        """Return the bits for the days from start to end (inclusive, and possibly None for open-ended)"""
+        first = max(self.get_index(start), 0)
+        last = self.length - 1 if end is None else min(self.get_index(end), self.length - 1)
+        if first > last:
+            return 0
+        return ((1 << (last - first + 1)) - 1) << first
+
+    def get_date_ranges_bits(self, dateranges):
+        bits = 0
+        for daterange in dateranges:
+            bits |= self.get_range_bits(daterange.start, daterange.end)
+        return bits
+
+    def get_weekdays_bits(self, weekdays):
+        """Given some weekday numbers (0 for Monday), return the bits for every one of those days"""
+        start_weekday = self.start.weekday()
+        week = 0
+        for i in range(7):
+            if (start_weekday + i) % 7 in weekdays:
+                week |= 1 << i
+        weeks = int('0000001' * (self.length // 7 + 1), 2)
+        return (week * weeks) & self.all
+
+
 class OperatingProfile(object):
+    calendar = None
+    bits = None
+
     def __init__(self, element, servicedorgs):
         element = element
 
@@ -782,33 +961,96 @@ class OperatingProfile(object):
             if date.weekday() not in self.regular_days:
                 return False
         if date in BANK_HOLIDAYS:
-            if 'AllBankHolidays' in self.operation_bank_holidays:
-                return True
-            if 'AllBankHolidays' in self.nonoperation_bank_holidays:
-                return False
-            for bank_holiday in BANK_HOLIDAYS[date]:
-                if bank_holiday in self.operation_bank_holidays:
-                    return True
-                if bank_holiday in self.nonoperation_bank_holidays:
-                    return False
+            operation = self.get_bank_holiday_operation(date)
+            if operation is not None:
+                return operation
 
         if not self.regular_days:
             return False
 
+        servicedorganisation_days, operation = self.get_servicedorganisation_days()
+        if servicedorganisation_days:
+            return operation == any(daterange.contains(date) for daterange in servicedorganisation_days)
+
+        return True
+
+    def get_bank_holiday_operation(self, date):
+        """Given a bank holiday date, return True or False if this profile specifically does or doesn't
+        operate on that bank holiday, or None if it doesn't say
+        """
+        if 'AllBankHolidays' in self.operation_bank_holidays:
+            return True
+        if 'AllBankHolidays' in self.nonoperation_bank_holidays:
+            return False
+        for bank_holiday in BANK_HOLIDAYS[date]:
+            if bank_holiday in self.operation_bank_holidays:
+                return True
+            if bank_holiday in self.nonoperation_bank_holidays:
+                return False
+
+    def get_servicedorganisation_days(self):
+        """Return a tuple of a list of DateRanges (or None) from any ServicedOrganisation,
+        and whether the profile operates on (True) or not on (False) those days
+        """
         if hasattr(self, 'servicedorganisation'):
             org = self.servicedorganisation
 
             nonoperation_days = (org.nonoperation_workingdays and org.nonoperation_workingdays.working_days or
                                  org.nonoperation_holidays and org.nonoperation_holidays.holidays)
             if nonoperation_days:
-                return not any(daterange.contains(date) for daterange in nonoperation_days)
+                return nonoperation_days, False
 
             operation_days = (org.operation_workingdays and org.operation_workingdays.working_days or
                               org.operation_holidays and org.operation_holidays.holidays)
             if operation_days:
-                return any(daterange.contains(date) for daterange in operation_days)
+                return operation_days, True
 
-        return True
+        return None, None
+
+    def get_bits(self, calendar):
+        """Given a Calendar, return a bitset of the days on which this profile operates
+        (equivalent to calling should_show for each day, but much quicker)
+        """
+        if self.calendar is not calendar:
+            self.bits = self.compile(calendar)
+            self.calendar = calendar
+        return self.bits
+
+    def compile(self, calendar):
+        everything = calendar.all
+
+        nonoperation_days = calendar.get_date_ranges_bits(getattr(self, 'nonoperation_days', ()))
+        operation_days = calendar.get_date_ranges_bits(getattr(self, 'operation_days', ()))
+
+        if self.regular_days:
+            regular_days = calendar.get_weekdays_bits({day.day for day in self.regular_days})
+        else:
+            regular_days = everything
+
+        bank_holidays_operation = bank_holidays_nonoperation = 0
+        for date in BANK_HOLIDAYS:
+            if calendar.contains(date):
+                operation = self.get_bank_holiday_operation(date)
+                if operation is True:
+                    bank_holidays_operation |= 1 << calendar.get_index(date)
+                elif operation is False:
+                    bank_holidays_nonoperation |= 1 << calendar.get_index(date)
+
+        if self.regular_days:
+            servicedorganisation_days, operation = self.get_servicedorganisation_days()
+            if servicedorganisation_days:
+                other_days = calendar.get_date_ranges_bits(servicedorganisation_days)
+                if not operation:
+                    other_days = ~other_days & everything
+            else:
+                other_days = everything
+        else:
+            other_days = 0
+
+        other_days &= ~bank_holidays_nonoperation
+        return ~nonoperation_days & everything & (
+            operation_days | regular_days & (bank_holidays_operation | other_days)
+        )
 
 
 class DateRange(object):
@@ -860,6 +1102,8 @@ class ColumnFoot(object):
 
 
 class Timetable(object):
+    calendar = None
+
     def __get_journeys(self, journeys_element, servicedorgs):
         journeys = {
             journey.code: journey for journey in (
@@ -908,6 +1152,46 @@ class Timetable(object):
                     journey.add_times()
             grouping.do_heads_and_feet()
 
+    def get_calendar(self, date):
+        """Return a Calendar, for compiling operating profiles against, containing the given date"""
+        if self.calendar is None or not self.calendar.contains(date):
+            self.calendar = Calendar(date, date + datetime.timedelta(days=CALENDAR_DAYS - 1))
+        return self.calendar
+
+    def get_bits(self, calendar):
+        """Given a Calendar, return a bitset of the days on which any journey runs
+        (within the operating period, and in a grouping with some rows)
+        """
+        bits = 0
+        for grouping in self.groupings:
+            if grouping.rows_list:
+                for journey in grouping.journeys:
+                    bits |= journey.get_bits(calendar, self)
+        return bits & calendar.get_range_bits(self.operating_period.start, self.operating_period.end)
+
+    def get_most_journeys(self, calendar, dates):
+        """Given a Calendar and some dates in it, return the most journeys that any one grouping has
+        on any one of the dates (the most columns the timetable would have)
+        """
+        period = calendar.get_range_bits(self.operating_period.start, self.operating_period.end)
+        most = 0
+        for grouping in self.groupings:
+            if grouping.rows_list and len(grouping.journeys) > most:
+                journeys_bits = [journey.get_bits(calendar, self) & period for journey in grouping.journeys]
+                for date in dates:
+                    most = max(most, sum(calendar.is_set(bits, date) for bits in journeys_bits))
+        return most
+
+    def set_description(self, description):
+        self.description = description
+        self.via = None
+        if description:
+            self.description_parts = list(map(sanitize_description_part, description.split(' - ')))
+            if ' via ' in self.description_parts[-1]:
+                self.description_parts[-1], self.via = self.description_parts[-1].split(' via ', 1)
+        else:
+            self.description_parts = None
+
     def __init__(self, open_file, date, description=None):
         iterator = ET.iterparse(open_file)
 
@@ -980,14 +1264,7 @@ class Timetable(object):
                     if description.isupper():
                         description = titlecase(description)
                     self.description = correct_description(description)
-
-                self.via = None
-                if self.description:
-                    self.description_parts = list(map(sanitize_description_part, self.description.split(' - ')))
-                    if ' via ' in self.description_parts[-1]:
-                        self.description_parts[-1], self.via = self.description_parts[-1].split(' via ', 1)
-                else:
-                    self.description_parts = None
+                self.set_description(self.description)
 
                 self.groupings = {
                     'outbound': Grouping('outbound', self),
@@ -1018,7 +1295,7 @@ class Timetable(object):
         del journeys
 
         for grouping in self.groupings:
-            grouping.journeys.sort(key=VehicleJourney.get_order)
+            grouping.sort_journeys()
 
         self.groupings.sort(key=lambda g: g.direction, reverse=True)
 